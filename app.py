@@ -7,9 +7,13 @@ from patient_routes import patients_bp
 from pharmacy_routes import pharmacy_bp
 from payment_routes import payment_bp
 from stats_routes import stats_bp
+from board_routes import board_bp
+from idempotency import new_token
 
 app = Flask(__name__)
 app.secret_key = 'clinic_secret_key_2025'
+# 表单幂等令牌：状态变更表单的隐藏字段 idempotency_key
+app.jinja_env.globals['idempotency_token'] = new_token
 
 # 注册各业务蓝图
 app.register_blueprint(auth_bp)
@@ -19,6 +23,7 @@ app.register_blueprint(patients_bp)
 app.register_blueprint(pharmacy_bp)
 app.register_blueprint(payment_bp)
 app.register_blueprint(stats_bp)
+app.register_blueprint(board_bp)
 
 
 @app.route('/')
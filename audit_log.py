@@ -0,0 +1,165 @@
+"""
+操作日志异步写入：log_operation 在业务事务提交后把日志放入内存队列，
+后台线程按条数（batch_size）或时间间隔（flush_interval）攒批，用一条多行 INSERT 写入 operation_log，
+审计不再占用业务请求的提交耗时。
+
+- 队列有上限（max_queue），写满时新日志被丢弃并计数（dropped），不会无限占用内存
+- 写库失败的批次按间隔重试 MAX_RETRIES 次，仍失败则逐条写入，只丢弃并计数（failed）真正写不进去的条目
+- 进程退出时（atexit）写完队列中剩余的日志
+- 必须立即落库的操作用 durable=True，在调用方事务内同步写入
+stats() 中 delayed 为从入队到写入超过 delay_warn 秒的条数，max_lag_ms 为最大延迟。
+"""
+import atexit
+import queue
+import threading
+import time
+
+COLUMNS = ('operator_id', 'operator_name', 'operator_role', 'operation_type', 'target_id', 'detail', 'create_time')
+INSERT_SQL = f"""
+    INSERT INTO operation_log ({', '.join(COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(COLUMNS))})
+"""
+MAX_RETRIES = 3
+
+
+def write_entries(conn, entries):
+    """写入若干条日志（不提交）；executemany 对 INSERT ... VALUES 会合并为一条多行 INSERT。"""
+    with conn.cursor() as cursor:
+        cursor.executemany(INSERT_SQL, entries)
+
+
+class AuditWriter:
+    def __init__(self, connect, max_queue=10000, batch_size=200, flush_interval=1.0, delay_warn=5.0):
+        self._connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.delay_warn = delay_warn
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._enqueued = 0
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._batches = 0
+        self._delayed = 0
+        self._max_lag = 0.0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def submit(self, entry):
+        """entry 为按 COLUMNS 顺序的元组；队列已满时丢弃并返回 False。"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.monotonic(), entry))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+        with self._lock:
+            self._enqueued += 1
+        return True
+
+    def _take_batch(self):
+        """等待第一条日志，再在 flush_interval 内凑满一批；停止时不再等待。"""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self._stopping.is_set():
+                timeout = 0
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        """多行写入整批，失败时重试；返回是否成功。"""
+        for attempt in range(MAX_RETRIES):
+            try:
+                conn = self._connect()
+                try:
+                    write_entries(conn, [entry for _, entry in batch])
+                    conn.commit()
+                finally:
+                    conn.close()
+                return True
+            except Exception as e:
+                print(f"[audit] 批量写入操作日志失败（第 {attempt + 1} 次）: {e}")
+                if attempt + 1 < MAX_RETRIES and not self._stopping.is_set():
+                    time.sleep(self.flush_interval)
+        return False
+
+    def _write_rows(self, batch):
+        """整批失败后逐条写入，单条坏数据（如必填列为空）只影响它自己；返回成功写入的条目。"""
+        written = []
+        try:
+            conn = self._connect()
+        except Exception as e:
+            print(f"[audit] 逐条写入操作日志失败: {e}")
+            return written
+        try:
+            for item in batch:
+                try:
+                    write_entries(conn, [item[1]])
+                    conn.commit()
+                    written.append(item)
+                except Exception as e:
+                    conn.rollback()
+                    print(f"[audit] 丢弃无法写入的操作日志 {item[1][:5]}: {e}")
+        finally:
+            conn.close()
+        return written
+
+    def _write(self, batch):
+        written = batch if self._write_batch(batch) else self._write_rows(batch)
+        now = time.monotonic()
+        lags = [now - enqueued_at for enqueued_at, _ in written]
+        with self._lock:
+            self._failed += len(batch) - len(written)
+            if not written:
+                return
+            self._written += len(written)
+            self._batches += 1
+            self._delayed += sum(1 for lag in lags if lag > self.delay_warn)
+            self._max_lag = max(self._max_lag, max(lags))
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def close(self, timeout=10):
+        """停止后台线程并写完队列中剩余的日志（进程退出时自动调用）。"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'enqueued': self._enqueued,
+                'written': self._written,
+                'batches': self._batches,
+                'dropped': self._dropped,
+                'failed': self._failed,
+                'delayed': self._delayed,
+                'max_lag_ms': round(self._max_lag * 1000, 1),
+            }
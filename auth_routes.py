@@ -5,6 +5,7 @@ from db import (
     DEFAULT_ADMIN_PASSWORD,
     generate_medical_record_no,
 )
+import patient_search
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -99,11 +100,12 @@ def register():
                     flash('该手机号已注册，请直接登录。', 'error')
                     return render_template('register.html')
 
-                mr_no = generate_medical_record_no(conn)
+                mr_no = generate_medical_record_no()
                 cursor.execute("""
                     INSERT INTO patient (name, gender, age, phone, allergy, medical_record_no, password)
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
                 """, (name, gender, age, phone, allergy, mr_no, password))
+                patient_search.index_patient(conn, cursor.lastrowid, name, phone, mr_no)
             conn.commit()
             flash('注册成功，请登录。', 'success')
             return redirect(url_for('auth.login'))
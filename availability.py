@@ -0,0 +1,116 @@
+"""
+号源余量：一段日期内 医生 × 日期 × 时间段 的剩余号数，供预约页在提交前展示。
+
+一次集合查询取出区间内的全部排班行，再按与 create_registration_record 相同的规则判定：
+    全天停诊（shift='全天' 且 status='停诊' 的任一行） -> 当天所有时间段停诊
+    有对应排班行（时间段相同、班次匹配或为全天）    -> 停诊 / 剩余 max_slots - booked_slots
+    没有排班行                                    -> 不限号（open，remaining 为 null）
+结果按查询条件缓存 ttl 秒；挂号、退号、恢复、排班修改提交后按日期失效。
+"""
+import threading
+import time
+from datetime import timedelta
+
+# 单次查询最多覆盖的天数
+MAX_DAYS = 31
+# 最多缓存的查询条件数，超出后淘汰最早加载的
+MAX_ENTRIES = 256
+
+
+def _date_range(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def load_availability(conn, date_col, doctor_ids, start, end, time_slots, shift_of):
+    """
+    返回 {doctor_id: {'YYYY-MM-DD': {time_slot: {'status', 'remaining', 'capacity'}}}}。
+    status：available / full / stopped / open（无排班，不限号）。
+    """
+    doctor_ids = sorted(doctor_ids)
+    if not doctor_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(doctor_ids))
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT doctor_id, {date_col} AS schedule_date, shift, time_slot, max_slots, booked_slots, status
+            FROM doctor_schedule
+            WHERE {date_col} BETWEEN %s AND %s
+              AND doctor_id IN ({placeholders})
+        """, [start, end] + doctor_ids)
+        rows = cursor.fetchall()
+
+    stopped_days = set()
+    by_slot = {}
+    for row in rows:
+        key = (row['doctor_id'], row['schedule_date'])
+        if row['shift'] == '全天' and row['status'] == '停诊':
+            stopped_days.add(key)
+        by_slot[key + (row['time_slot'],)] = row
+
+    stopped = {'status': 'stopped', 'remaining': 0, 'capacity': 0}
+    unlimited = {'status': 'open', 'remaining': None, 'capacity': None}
+    result = {}
+    for doctor_id in doctor_ids:
+        days = result[doctor_id] = {}
+        for day in _date_range(start, end):
+            slots = days[day.isoformat()] = {}
+            if (doctor_id, day) in stopped_days:
+                for slot in time_slots:
+                    slots[slot] = stopped
+                continue
+            for slot in time_slots:
+                row = by_slot.get((doctor_id, day, slot))
+                if row is None or row['shift'] not in (shift_of(slot), '全天'):
+                    slots[slot] = unlimited
+                elif row['status'] == '停诊':
+                    slots[slot] = stopped
+                else:
+                    remaining = max(int(row['max_slots']) - int(row['booked_slots']), 0)
+                    slots[slot] = {
+                        'status': 'available' if remaining else 'full',
+                        'remaining': remaining,
+                        'capacity': int(row['max_slots']),
+                    }
+    return result
+
+
+class AvailabilityCache:
+    """
+    按 (医生集合, 起止日期) 缓存号源余量 ttl 秒；invalidate(day) 只丢弃覆盖该日期的条目，
+    不传日期时全部丢弃。加载期间发生失效的结果只给当前调用方用，不写回缓存。
+    """
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+
+    def get(self, conn, date_col, doctor_ids, start, end, time_slots, shift_of):
+        key = (tuple(sorted(doctor_ids)), start, end)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            generation = self._generation
+        if cached and now - cached[0] < self.ttl:
+            return cached[1]
+        result = load_availability(conn, date_col, doctor_ids, start, end, time_slots, shift_of)
+        with self._lock:
+            if generation == self._generation:
+                if len(self._entries) >= MAX_ENTRIES:
+                    oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                    del self._entries[oldest]
+                self._entries[key] = (now, result)
+        return result
+
+    def invalidate(self, day=None):
+        with self._lock:
+            self._generation += 1
+            if day is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[1] <= day <= k[2]]:
+                del self._entries[key]
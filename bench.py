@@ -0,0 +1,441 @@
+"""
+性能基准脚本（需连接真实的 MySQL，配置同 db.py）。
+
+用法：
+    python bench.py startup [--workers 1 4 16]
+    python bench.py booking [--concurrency 200] [--max-slots 200]
+    python bench.py surge [--concurrency 300] [--max-slots 50]
+    python bench.py mrno [--threads 8] [--count 2000]
+    python bench.py consultation [--lines 1 30]
+"""
+import argparse
+import multiprocessing
+import statistics
+import sys
+import threading
+import time
+
+import pymysql
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _print_summary(title, values_ms):
+    print(f"{title}: n={len(values_ms)} "
+          f"min={min(values_ms):.1f}ms p50={statistics.median(values_ms):.1f}ms "
+          f"p99={_percentile(values_ms, 99):.1f}ms max={max(values_ms):.1f}ms")
+
+
+# ==================== startup：多 worker 首请求耗时 ==================== #
+
+
+def _startup_worker(start_barrier, result_queue):
+    start_barrier.wait()
+    begin = time.perf_counter()
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['role'] = 'admin'
+        sess['user_id'] = 1
+        sess['user_name'] = 'bench'
+    resp = client.get('/registration/manage')
+    result_queue.put(((time.perf_counter() - begin) * 1000, resp.status_code))
+
+
+def bench_startup(args):
+    """
+    模拟 N 个 worker 同时冷启动：每个子进程各自 import app 并发出第一个请求，
+    统计从进程开始到首请求返回的耗时（time-to-first-request）。
+    若要观察迁移协调效果，请在版本落后的数据库上运行。
+    """
+    ctx = multiprocessing.get_context('spawn')
+    for workers in args.workers:
+        barrier = ctx.Barrier(workers)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_startup_worker, args=(barrier, results)) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        samples = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        failed = [code for _, code in samples if code != 200]
+        _print_summary(f"startup workers={workers}", [ms for ms, _ in samples])
+        if failed:
+            print(f"  非 200 响应：{failed}")
+
+
+# ==================== booking：同一号源并发预约 ==================== #
+
+
+BENCH_DATE = '2099-12-31'
+BENCH_SLOT = '08:00-09:00'
+
+
+def _raw_connection():
+    from db import DB_CONFIG
+    return pymysql.connect(**DB_CONFIG)
+
+
+def _setup_bench_schedule(max_slots):
+    """在 BENCH_DATE 上为第一位在岗医生建一条号源为 max_slots 的排班，返回 (doctor, patient, schedule_id)。"""
+    from db import get_schedule_date_column
+
+    setup = _raw_connection()
+    try:
+        with setup.cursor() as cursor:
+            cursor.execute("SELECT doctor_id, dept_id FROM doctor WHERE status='正常' ORDER BY doctor_id LIMIT 1")
+            doctor = cursor.fetchone()
+            cursor.execute("SELECT patient_id FROM patient ORDER BY patient_id LIMIT 1")
+            patient = cursor.fetchone()
+            if not doctor or not patient:
+                return None, None, None
+            cursor.execute("DELETE FROM queue_sequence WHERE doctor_id=%s AND visit_date=%s",
+                           (doctor['doctor_id'], BENCH_DATE))
+            date_col = get_schedule_date_column(setup)
+            cursor.execute(f"""
+                INSERT INTO doctor_schedule (doctor_id, {date_col}, shift, time_slot, max_slots, booked_slots, status)
+                VALUES (%s, %s, '上午', %s, %s, 0, '可用')
+                ON DUPLICATE KEY UPDATE max_slots=VALUES(max_slots), booked_slots=0, status='可用'
+            """, (doctor['doctor_id'], BENCH_DATE, BENCH_SLOT, max_slots))
+            cursor.execute(f"""
+                SELECT schedule_id FROM doctor_schedule
+                WHERE doctor_id=%s AND {date_col}=%s AND time_slot=%s
+            """, (doctor['doctor_id'], BENCH_DATE, BENCH_SLOT))
+            schedule_id = cursor.fetchone()['schedule_id']
+        setup.commit()
+        return doctor, patient, schedule_id
+    finally:
+        setup.close()
+
+
+def _delete_bench_stats(cursor):
+    """删除 BENCH_DATE 的汇总行：压测挂号已删除，留下的增量会让 stats_rollup check 报告偏差。"""
+    cursor.execute("DELETE FROM daily_stats WHERE stat_date=%s", (BENCH_DATE,))
+    cursor.execute("DELETE FROM daily_medicine_stats WHERE stat_date=%s", (BENCH_DATE,))
+
+
+def _cleanup_bench_schedule(doctor, schedule_id):
+    """删除本次压测产生的挂号/台账/汇总/排班/排队号，返回清理前的 booked_slots。"""
+    conn = _raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT booked_slots FROM doctor_schedule WHERE schedule_id=%s", (schedule_id,))
+            booked = cursor.fetchone()['booked_slots']
+            cursor.execute("""
+                DELETE b FROM billing_ledger b JOIN registration r ON b.reg_id = r.reg_id
+                WHERE r.schedule_id=%s
+            """, (schedule_id,))
+            cursor.execute("DELETE FROM registration WHERE schedule_id=%s", (schedule_id,))
+            cursor.execute("DELETE FROM doctor_schedule WHERE schedule_id=%s", (schedule_id,))
+            cursor.execute("DELETE FROM queue_sequence WHERE doctor_id=%s AND visit_date=%s",
+                           (doctor['doctor_id'], BENCH_DATE))
+            _delete_bench_stats(cursor)
+        conn.commit()
+        return booked
+    finally:
+        conn.close()
+
+
+def bench_booking(args):
+    """
+    N 个线程（各自独立连接）同时预约同一医生同一时间段，校验：
+    排队号唯一且从 1 连续、成功数不超过 max_slots、booked_slots 与成功数一致。
+    使用远期日期 BENCH_DATE 的排班，结束后清理本次产生的数据。
+    """
+    from db import create_registration_record
+
+    doctor, patient, schedule_id = _setup_bench_schedule(args.max_slots)
+    if not doctor:
+        print("需要至少一名医生和一名患者")
+        return
+
+    barrier = threading.Barrier(args.concurrency)
+    numbers, failures, latencies = [], [], []
+    lock = threading.Lock()
+
+    def worker():
+        conn = _raw_connection()
+        try:
+            barrier.wait()
+            begin = time.perf_counter()
+            try:
+                num = create_registration_record(
+                    conn, patient['patient_id'], doctor['doctor_id'], doctor['dept_id'],
+                    BENCH_DATE, '上午', BENCH_SLOT
+                )
+                conn.commit()
+                outcome = (num, None)
+            except Exception as e:
+                conn.rollback()
+                outcome = (None, str(e))
+            elapsed = (time.perf_counter() - begin) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if outcome[0] is not None:
+                    numbers.append(outcome[0])
+                else:
+                    failures.append(outcome[1])
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - begin
+
+    booked = _cleanup_bench_schedule(doctor, schedule_id)
+
+    _print_summary(f"booking concurrency={args.concurrency}", latencies)
+    print(f"  成功 {len(numbers)}，失败 {len(failures)}，总耗时 {total:.2f}s，"
+          f"吞吐 {len(numbers) / total:.1f} 次/秒")
+    unique_ok = len(set(numbers)) == len(numbers)
+    gap_free = sorted(numbers) == list(range(1, len(numbers) + 1))
+    print(f"  排队号唯一：{unique_ok}，连续无空号：{gap_free}，"
+          f"未超号：{len(numbers) <= args.max_slots}，booked_slots={booked}")
+    if failures:
+        print(f"  失败原因示例：{sorted(set(failures))[:3]}")
+
+
+# ==================== surge：放号高峰，有/无预约准入对比 ==================== #
+
+
+def bench_surge(args):
+    """
+    模拟放号瞬间：N 个线程同时预约同一号源（号源数远小于 N），每个请求与 book_appointment 一样
+    先借连接再建挂号。分别在不经过 / 经过预约准入（db.admit_booking）时各跑一轮，
+    比较请求吞吐、p99 延迟与各类结果数；有准入时被拒绝的请求不借连接、不碰排班行。
+    """
+    from booking_gate import RetryLater, SlotFull
+    from db import admit_booking, create_registration_record, get_booking_gate_stats, reopen_booking
+
+    for gated in (False, True):
+        doctor, patient, schedule_id = _setup_bench_schedule(args.max_slots)
+        if not doctor:
+            print("需要至少一名医生和一名患者")
+            return
+        # 清除上一轮留下的号源满标记
+        reset = _raw_connection()
+        try:
+            reopen_booking(reset, doctor['doctor_id'], BENCH_DATE, BENCH_SLOT)
+        finally:
+            reset.close()
+
+        barrier = threading.Barrier(args.concurrency)
+        outcomes, latencies = {}, []
+        lock = threading.Lock()
+
+        def book():
+            conn = _raw_connection()
+            try:
+                create_registration_record(
+                    conn, patient['patient_id'], doctor['doctor_id'], doctor['dept_id'],
+                    BENCH_DATE, '上午', BENCH_SLOT
+                )
+            finally:
+                conn.close()
+
+        def worker():
+            barrier.wait()
+            begin = time.perf_counter()
+            try:
+                if gated:
+                    with admit_booking(doctor['doctor_id'], BENCH_DATE, BENCH_SLOT):
+                        book()
+                else:
+                    book()
+                outcome = '成功'
+            except SlotFull:
+                outcome = '号源已满'
+            except RetryLater:
+                outcome = '稍后重试'
+            except Exception as e:
+                outcome = type(e).__name__
+            elapsed = (time.perf_counter() - begin) * 1000
+            with lock:
+                latencies.append(elapsed)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        begin = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = time.perf_counter() - begin
+
+        booked = _cleanup_bench_schedule(doctor, schedule_id)
+        title = "surge 有准入" if gated else "surge 无准入"
+        _print_summary(f"{title} concurrency={args.concurrency} max_slots={args.max_slots}", latencies)
+        print(f"  总耗时 {total:.2f}s，请求吞吐 {len(latencies) / total:.1f} 次/秒，"
+              f"结果 {outcomes}，booked_slots={booked}")
+        if gated:
+            print(f"  准入统计：{get_booking_gate_stats()}")
+
+
+# ==================== mrno：多线程批量建档 ==================== #
+
+
+def bench_mrno(args):
+    """
+    多线程批量创建患者（每个患者一次取号 + INSERT + 提交），统计建档吞吐并校验病历号唯一。
+    测试患者以 phone='bench-...' 标记，结束后删除。
+    """
+    from db import get_db_connection, generate_medical_record_no
+
+    per_thread = args.count // args.threads
+    issued, latencies = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def worker(tid):
+        conn = get_db_connection()
+        local_nos, local_lat = [], []
+        try:
+            barrier.wait()
+            for i in range(per_thread):
+                begin = time.perf_counter()
+                mr_no = generate_medical_record_no()
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO patient (name, gender, age, phone, allergy, medical_record_no, password)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    """, ('压测患者', '男', 30, f'bench-{tid}-{i}', '', mr_no, '123456'))
+                conn.commit()
+                local_lat.append((time.perf_counter() - begin) * 1000)
+                local_nos.append(mr_no)
+        finally:
+            conn.close()
+        with lock:
+            issued.extend(local_nos)
+            latencies.extend(local_lat)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - begin
+
+    cleanup = _raw_connection()
+    try:
+        with cleanup.cursor() as cursor:
+            cursor.execute("DELETE FROM patient WHERE phone LIKE %s", ('bench-%',))
+        cleanup.commit()
+    finally:
+        cleanup.close()
+
+    _print_summary(f"mrno threads={args.threads}", latencies)
+    print(f"  建档 {len(issued)} 个，总耗时 {total:.2f}s，吞吐 {len(issued) / total:.1f} 个/秒，"
+          f"病历号唯一：{len(set(issued)) == len(issued)}")
+
+
+# ==================== consultation：处方行数与往返次数 ==================== #
+
+
+def _questions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SHOW SESSION STATUS LIKE 'Questions'")
+        return int(cursor.fetchone()['Value'])
+
+
+def bench_consultation(args):
+    """
+    对 1 行 / 30 行处方分别提交一次诊疗，用会话级 Questions 计数统计 SQL 往返次数，
+    验证批量提交的往返次数不随处方行数增长。测试挂号使用 BENCH_DATE，结束后清理。
+    """
+    import billing
+    import stats_rollup
+    from db import save_consultation
+
+    conn = _raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT doctor_id, dept_id, reg_fee FROM doctor WHERE status='正常' ORDER BY doctor_id LIMIT 1")
+            doctor = cursor.fetchone()
+            cursor.execute("SELECT patient_id FROM patient ORDER BY patient_id LIMIT 1")
+            patient = cursor.fetchone()
+            cursor.execute("SELECT med_id FROM medicine WHERE stock >= 1 ORDER BY stock DESC LIMIT 30")
+            med_ids = [row['med_id'] for row in cursor.fetchall()]
+        if not doctor or not patient or not med_ids:
+            print("需要至少一名医生、一名患者和一种有库存的药品")
+            return
+
+        for lines in args.lines:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO registration (patient_id, doctor_id, dept_id, reg_fee, visit_status, queue_num,
+                                              reg_time, visit_date, shift, time_slot, fee_status)
+                    VALUES (%s, %s, %s, %s, '就诊中', 0, NOW(), %s, '上午', %s, '未支付')
+                """, (patient['patient_id'], doctor['doctor_id'], doctor['dept_id'], doctor['reg_fee'],
+                      BENCH_DATE, BENCH_SLOT))
+                reg_id = cursor.lastrowid
+            # 与 create_registration_record 一样建台账行、计入汇总，诊疗提交走真实的写路径
+            billing.open_ledger(conn, [reg_id])
+            stats_rollup.add_registrations(conn, [reg_id])
+            conn.commit()
+
+            # 同一药品重复出现时按总量校验库存，这里每行数量为 1
+            items = [(med_ids[i % len(med_ids)], 1, '压测') for i in range(lines)]
+            before = _questions(conn)
+            begin = time.perf_counter()
+            save_consultation(conn, reg_id, doctor['doctor_id'], '压测主诉', '压测诊断', items)
+            elapsed = (time.perf_counter() - begin) * 1000
+            round_trips = _questions(conn) - before - 1
+            print(f"consultation lines={lines}: 往返 {round_trips} 次，耗时 {elapsed:.1f}ms")
+
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM prescription WHERE reg_id=%s", (reg_id,))
+                cursor.execute("DELETE FROM medical_record WHERE reg_id=%s", (reg_id,))
+                cursor.execute("DELETE FROM billing_ledger WHERE reg_id=%s", (reg_id,))
+                cursor.execute("DELETE FROM registration WHERE reg_id=%s", (reg_id,))
+                _delete_bench_stats(cursor)
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='诊疗通性能基准')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('startup', help='多 worker 冷启动首请求耗时')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('booking', help='同一号源并发预约：排队号唯一/连续、不超号')
+    p.add_argument('--concurrency', type=int, default=200)
+    p.add_argument('--max-slots', type=int, default=200)
+    p.set_defaults(func=bench_booking)
+
+    p = sub.add_parser('surge', help='放号高峰：有/无预约准入时的吞吐与 p99 延迟')
+    p.add_argument('--concurrency', type=int, default=300)
+    p.add_argument('--max-slots', type=int, default=50)
+    p.set_defaults(func=bench_surge)
+
+    p = sub.add_parser('mrno', help='多线程批量建档：病历号生成吞吐与唯一性')
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--count', type=int, default=2000)
+    p.set_defaults(func=bench_mrno)
+
+    p = sub.add_parser('consultation', help='诊疗提交往返次数（不同处方行数）')
+    p.add_argument('--lines', type=int, nargs='+', default=[1, 30])
+    p.set_defaults(func=bench_consultation)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+挂号账单台账 billing_ledger：每条挂号一行，保存挂号费/检查费/药费/合计及已付、已退金额（DECIMAL）。
+
+各写路径在自己的事务内维护：
+    建挂号        open_ledger()
+    写处方        add_medicine_fee()
+    支付          record_payment()
+    退号退款      record_refund()
+收银台、患者缴费页直接读台账，不再对每行做 SUM(prescription.total_amount)。
+
+paid_amount 是支付时的合计金额。支付后再写处方（如先交挂号费再就诊）只增加 total_fee，
+total_fee - paid_amount 即为未付余额。
+
+与原始表核对并修复：
+    python billing.py rebuild
+"""
+import sys
+
+_REBUILD_SQL = """
+    INSERT INTO billing_ledger (reg_id, reg_fee, check_fee, med_fee, total_fee, paid_amount, refunded_amount)
+    SELECT t.reg_id, t.reg_fee, t.check_fee, t.med_fee, t.total_fee,
+           CASE WHEN t.fee_status IN ('已支付', '已退款') THEN t.total_fee ELSE 0 END,
+           CASE WHEN t.fee_status = '已退款' THEN t.total_fee ELSE 0 END
+    FROM (
+        SELECT r.reg_id, r.fee_status, r.reg_fee, IFNULL(r.check_fee, 0) AS check_fee,
+               IFNULL(pf.med_fee, 0) AS med_fee,
+               r.reg_fee + IFNULL(r.check_fee, 0) + IFNULL(pf.med_fee, 0) AS total_fee
+        FROM registration r
+                 LEFT JOIN (
+                     SELECT reg_id, SUM(total_amount) AS med_fee FROM prescription GROUP BY reg_id
+                 ) pf ON pf.reg_id = r.reg_id
+    ) t
+    ON DUPLICATE KEY UPDATE
+        reg_fee = VALUES(reg_fee),
+        check_fee = VALUES(check_fee),
+        med_fee = VALUES(med_fee),
+        total_fee = VALUES(total_fee),
+        paid_amount = CASE WHEN VALUES(paid_amount) = 0 THEN 0
+                           WHEN paid_amount > 0 THEN paid_amount
+                           ELSE VALUES(paid_amount) END,
+        refunded_amount = CASE WHEN VALUES(refunded_amount) = 0 THEN 0
+                               WHEN paid_amount > 0 THEN paid_amount
+                               ELSE VALUES(refunded_amount) END
+"""
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def _ids(reg_ids):
+    return sorted({int(r) for r in reg_ids if r})
+
+
+def open_ledger(conn, reg_ids):
+    """新挂号插入后调用：按挂号费/检查费建台账行，药费为 0。"""
+    reg_ids = _ids(reg_ids)
+    if not reg_ids:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO billing_ledger (reg_id, reg_fee, check_fee, med_fee, total_fee, paid_amount)
+            SELECT reg_id, reg_fee, IFNULL(check_fee, 0), 0, reg_fee + IFNULL(check_fee, 0),
+                   CASE WHEN fee_status = '已支付' THEN reg_fee + IFNULL(check_fee, 0) ELSE 0 END
+            FROM registration
+            WHERE reg_id IN ({_placeholders(reg_ids)})
+        """, reg_ids)
+
+
+def add_medicine_fee(conn, reg_id, amount):
+    """写入处方后调用：药费与合计同时累加 amount。"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE billing_ledger
+            SET med_fee = med_fee + %s, total_fee = total_fee + %s
+            WHERE reg_id = %s
+        """, (amount, amount, reg_id))
+
+
+def record_payment(conn, reg_ids):
+    """支付成功后调用：已付金额记为当前合计。"""
+    reg_ids = _ids(reg_ids)
+    if not reg_ids:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE billing_ledger SET paid_amount = total_fee
+            WHERE reg_id IN ({_placeholders(reg_ids)})
+        """, reg_ids)
+
+
+def record_refund(conn, reg_ids):
+    """退号退款后调用：已退金额记为已付金额（未支付的挂号已付为 0，不产生退款）。"""
+    reg_ids = _ids(reg_ids)
+    if not reg_ids:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE billing_ledger SET refunded_amount = paid_amount
+            WHERE reg_id IN ({_placeholders(reg_ids)})
+        """, reg_ids)
+
+
+def rebuild(conn):
+    """
+    按原始表重算全部台账行（挂号费/检查费/处方合计）。
+    已付/已退按 fee_status 判断：未支付为 0；已支付/已退款时保留台账中支付时记下的金额（与 record_payment 一致），
+    没有记录的（台账建立前的历史数据）按当前合计推算。
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(_REBUILD_SQL)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv != ['rebuild']:
+        print("用法：python billing.py rebuild")
+        return 2
+
+    import pymysql
+    from db import DB_CONFIG
+
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        rebuild(conn)
+        print("[billing] 已按原始表重建账单台账")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
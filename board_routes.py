@@ -0,0 +1,73 @@
+from flask import Blueprint, render_template, redirect, url_for, flash, Response
+from db import get_db_connection, get_reference_data
+import queue_events
+
+board_bp = Blueprint('board', __name__)
+
+
+def _department(conn, dept_id):
+    for dept in get_reference_data(conn)['departments']:
+        if dept['dept_id'] == dept_id:
+            return dept
+    return None
+
+
+@board_bp.route('/board')
+def board_index():
+    """
+    候诊区叫号屏入口：列出各科室的叫号屏地址（公开页面，供大厅屏幕打开）。
+    """
+    conn = get_db_connection()
+    try:
+        departments = get_reference_data(conn)['departments']
+    finally:
+        conn.close()
+    return render_template('call_board.html', departments=departments, dept=None, doctors=[])
+
+
+@board_bp.route('/board/<int:dept_id>')
+def call_board(dept_id):
+    """
+    科室叫号屏：每位医生当前叫号/就诊中的患者与下一位，数据来自进程内科室队列。
+    """
+    conn = get_db_connection()
+    try:
+        dept = _department(conn, dept_id)
+        if not dept:
+            flash("科室不存在", 'error')
+            return redirect(url_for('board.board_index'))
+        doctors = queue_events.board_view(conn, dept_id)
+    finally:
+        conn.close()
+    return render_template('call_board.html', departments=[], dept=dept, doctors=doctors)
+
+
+@board_bp.route('/board/<int:dept_id>/stream')
+def call_board_stream(dept_id):
+    """
+    叫号屏推送（text/event-stream）：连接后先发送一次完整数据，之后科室队列每次变化推送一次。
+    科室已装载时不访问数据库。
+    """
+    conn = None
+    try:
+        # 只为存在的科室建立频道与科室队列；已装载的科室必然存在，不再查询
+        if queue_events.cached_board_view(dept_id) is None:
+            conn = get_db_connection()
+            if not _department(conn, dept_id):
+                return "科室不存在", 404
+        sub = queue_events.subscribe_board(dept_id)
+        try:
+            doctors = queue_events.cached_board_view(dept_id)
+            if doctors is None:
+                if conn is None:
+                    conn = get_db_connection()
+                doctors = queue_events.board_view(conn, dept_id)
+        except Exception:
+            queue_events.unsubscribe(sub)
+            raise
+    finally:
+        if conn is not None:
+            conn.close()
+    return Response(queue_events.stream(sub, initial={'type': 'board', 'kind': 'snapshot', 'doctors': doctors}),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,144 @@
+"""
+预约准入：放号高峰时同一号源（医生 + 日期 + 时间段，即 doctor_schedule 的唯一键）的预约
+在进程内排队、逐个进入，排队人数超限或等待超时时立即返回“稍后重试”，
+号源已满时在 full_ttl 秒内直接拒绝，不再借连接、不再去争抢同一行排班的行锁。
+
+    with gate.admit((doctor_id, visit_date, time_slot)):
+        conn = get_db_connection()
+        ...create_registration_record(...)
+
+号源满由 create_registration_record 调用 mark_full() 标记；只有释放号源的操作（退号、排班修改）才 reopen() 解除，
+挂号成功不解除，放号高峰时已满的号源一直走快速拒绝。
+排队只在本进程内生效，多进程部署时各进程分别排队，最终仍由排班行的条件更新保证不超号。
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class SlotFull(ValueError):
+    """号源已满。"""
+
+
+class RetryLater(Exception):
+    """排队人数过多或等待超时，稍后重试。"""
+
+
+class _Lane:
+    __slots__ = ('lock', 'waiting', 'full_until')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.full_until = 0.0
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class BookingGate:
+    """
+    - max_waiting：同一号源最多排队（含正在处理）的请求数，超过直接拒绝
+    - wait_timeout：排队最长等待秒数，超时拒绝
+    - full_ttl：号源满标记的有效秒数（其它进程退号时本进程最迟在此之后重新放行）
+    """
+
+    def __init__(self, max_waiting=50, wait_timeout=3.0, full_ttl=5.0, samples=1000):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.full_ttl = full_ttl
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._waits = deque(maxlen=samples)
+        self._waiting = 0
+        self._max_depth = 0
+        self._admitted = 0
+        self._rejected_full = 0
+        self._rejected_busy = 0
+        self._timeouts = 0
+
+    def _drop_idle(self, key, lane):
+        if lane.waiting == 0 and lane.full_until <= time.monotonic() and self._lanes.get(key) is lane:
+            del self._lanes[key]
+
+    def _leave(self, key, lane):
+        with self._lock:
+            lane.waiting -= 1
+            self._waiting -= 1
+            self._drop_idle(key, lane)
+
+    @contextmanager
+    def admit(self, key):
+        begin = time.monotonic()
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            if lane.full_until > begin:
+                self._rejected_full += 1
+                raise SlotFull("该班次号源已满")
+            if lane.waiting >= self.max_waiting:
+                self._rejected_busy += 1
+                raise RetryLater("当前预约人数较多，请稍后重试")
+            lane.waiting += 1
+            self._waiting += 1
+            self._max_depth = max(self._max_depth, lane.waiting)
+
+        if not lane.lock.acquire(timeout=self.wait_timeout):
+            with self._lock:
+                self._timeouts += 1
+            self._leave(key, lane)
+            raise RetryLater("当前预约人数较多，请稍后重试")
+        try:
+            waited = time.monotonic() - begin
+            with self._lock:
+                self._waits.append(waited)
+                # 排队期间前面的请求可能已把号源约满
+                if lane.full_until > time.monotonic():
+                    self._rejected_full += 1
+                    raise SlotFull("该班次号源已满")
+                self._admitted += 1
+            yield
+        finally:
+            lane.lock.release()
+            self._leave(key, lane)
+
+    def mark_full(self, key):
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            lane.full_until = time.monotonic() + self.full_ttl
+
+    def reopen(self, key=None):
+        """解除号源满标记：指定 key 只解除该号源，否则全部解除。"""
+        with self._lock:
+            if key is not None:
+                lane = self._lanes.get(key)
+                if lane is not None:
+                    lane.full_until = 0.0
+                    self._drop_idle(key, lane)
+                return
+            for lane_key, lane in list(self._lanes.items()):
+                lane.full_until = 0.0
+                self._drop_idle(lane_key, lane)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                'lanes': len(self._lanes),
+                'waiting': self._waiting,
+                'max_depth': self._max_depth,
+                'admitted': self._admitted,
+                'rejected_full': self._rejected_full,
+                'rejected_busy': self._rejected_busy,
+                'timeouts': self._timeouts,
+                'wait_ms_p50': round(_percentile(waits, 50) * 1000, 2),
+                'wait_ms_p99': round(_percentile(waits, 99) * 1000, 2),
+                'wait_ms_max': round(waits[-1] * 1000, 2) if waits else 0.0,
+            }
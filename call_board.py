@@ -0,0 +1,156 @@
+"""
+候诊区叫号屏的进程内队列：按科室保存当天每位医生的候诊挂号，
+据此给出“正在叫号/就诊中”与“下一位”。
+
+每个科室当天第一次有叫号屏打开时查一次数据库装载，之后只由
+queue_events.notify() 在挂号/退号/叫号/接诊/完成问诊提交后增量更新，
+叫号屏的读取与推送不再访问数据库；跨天后自动重新装载。
+"""
+import threading
+from datetime import date
+
+# 每位医生显示的“下一位”人数
+NEXT_UP = 3
+
+_LOAD_SQL = """
+    SELECT r.reg_id, r.dept_id, r.doctor_id, d.name AS doctor_name, p.name AS patient_name,
+           r.visit_status, r.queue_num, r.visit_date, r.time_slot, r.called_time
+    FROM registration r
+             JOIN patient p ON r.patient_id = p.patient_id
+             JOIN doctor d ON r.doctor_id = d.doctor_id
+    WHERE r.dept_id = %s
+      AND r.visit_date = %s
+      AND r.visit_status IN ('未就诊', '就诊中')
+"""
+
+
+def mask_name(name):
+    """公共屏幕上只显示姓名首尾字：张三 -> 张*，欧阳娜娜 -> 欧**娜。"""
+    name = (name or '').strip()
+    if len(name) <= 1:
+        return name
+    if len(name) == 2:
+        return name[0] + '*'
+    return name[0] + '*' * (len(name) - 2) + name[-1]
+
+
+class _Entry:
+    __slots__ = ('reg_id', 'doctor_id', 'patient_name', 'visit_status', 'queue_num', 'time_slot', 'called_time')
+
+    def __init__(self, row):
+        self.reg_id = row['reg_id']
+        self.doctor_id = row['doctor_id']
+        self.patient_name = mask_name(row['patient_name'])
+        self.visit_status = row['visit_status']
+        self.queue_num = row['queue_num'] or 0
+        self.time_slot = row['time_slot'] or ''
+        self.called_time = row['called_time']
+
+    def as_dict(self):
+        return {
+            'reg_id': self.reg_id,
+            'patient_name': self.patient_name,
+            'queue_num': self.queue_num,
+            'time_slot': self.time_slot,
+            'status': self.visit_status,
+            'called_time': self.called_time.strftime('%H:%M:%S') if self.called_time else None,
+        }
+
+
+class _Department:
+    def __init__(self):
+        self.doctor_names = {}
+        # {doctor_id: {reg_id: _Entry}}
+        self.entries = {}
+
+    def apply(self, row):
+        for entries in self.entries.values():
+            entries.pop(row['reg_id'], None)
+        if row['visit_status'] in ('未就诊', '就诊中'):
+            self.doctor_names[row['doctor_id']] = row['doctor_name']
+            self.entries.setdefault(row['doctor_id'], {})[row['reg_id']] = _Entry(row)
+
+    def view(self):
+        doctors = []
+        for doctor_id, entries in self.entries.items():
+            current = None
+            consulting = [e for e in entries.values() if e.visit_status == '就诊中']
+            called = [e for e in entries.values() if e.visit_status == '未就诊' and e.called_time]
+            if consulting:
+                current = consulting[0]
+            elif called:
+                current = max(called, key=lambda e: e.called_time)
+            waiting = sorted(
+                (e for e in entries.values() if e.visit_status == '未就诊' and e is not current),
+                key=lambda e: (e.time_slot, e.queue_num),
+            )
+            doctors.append({
+                'doctor_id': doctor_id,
+                'doctor_name': self.doctor_names.get(doctor_id, ''),
+                'current': current.as_dict() if current else None,
+                'next': [e.as_dict() for e in waiting[:NEXT_UP]],
+                'waiting': len(waiting),
+            })
+        doctors.sort(key=lambda d: d['doctor_name'])
+        return doctors
+
+
+class CallBoard:
+    """按科室缓存当天候诊队列；只有已装载（有叫号屏打开过）的科室才接收增量更新。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day = date.today()
+        self._departments = {}
+
+    def _roll_day(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._departments = {}
+
+    def has_departments(self):
+        with self._lock:
+            return bool(self._departments)
+
+    def cached_view(self, dept_id):
+        """科室已装载时返回叫号屏数据，否则返回 None（不访问数据库）。"""
+        with self._lock:
+            self._roll_day()
+            dept = self._departments.get(dept_id)
+            return dept.view() if dept is not None else None
+
+    def view(self, conn, dept_id):
+        """返回科室叫号屏数据；本进程当天首次访问该科室时装载一次。"""
+        doctors = self.cached_view(dept_id)
+        if doctors is not None:
+            return doctors
+        day = self._day
+        with conn.cursor() as cursor:
+            cursor.execute(_LOAD_SQL, (dept_id, day))
+            rows = cursor.fetchall()
+        with self._lock:
+            self._roll_day()
+            dept = self._departments.get(dept_id)
+            if dept is None and day == self._day:
+                dept = self._departments[dept_id] = _Department()
+                for row in rows:
+                    dept.apply(row)
+            if dept is None:
+                loaded = _Department()
+                for row in rows:
+                    loaded.apply(row)
+                return loaded.view()
+            return dept.view()
+
+    def apply(self, row):
+        """
+        应用一行挂号的最新状态；返回变化后的科室视图，科室未装载或非当天挂号时返回 None。
+        """
+        with self._lock:
+            self._roll_day()
+            dept = self._departments.get(row['dept_id'])
+            if dept is None or row['visit_date'] != self._day:
+                return None
+            dept.apply(row)
+            return dept.view()
@@ -1,328 +1,362 @@
+import threading
+from contextlib import contextmanager
+
 import pymysql
 from datetime import datetime
 
+from db_pool import ConnectionPool
+from schema_catalog import SchemaCatalog
+from record_no import MedicalRecordNoGenerator
+from ref_cache import ReferenceDataCache
+from medicine_catalog import MedicineCatalog
+from medicine_search import PrescribingFrequency
+from availability import AvailabilityCache
+from booking_gate import BookingGate, SlotFull
+from audit_log import AuditWriter, write_entries
+import medicine_catalog
+import billing
+import queue_events
+import stats_rollup
+
 DB_NAME = 'clinic_system'
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',
+    'password': '123456',  # 请根据实际密码修改
+    'database': DB_NAME,
+    'charset': 'utf8mb4',
+    'cursorclass': pymysql.cursors.DictCursor,
+}
+# 连接池参数：常驻/最大连接数、借连接超时（秒）、连接最长存活（秒）
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+POOL_TIMEOUT = 10
+POOL_MAX_LIFETIME = 1800
+# 版本落后时由 Web 进程自动迁移（多 worker 间通过 MySQL 咨询锁保证只有一个执行）
+AUTO_MIGRATE = True
+AUTO_MIGRATE_WAIT = 10
+# 病历号每次向数据库预留的序号个数（1 表示每个病历号都单独取号）
+MR_BLOCK_SIZE = 10
+# 药品联想中“医生常用药”频次的缓存时间（秒）
+PRESCRIBING_FREQUENCY_TTL = 300
+# 科室/医生参考数据缓存的有效期（秒）；本进程内的修改会立即失效缓存
+REF_CACHE_TTL = 60
+# 号源余量查询的缓存时间（秒）；本进程内挂号/退号/排班修改提交后按日期立即失效
+AVAILABILITY_TTL = 5
+# 预约准入：同一号源最多排队的请求数、排队最长等待（秒）、号源满标记的有效期（秒）
+BOOKING_GATE_MAX_WAITING = 50
+BOOKING_GATE_WAIT_TIMEOUT = 3
+BOOKING_FULL_TTL = 5
+# 操作日志异步写入：内存队列上限（条）、每批写入条数、攒批间隔（秒）、超过多少秒计为延迟；
+# AUDIT_ASYNC = False 时全部在调用方事务内同步写入
+AUDIT_ASYNC = True
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 1.0
+AUDIT_DELAY_WARN = 5
+
 DEFAULT_ADMIN_NAME = '管理员'
 DEFAULT_ADMIN_PHONE = 'admin'
 DEFAULT_ADMIN_PASSWORD = '123456'
 _SCHEMA_READY = False
+_SCHEMA_LOCK = threading.Lock()
+
+
+def _connect():
+    return pymysql.connect(**DB_CONFIG)
+
+
+_POOL = ConnectionPool(
+    _connect,
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    timeout=POOL_TIMEOUT,
+    max_lifetime=POOL_MAX_LIFETIME,
+)
 
 
 def get_db_connection():
-    conn = pymysql.connect(
-        host='localhost',
-        user='root',
-        password='123456',  # 请根据实际密码修改
-        database=DB_NAME,
-        charset='utf8mb4',
-        cursorclass=pymysql.cursors.DictCursor
-    )
+    """
+    从连接池借出连接；调用方照常 conn.close()，连接会回滚后归还连接池。
+    """
+    conn = _POOL.acquire()
     ensure_schema(conn)
     return conn
 
 
+def get_pool_stats():
+    """
+    连接池运行时统计：使用中/空闲连接数、等待次数与等待耗时等。
+    """
+    return _POOL.stats()
+
+
+_CATALOG = SchemaCatalog(DB_NAME)
+
+
 def table_exists(conn, table_name):
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            SELECT 1 FROM information_schema.tables
-            WHERE table_schema=%s AND table_name=%s
-            LIMIT 1
-        """, (DB_NAME, table_name))
-        return cursor.fetchone() is not None
+    return _CATALOG.table_exists(conn, table_name)
 
 
 def column_exists(conn, table_name, column_name):
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            SELECT 1 FROM information_schema.columns
-            WHERE table_schema=%s AND table_name=%s AND column_name=%s
-            LIMIT 1
-        """, (DB_NAME, table_name, column_name))
-        return cursor.fetchone() is not None
+    return _CATALOG.column_exists(conn, table_name, column_name)
+
+
+def get_table_columns(conn, table_name):
+    """
+    返回表的列名集合（来自进程内表结构目录，不访问 information_schema）。
+    """
+    return _CATALOG.columns(conn, table_name)
 
 
 def get_schedule_date_column(conn):
-    if column_exists(conn, 'doctor_schedule', 'schedule_date'):
-        return 'schedule_date'
-    if column_exists(conn, 'doctor_schedule', 'work_date'):
-        return 'work_date'
-    return 'schedule_date'
+    return _CATALOG.schedule_date_column(conn)
+
+
+def invalidate_schema_catalog():
+    """
+    执行 DDL（建表/加列）后调用，下次查询时重新加载表结构目录。
+    """
+    _CATALOG.invalidate()
+
+
+@contextmanager
+def transaction(conn):
+    """
+    事务上下文（Unit of Work）：一次业务操作只提交一次。
+    可以嵌套使用，只有最外层在正常结束时 commit、异常时 rollback 并继续抛出；
+    内层（如 create_registration_record、update_schedule_booked 等 helper）只负责执行 SQL。
+
+        with transaction(conn):
+            ...
+            update_schedule_booked(conn, schedule_id, -1)
+            log_operation(conn, ...)
+    """
+    depth = getattr(conn, 'tx_depth', 0)
+    conn.tx_depth = depth + 1
+    if depth == 0:
+        conn.after_commit_callbacks = []
+    try:
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except Exception:
+        if depth == 0:
+            conn.rollback()
+            conn.after_commit_callbacks = []
+        raise
+    finally:
+        conn.tx_depth = depth
+    if depth == 0:
+        _run_after_commit(conn)
+
+
+def after_commit(conn, callback):
+    """
+    登记在最外层事务提交成功后执行的回调（如推送队列变化）；事务回滚时丢弃。
+    不在事务中调用时立即执行。
+    """
+    if getattr(conn, 'tx_depth', 0) == 0:
+        callback()
+    else:
+        conn.after_commit_callbacks.append(callback)
+
+
+def _run_after_commit(conn):
+    callbacks, conn.after_commit_callbacks = conn.after_commit_callbacks, []
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            # 数据已提交，提交后的通知失败不影响业务结果
+            print(f"[after_commit] 回调失败: {e}")
 
 
 def ensure_schema(conn):
     """
-    兜底创建/补充挂号所需的表字段，避免列缺失导致运行错误。
+    启动时的表结构版本检查：每个进程只读一次 schema_version。
+    建表/补字段/数据回填由 migrations.py 中的迁移步骤负责；
+    开启 AUTO_MIGRATE 时，版本落后由抢到 MySQL 咨询锁的那个进程执行迁移，
+    其它进程短暂等待后直接复用结果，否则需单独执行：
+        python migrations.py
     """
     global _SCHEMA_READY
     if _SCHEMA_READY:
         return
-    try:
-        with conn.cursor() as cursor:
-            if not table_exists(conn, 'doctor_schedule'):
-                cursor.execute("""
-                    CREATE TABLE doctor_schedule (
-                        schedule_id INT AUTO_INCREMENT PRIMARY KEY,
-                        doctor_id INT NOT NULL,
-                        schedule_date DATE NOT NULL,
-                        shift VARCHAR(10) NOT NULL,
-                        time_slot VARCHAR(20) NOT NULL DEFAULT '09:00-10:00',
-                        max_slots INT NOT NULL DEFAULT 20,
-                        booked_slots INT NOT NULL DEFAULT 0,
-                        status VARCHAR(10) NOT NULL DEFAULT '可用',
-                        UNIQUE KEY uniq_doctor_date_slot (doctor_id, schedule_date, time_slot),
-                        KEY idx_doctor_date_slot (doctor_id, schedule_date, time_slot)
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-            else:
-                # 针对已有表补全缺失列
-                if not column_exists(conn, 'doctor_schedule', 'schedule_date'):
-                    # 避免在部分 MySQL 版本上使用函数作为默认值导致失败
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN schedule_date DATE NULL;")
-                if not column_exists(conn, 'doctor_schedule', 'shift'):
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN shift VARCHAR(10) NOT NULL DEFAULT '上午';")
-                if not column_exists(conn, 'doctor_schedule', 'time_slot'):
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN time_slot VARCHAR(20) NOT NULL DEFAULT '09:00-10:00' AFTER shift;")
-                if not column_exists(conn, 'doctor_schedule', 'max_slots'):
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN max_slots INT NOT NULL DEFAULT 20;")
-                if not column_exists(conn, 'doctor_schedule', 'booked_slots'):
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN booked_slots INT NOT NULL DEFAULT 0;")
-                if not column_exists(conn, 'doctor_schedule', 'status'):
-                    cursor.execute("ALTER TABLE doctor_schedule ADD COLUMN status VARCHAR(10) NOT NULL DEFAULT '可用';")
-                # 调整唯一索引，支持同一医生同一天多个时间段
-                cursor.execute("SHOW INDEX FROM doctor_schedule WHERE Key_name='uniq_doctor_date_shift'")
-                if cursor.fetchone():
-                    try:
-                        cursor.execute("ALTER TABLE doctor_schedule DROP INDEX uniq_doctor_date_shift")
-                    except Exception:
-                        pass
-                cursor.execute("SHOW INDEX FROM doctor_schedule WHERE Key_name='uniq_doctor_date_slot'")
-                if not cursor.fetchone():
-                    try:
-                        cursor.execute(
-                            "ALTER TABLE doctor_schedule ADD UNIQUE KEY uniq_doctor_date_slot (doctor_id, schedule_date, time_slot)"
-                        )
-                    except Exception:
-                        pass
-                if column_exists(conn, 'doctor_schedule', 'work_date') and column_exists(conn, 'doctor_schedule', 'schedule_date'):
-                    cursor.execute("""
-                        UPDATE doctor_schedule
-                        SET schedule_date = work_date
-                        WHERE schedule_date IS NULL AND work_date IS NOT NULL
-                    """)
-
-            # 确保 prescription 表存在（药房发药/收费依赖）
-            if not table_exists(conn, 'prescription'):
-                cursor.execute("""
-                    CREATE TABLE prescription (
-                        presc_id INT AUTO_INCREMENT PRIMARY KEY,
-                        reg_id INT NOT NULL,
-                        med_id INT NOT NULL,
-                        dosage VARCHAR(50) NULL,
-                        med_usage VARCHAR(255) NULL,
-                        total_quantity INT NOT NULL DEFAULT 0,
-                        total_amount DECIMAL(10,2) NOT NULL DEFAULT 0,
-                        dispense_status VARCHAR(20) NOT NULL DEFAULT '未发药',
-                        dispense_time DATETIME NULL,
-                        KEY idx_reg (reg_id),
-                        KEY idx_med (med_id)
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-            if not column_exists(conn, 'registration', 'visit_date'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN visit_date DATE NULL AFTER reg_time;")
-            if not column_exists(conn, 'registration', 'shift'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN shift VARCHAR(10) NOT NULL DEFAULT '全天' AFTER visit_date;")
-            if not column_exists(conn, 'registration', 'time_slot'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN time_slot VARCHAR(20) NOT NULL DEFAULT '09:00-10:00' AFTER shift;")
-            if not column_exists(conn, 'registration', 'fee_status'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN fee_status VARCHAR(20) NOT NULL DEFAULT '未支付' AFTER reg_fee;")
-            if not column_exists(conn, 'registration', 'schedule_id'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN schedule_id INT NULL AFTER shift;")
-            if not column_exists(conn, 'patient', 'medical_record_no'):
-                cursor.execute("ALTER TABLE patient ADD COLUMN medical_record_no VARCHAR(32) NULL AFTER age;")
-            if not column_exists(conn, 'patient', 'past_illness'):
-                cursor.execute("ALTER TABLE patient ADD COLUMN past_illness VARCHAR(255) NULL AFTER allergy;")
-            if not column_exists(conn, 'registration', 'check_fee'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN check_fee DECIMAL(10,2) NOT NULL DEFAULT 0 AFTER reg_fee;")
-            if not column_exists(conn, 'registration', 'paid_time'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN paid_time DATETIME NULL AFTER fee_status;")
-            if not column_exists(conn, 'prescription', 'dispense_status'):
-                cursor.execute("ALTER TABLE prescription ADD COLUMN dispense_status VARCHAR(20) NOT NULL DEFAULT '未发药';")
-            if not column_exists(conn, 'prescription', 'dispense_time'):
-                cursor.execute("ALTER TABLE prescription ADD COLUMN dispense_time DATETIME NULL;")
-            # 医生叫号记录
-            if not column_exists(conn, 'registration', 'called_time'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN called_time DATETIME NULL;")
-            if not column_exists(conn, 'registration', 'call_times'):
-                cursor.execute("ALTER TABLE registration ADD COLUMN call_times INT NOT NULL DEFAULT 0;")
-
-            # ===== 数据回填：避免页面出现 None =====
-            # 1) 病历号为空的患者：用 patient_id 生成稳定且唯一的病历号
-            if column_exists(conn, 'patient', 'medical_record_no'):
-                cursor.execute("""
-                    UPDATE patient
-                    SET medical_record_no = CONCAT('MR', LPAD(patient_id, 8, '0'))
-                    WHERE medical_record_no IS NULL OR medical_record_no = ''
-                """)
-
-            # 2) 就诊日期为空的挂号：默认使用 reg_time 的日期
-            if column_exists(conn, 'registration', 'visit_date'):
-                cursor.execute("""
-                    UPDATE registration
-                    SET visit_date = DATE(reg_time)
-                    WHERE visit_date IS NULL AND reg_time IS NOT NULL
-                """)
-            # 3) 班次为空：给默认值，避免展示 None
-            if column_exists(conn, 'registration', 'shift'):
-                cursor.execute("""
-                    UPDATE registration
-                    SET shift = '全天'
-                    WHERE shift IS NULL OR shift = ''
-                """)
-            # 3.1) 时间段为空：给默认值
-            if column_exists(conn, 'registration', 'time_slot'):
-                cursor.execute("""
-                    UPDATE registration
-                    SET time_slot = '09:00-10:00'
-                    WHERE time_slot IS NULL OR time_slot = ''
-                """)
-
-            # 4) 排班日期为空：给默认值，避免列表展示 None
-            if column_exists(conn, 'doctor_schedule', 'schedule_date'):
-                cursor.execute("""
-                    UPDATE doctor_schedule
-                    SET schedule_date = CURDATE()
-                    WHERE schedule_date IS NULL
-                """)
-            if column_exists(conn, 'doctor_schedule', 'time_slot'):
-                cursor.execute("""
-                    UPDATE doctor_schedule
-                    SET time_slot = '09:00-10:00'
-                    WHERE time_slot IS NULL OR time_slot = ''
-                """)
-
-            # 管理员账号：单独表，避免依赖 doctor/department 结构
-            if not table_exists(conn, 'admin_user'):
-                cursor.execute("""
-                    CREATE TABLE admin_user (
-                        admin_id INT AUTO_INCREMENT PRIMARY KEY,
-                        name VARCHAR(50) NOT NULL,
-                        phone VARCHAR(32) NOT NULL UNIQUE,
-                        password VARCHAR(64) NOT NULL
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-
-            # 操作日志表
-            if not table_exists(conn, 'operation_log'):
-                cursor.execute("""
-                    CREATE TABLE operation_log (
-                        log_id INT AUTO_INCREMENT PRIMARY KEY,
-                        operator_id INT NOT NULL,
-                        operator_name VARCHAR(50) NULL,
-                        operator_role VARCHAR(20) NULL,
-                        operation_type VARCHAR(50) NOT NULL,
-                        target_id INT NULL,
-                        detail TEXT NULL,
-                        create_time DATETIME DEFAULT CURRENT_TIMESTAMP
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-
-            # 确保默认管理员账号存在
-            cursor.execute("SELECT 1 FROM admin_user WHERE phone=%s LIMIT 1", (DEFAULT_ADMIN_PHONE,))
-            if not cursor.fetchone():
-                cursor.execute(
-                    "INSERT INTO admin_user (name, phone, password) VALUES (%s, %s, %s)",
-                    (DEFAULT_ADMIN_NAME, DEFAULT_ADMIN_PHONE, DEFAULT_ADMIN_PASSWORD)
-                )
-
-            # ===== 医生数据重置与重新生成逻辑 =====
-            # 我们通过一个特殊的逻辑确保只在需要时执行重置
-            # 检查是否已经执行过本次重置（可选，但为了响应您的指令，我们直接执行一次性覆盖）
-            
-            print("[Init] 正在执行医生数据重置...")
-            cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
-            cursor.execute("TRUNCATE TABLE registration;")
-            cursor.execute("TRUNCATE TABLE doctor_schedule;")
-            cursor.execute("TRUNCATE TABLE medical_record;")
-            cursor.execute("TRUNCATE TABLE prescription;")
-            cursor.execute("DELETE FROM doctor;") # 清空所有医生
-            cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
-
-            # 确保科室存在
-            depts = ['内科', '外科', '儿科']
-            for dname in depts:
-                cursor.execute("SELECT 1 FROM department WHERE dept_name=%s", (dname,))
-                if not cursor.fetchone():
-                    cursor.execute("INSERT INTO department (dept_name) VALUES (%s)", (dname,))
-            
-            cursor.execute("SELECT dept_id, dept_name FROM department")
-            dept_map = {row['dept_name']: row['dept_id'] for row in cursor.fetchall()}
-            
-            # 重新生成的医生名单 (2-3名/科室)
-            regenerated_doctors = [
-                # 内科
-                ('张宏', '主任医师', 50.00, '内科', '13800000001', '123456'),
-                ('陈静', '副主任医师', 30.00, '内科', '13800000002', '123456'),
-                ('刘志强', '主治医师', 20.00, '内科', '13800000006', '123456'),
-                # 外科
-                ('李芳', '主任医师', 50.00, '外科', '13800000003', '123456'),
-                ('孙勇', '副主任医师', 30.00, '外科', '13800000004', '123456'),
-                ('赵铁柱', '主治医师', 25.00, '外科', '13800000007', '123456'),
-                # 儿科
-                ('王强', '主任医师', 50.00, '儿科', '13800000005', '123456'),
-                ('林妙妙', '副主任医师', 30.00, '儿科', '13800000008', '123456')
-            ]
-            
-            for d_name, d_title, d_fee, d_dept_name, d_phone, d_pwd in regenerated_doctors:
-                target_dept_id = dept_map.get(d_dept_name)
-                if target_dept_id:
-                    cursor.execute("""
-                        INSERT INTO doctor (name, title, reg_fee, dept_id, phone, password, status)
-                        VALUES (%s, %s, %s, %s, %s, %s, '正常')
-                    """, (d_name, d_title, d_fee, target_dept_id, d_phone, d_pwd))
-            
-            print(f"[Init] 医生重置完成，共录入 {len(regenerated_doctors)} 名医生。")
+    from migrations import current_version, latest_version, migrate_with_lock
+    with _SCHEMA_LOCK:
+        if _SCHEMA_READY:
+            return
+        try:
+            current = current_version(conn)
+            latest = latest_version()
+            if current < latest:
+                if AUTO_MIGRATE:
+                    result = migrate_with_lock(conn, AUTO_MIGRATE_WAIT)
+                    if result == 'timeout':
+                        # 不标记完成，下一个请求再检查一次
+                        print("[schema] 等待其它进程完成迁移超时，本次请求跳过初始化")
+                        return
+                    if result == 'migrated':
+                        print(f"[schema] 已由本进程迁移至版本 {latest}")
+                else:
+                    print(f"[schema] 数据库版本 {current} 落后于代码版本 {latest}，请先执行 python migrations.py")
+            _SCHEMA_READY = True
+        except Exception as e:
+            # 记录但不中断主流程
+            print(f"[schema] version check failed: {e}")
+
+
+# 号段申请使用生成器自己的连接：调用方通常已持有一条池连接，不再从连接池借第二条
+_MR_GENERATOR = MedicalRecordNoGenerator(_connect, block_size=MR_BLOCK_SIZE)
+
+
+def generate_medical_record_no():
+    """
+    生成唯一的病历号：MR + yyyyMMdd + 当日序号（按日计数行 + 进程内号段缓存，不扫描 patient 表）
+    """
+    return _MR_GENERATOR.next_no()
 
-        conn.commit()
 
-        conn.commit()
-        _SCHEMA_READY = True
-    except Exception as e:
-        # 记录但不中断主流程
-        print(f"[schema] ensure failed: {e}")
+_REF_CACHE = ReferenceDataCache(ttl=REF_CACHE_TTL)
 
 
-def generate_medical_record_no(conn):
+def get_reference_data(conn):
     """
-    生成唯一的病历号：MR + yyyyMMdd + 自增编号
+    科室/医生参考数据快照（只读）：departments、doctors（在岗）、all_doctors、
+    doctors_by_dept、dept_doctor_counts、doctor_by_id。
     """
-    today_str = datetime.now().strftime('%Y%m%d')
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT IFNULL(MAX(patient_id),0) AS max_id FROM patient")
-        max_id = cursor.fetchone()['max_id'] + 1
-    return f"MR{today_str}{str(max_id).zfill(4)}"
+    return _REF_CACHE.get(conn)
+
+
+def invalidate_reference_data():
+    """
+    新增/修改 doctor 或 department 后调用，下次读取时重新加载参考数据。
+    """
+    _REF_CACHE.invalidate()
+
+
+_MEDICINE_CATALOG = MedicineCatalog()
+
+
+def get_medicines(conn, in_stock_only=False, descending=False):
+    """
+    药品目录（来自进程内版本化快照）：[{med_id, med_name, price, stock}]，按 med_id 排序。
+    药品增删改、发药时须在同一事务内调用 medicine_catalog.mark_changed / mark_structure_changed。
+    """
+    return _MEDICINE_CATALOG.rows(conn, in_stock_only=in_stock_only, descending=descending)
+
+
+_PRESCRIBING_FREQUENCY = PrescribingFrequency(ttl=PRESCRIBING_FREQUENCY_TTL)
+
+
+def search_medicines(conn, query, doctor_id=None, limit=10):
+    """
+    药品输入联想：按药名字符、全拼、拼音首字母前缀匹配有库存的药品，
+    指定 doctor_id 时该医生开得多的药排在前面。
+    """
+    frequency = _PRESCRIBING_FREQUENCY.get(conn, doctor_id) if doctor_id else None
+    return _MEDICINE_CATALOG.search(conn, query, frequency=frequency, limit=limit)
+
+
+def invalidate_prescribing_frequency(doctor_id):
+    _PRESCRIBING_FREQUENCY.invalidate(doctor_id)
+
+
+_AVAILABILITY = AvailabilityCache(ttl=AVAILABILITY_TTL)
+
+
+def get_availability(conn, doctor_ids, start, end, time_slots, shift_of):
+    """
+    医生 × 日期 × 时间段 的剩余号数（见 availability.load_availability），短时缓存。
+    """
+    return _AVAILABILITY.get(conn, get_schedule_date_column(conn), doctor_ids, start, end, time_slots, shift_of)
+
+
+def invalidate_availability(conn, visit_date=None):
+    """
+    号源变化（挂号/退号/恢复/排班修改）后调用：事务提交后失效覆盖 visit_date 的余量缓存；
+    不传日期时全部失效。
+    """
+    if isinstance(visit_date, str):
+        try:
+            visit_date = datetime.strptime(visit_date, '%Y-%m-%d').date()
+        except ValueError:
+            visit_date = None
+    after_commit(conn, lambda: _AVAILABILITY.invalidate(visit_date))
+
+
+_BOOKING_GATE = BookingGate(
+    max_waiting=BOOKING_GATE_MAX_WAITING,
+    wait_timeout=BOOKING_GATE_WAIT_TIMEOUT,
+    full_ttl=BOOKING_FULL_TTL,
+)
+
+
+def _booking_key(doctor_id, visit_date, time_slot):
+    return int(doctor_id), str(visit_date), time_slot
+
+
+def admit_booking(doctor_id, visit_date, time_slot):
+    """
+    预约准入（见 booking_gate）：同一号源的预约在本进程内排队逐个执行，
+    号源已满抛 SlotFull，排队过长/超时抛 RetryLater。须在借数据库连接之前进入：
+
+        with admit_booking(doctor_id, visit_date, time_slot):
+            conn = get_db_connection()
+            ...
+    """
+    return _BOOKING_GATE.admit(_booking_key(doctor_id, visit_date, time_slot))
+
+
+def reopen_booking(conn, doctor_id=None, visit_date=None, time_slot=None):
+    """
+    释放号源（退号、排班修改）后调用：事务提交后解除该号源的号源满标记；不传号源时全部解除。
+    挂号成功不调用，已满号源在高峰期保持快速拒绝。
+    """
+    key = None if doctor_id is None else _booking_key(doctor_id, visit_date, time_slot)
+    after_commit(conn, lambda: _BOOKING_GATE.reopen(key))
+
+
+def get_booking_gate_stats():
+    """预约准入运行时统计：排队数、拒绝次数、排队等待耗时等。"""
+    return _BOOKING_GATE.stats()
+
+
+def publish_queue_change(conn, reg_id, kind):
+    """
+    挂号候诊状态变化后调用：事务提交后把该行推送给订阅了对应医生工作台的连接（见 queue_events）。
+    """
+    after_commit(conn, lambda: queue_events.notify(conn, reg_id, kind))
 
 
 def fetch_departments_and_doctors(conn):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT dept_id, dept_name FROM department ORDER BY dept_name")
-        departments = cursor.fetchall()
+    ref = get_reference_data(conn)
+    return ref['departments'], ref['doctors']
+
 
+def allocate_queue_num(conn, doctor_id, visit_date, shift, time_slot):
+    """
+    从 queue_sequence 计数行分配排队号（医生 + 日期 + 班次 + 时间段）。
+    单条 upsert 完成“加一并取值”，行锁持有到事务提交，回滚时号码一并回退，
+    因此并发预约拿到的号码唯一且连续，耗时与已有挂号数量无关。
+    """
+    with conn.cursor() as cursor:
         cursor.execute("""
-            SELECT d.doctor_id, d.name, d.title, d.reg_fee, d.dept_id, dept.dept_name
-            FROM doctor d
-                     JOIN department dept ON d.dept_id = dept.dept_id
-            WHERE d.status = '正常'
-            ORDER BY dept.dept_name, d.name
-        """)
-        doctors = cursor.fetchall()
-    return departments, doctors
+            INSERT INTO queue_sequence (doctor_id, visit_date, shift, time_slot, last_num)
+            VALUES (%s, %s, %s, %s, LAST_INSERT_ID(1))
+            ON DUPLICATE KEY UPDATE last_num = LAST_INSERT_ID(last_num + 1)
+        """, (doctor_id, visit_date, shift, time_slot))
+        return cursor.lastrowid
 
 
 def create_registration_record(conn, patient_id, doctor_id, dept_id, visit_date, shift, time_slot, fee_status='未支付'):
     """
     创建挂号记录，校验排班与号源，返回排队号。
     """
-    with conn.cursor() as cursor:
+    # 未指定就诊日期按当天处理（与历史数据按 reg_time 回填就诊日期的规则一致）
+    visit_date = visit_date or datetime.now().strftime('%Y-%m-%d')
+    with transaction(conn), conn.cursor() as cursor:
         cursor.execute("SELECT reg_fee FROM doctor WHERE doctor_id=%s", (doctor_id,))
         doc = cursor.fetchone()
         if not doc:
@@ -350,16 +384,17 @@ def create_registration_record(conn, patient_id, doctor_id, dept_id, visit_date,
         if schedule:
             if schedule['status'] == '停诊':
                 raise ValueError("该医生本时段停诊")
-            if schedule['booked_slots'] >= schedule['max_slots']:
-                raise ValueError("该班次号源已满")
-
-        cursor.execute("""
-            SELECT COUNT(*) AS cnt
-            FROM registration
-            WHERE doctor_id=%s AND visit_date=%s AND shift=%s AND time_slot=%s AND visit_status != '已取消'
-        """, (doctor_id, visit_date, shift, time_slot))
-        count_res = cursor.fetchone()
-        new_queue_num = count_res['cnt'] + 1
+            # 条件更新占用号源：并发预约在排班行上串行化，不会超过 max_slots
+            cursor.execute("""
+                UPDATE doctor_schedule
+                SET booked_slots = booked_slots + 1
+                WHERE schedule_id=%s AND booked_slots < max_slots
+            """, (schedule['schedule_id'],))
+            if cursor.rowcount != 1:
+                _BOOKING_GATE.mark_full(_booking_key(doctor_id, visit_date, time_slot))
+                raise SlotFull("该班次号源已满")
+
+        new_queue_num = allocate_queue_num(conn, doctor_id, visit_date, shift, time_slot)
 
         cursor.execute("""
             INSERT INTO registration (patient_id, doctor_id, dept_id, reg_fee, visit_status, queue_num, reg_time,
@@ -367,36 +402,256 @@ def create_registration_record(conn, patient_id, doctor_id, dept_id, visit_date,
             VALUES (%s, %s, %s, %s, '未就诊', %s, NOW(), %s, %s, %s, %s, %s)
         """, (patient_id, doctor_id, dept_id, doc['reg_fee'], new_queue_num, visit_date, shift, time_slot, fee_status,
               schedule['schedule_id'] if schedule else None))
+        reg_id = cursor.lastrowid
+        billing.open_ledger(conn, [reg_id])
+        stats_rollup.add_registrations(conn, [reg_id])
+        publish_queue_change(conn, reg_id, 'booked')
+        invalidate_availability(conn, visit_date)
+        return new_queue_num
 
-        if schedule:
-            cursor.execute(
-                "UPDATE doctor_schedule SET booked_slots = booked_slots + 1 WHERE schedule_id=%s",
-                (schedule['schedule_id'],)
-            )
 
-        conn.commit()
-        return new_queue_num
+def save_consultation(conn, reg_id, doctor_id, main_complaint, diagnosis, items):
+    """
+    提交诊疗：病历 + 处方 + 就诊状态在同一事务内完成，往返次数与处方行数无关：
+    1) 条件更新挂号状态（就诊中 -> 已就诊），同时校验归属并锁定挂号行，防止重复提交
+    2) 一次 IN 查询取出全部药品的价格与库存（共享锁，校验期间库存不被并发改小）
+    3) 写病历；4) executemany 一次性写入全部处方行
+    items 为 [(med_id, quantity, usage), ...]，校验失败抛 ValueError。
+    """
+    with transaction(conn), stats_rollup.track_registrations(conn, [reg_id]), conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE registration SET visit_status = '已就诊'
+            WHERE reg_id = %s AND doctor_id = %s AND visit_status = '就诊中'
+        """, (reg_id, doctor_id))
+        if cursor.rowcount != 1:
+            raise ValueError("当前挂号不在可问诊状态")
+
+        medicines = {}
+        med_ids = sorted({med_id for med_id, _, _ in items})
+        if med_ids:
+            placeholders = ', '.join(['%s'] * len(med_ids))
+            cursor.execute(f"""
+                SELECT med_id, med_name, price, stock
+                FROM medicine
+                WHERE med_id IN ({placeholders})
+                LOCK IN SHARE MODE
+            """, med_ids)
+            medicines = {row['med_id']: row for row in cursor.fetchall()}
+
+        need = {}
+        for med_id, quantity, _ in items:
+            if med_id not in medicines:
+                raise ValueError("处方包含不存在的药品")
+            need[med_id] = need.get(med_id, 0) + quantity
+        for med_id, qty_need in need.items():
+            m = medicines[med_id]
+            if int(m['stock']) < qty_need:
+                raise ValueError(f"库存不足：{m['med_name']}（库存{m['stock']}），请调整数量")
 
+        cursor.execute("""
+            INSERT INTO medical_record (reg_id, doctor_id, main_complaint, diagnosis, create_time)
+            VALUES (%s, %s, %s, %s, NOW())
+        """, (reg_id, doctor_id, main_complaint, diagnosis))
+
+        if items:
+            rows = [
+                (reg_id, med_id, usage, quantity, medicines[med_id]['price'] * quantity)
+                for med_id, quantity, usage in items
+            ]
+            cursor.executemany("""
+                INSERT INTO prescription (reg_id, med_id, dosage, med_usage, total_quantity, total_amount)
+                VALUES (%s, %s, '标准剂量', %s, %s, %s)
+            """, rows)
+            billing.add_medicine_fee(conn, reg_id, sum(row[4] for row in rows))
+        publish_queue_change(conn, reg_id, 'consult_finished')
 
-def update_schedule_booked(conn, schedule_id, delta):
+
+def dispense_registrations(conn, reg_ids):
+    """
+    整单/多单发药：一个事务内为若干挂号的全部未发药处方行发药，返回逐行结果。
+    - 处方行按 presc_id、药品行按 med_id 顺序加锁，多个药房终端并发时加锁顺序一致，避免死锁
+    - 同一药品的需求量合并后校验库存，库存不足的药品整体跳过，其余照常发药
+    - 库存用一条集合 UPDATE 扣减；处方状态只允许 未发药 -> 已发药，影响行数不符则整单回滚
+    每行结果：{reg_id, presc_id, med_id, med_name, quantity, ok, message}
+    """
+    reg_ids = sorted({int(r) for r in reg_ids if r})
+    if not reg_ids:
+        return []
+    reg_ph = ', '.join(['%s'] * len(reg_ids))
+    results = []
+    with transaction(conn), conn.cursor() as cursor:
+        cursor.execute(f"SELECT reg_id, fee_status, visit_date FROM registration WHERE reg_id IN ({reg_ph})", reg_ids)
+        regs = {row['reg_id']: row for row in cursor.fetchall()}
+        paid = {reg_id for reg_id, row in regs.items() if row['fee_status'] == '已支付'}
+
+        cursor.execute(f"""
+            SELECT presc_id, reg_id, med_id, total_quantity, dispense_status
+            FROM prescription
+            WHERE reg_id IN ({reg_ph})
+            ORDER BY presc_id
+            FOR UPDATE
+        """, reg_ids)
+        lines = cursor.fetchall()
+        if not lines:
+            return []
+
+        med_ids = sorted({line['med_id'] for line in lines})
+        med_ph = ', '.join(['%s'] * len(med_ids))
+        cursor.execute(f"""
+            SELECT med_id, med_name, stock
+            FROM medicine
+            WHERE med_id IN ({med_ph})
+            ORDER BY med_id
+            FOR UPDATE
+        """, med_ids)
+        medicines = {row['med_id']: row for row in cursor.fetchall()}
+
+        need = {}
+        for line in lines:
+            med = medicines.get(line['med_id'])
+            result = {
+                'reg_id': line['reg_id'],
+                'presc_id': line['presc_id'],
+                'med_id': line['med_id'],
+                'med_name': med['med_name'] if med else None,
+                'quantity': line['total_quantity'],
+                'ok': False,
+                'message': '',
+            }
+            results.append(result)
+            if line['reg_id'] not in paid:
+                result['message'] = '未支付订单不可发药'
+            elif line['dispense_status'] == '已发药':
+                result['message'] = '已发药，无需重复操作'
+            elif not med:
+                result['message'] = '药品不存在'
+            elif not line['total_quantity'] or int(line['total_quantity']) <= 0:
+                result['message'] = '处方数量异常'
+            else:
+                result['ok'] = True
+                need[line['med_id']] = need.get(line['med_id'], 0) + int(line['total_quantity'])
+
+        short = {med_id for med_id, qty in need.items() if int(medicines[med_id]['stock']) < qty}
+        for result in results:
+            if result['ok'] and result['med_id'] in short:
+                result['ok'] = False
+                result['message'] = f"库存不足（库存{medicines[result['med_id']]['stock']}）"
+        for med_id in short:
+            del need[med_id]
+
+        to_dispense = [r['presc_id'] for r in results if r['ok']]
+        if not to_dispense:
+            return results
+
+        deduct_sql = ' UNION ALL '.join(['SELECT %s AS med_id, %s AS qty'] * len(need))
+        deduct_args = [v for med_id in sorted(need) for v in (med_id, need[med_id])]
+        cursor.execute(f"""
+            UPDATE medicine m
+                JOIN ({deduct_sql}) d ON m.med_id = d.med_id
+            SET m.stock = m.stock - d.qty
+        """, deduct_args)
+
+        presc_ph = ', '.join(['%s'] * len(to_dispense))
+        cursor.execute(f"""
+            UPDATE prescription
+            SET dispense_status='已发药', dispense_time=NOW()
+            WHERE presc_id IN ({presc_ph}) AND dispense_status != '已发药'
+        """, to_dispense)
+        if cursor.rowcount != len(to_dispense):
+            raise ValueError("处方状态已变化，已取消本次发药")
+        medicine_catalog.mark_changed(conn, need)
+        stats_rollup.add_dispensed(conn, [
+            (regs[r['reg_id']]['visit_date'], r['med_id'], r['quantity']) for r in results if r['ok']
+        ])
+        for result in results:
+            if result['ok']:
+                result['message'] = '发药成功'
+    return results
+
+
+def settle_registrations(conn, reg_ids=None, patient_id=None, visit_date=None):
+    """
+    批量结算：把选中的挂号（或某患者 / 某日全部）中仍为“未支付”且未取消的订单在一个事务内标记为已支付。
+    条件更新只作用于 fee_status='未支付' 的行，并校验影响行数，防止与单笔支付并发时重复收费。
+    返回 {'reg_ids': 本次结算的挂号, 'amount': 合计金额}。
+    """
+    conditions = ["r.fee_status = '未支付'", "r.visit_status != '已取消'"]
+    args = []
+    if reg_ids is not None:
+        reg_ids = sorted({int(r) for r in reg_ids if r})
+        if not reg_ids:
+            return {'reg_ids': [], 'amount': 0}
+        conditions.append(f"r.reg_id IN ({', '.join(['%s'] * len(reg_ids))})")
+        args.extend(reg_ids)
+    if patient_id is not None:
+        conditions.append("r.patient_id = %s")
+        args.append(patient_id)
+    if visit_date is not None:
+        conditions.append("r.visit_date = %s")
+        args.append(visit_date)
+    if len(conditions) == 2:
+        raise ValueError("请指定要结算的挂号范围")
+
+    with transaction(conn), conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT r.reg_id, b.total_fee
+            FROM registration r
+                     JOIN billing_ledger b ON b.reg_id = r.reg_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY r.reg_id
+            FOR UPDATE
+        """, args)
+        payable = cursor.fetchall()
+        if not payable:
+            return {'reg_ids': [], 'amount': 0}
+        ids = [row['reg_id'] for row in payable]
+        with stats_rollup.track_registrations(conn, ids):
+            cursor.execute(f"""
+                UPDATE registration
+                SET fee_status='已支付', paid_time=NOW()
+                WHERE reg_id IN ({', '.join(['%s'] * len(ids))}) AND fee_status='未支付'
+            """, ids)
+            if cursor.rowcount != len(ids):
+                raise ValueError("订单状态已变化，请刷新后重试")
+            billing.record_payment(conn, ids)
+    return {'reg_ids': ids, 'amount': sum(row['total_fee'] for row in payable)}
+
+
+def update_schedule_booked(conn, schedule_id, delta, visit_date=None):
     if not schedule_id:
         return
-    with conn.cursor() as cursor:
+    with transaction(conn), conn.cursor() as cursor:
         cursor.execute("""
             UPDATE doctor_schedule
             SET booked_slots = GREATEST(0, LEAST(max_slots, booked_slots + %s))
             WHERE schedule_id=%s
         """, (delta, schedule_id))
-    conn.commit()
+        invalidate_availability(conn, visit_date)
 
 
-def log_operation(conn, operator_id, operator_name, operator_role, op_type, target_id=None, detail=None):
+def log_operation(conn, operator_id, operator_name, operator_role, op_type, target_id=None, detail=None,
+                  durable=False):
     """
-    记录操作日志
+    记录操作日志。默认在调用方事务提交后放入异步写入队列（见 audit_log），业务回滚则不记录；
+    durable=True（或 AUDIT_ASYNC = False）时在调用方事务内同步写入，随业务操作一起提交。
     """
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            INSERT INTO operation_log (operator_id, operator_name, operator_role, operation_type, target_id, detail)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (operator_id, operator_name, operator_role, op_type, target_id, detail))
-    conn.commit()
+    entry = (operator_id, operator_name, operator_role, op_type, target_id, detail, datetime.now())
+    if durable or not AUDIT_ASYNC:
+        with transaction(conn):
+            write_entries(conn, [entry])
+        return
+    after_commit(conn, lambda: _AUDIT.submit(entry))
+
+
+_AUDIT = AuditWriter(
+    get_db_connection,
+    max_queue=AUDIT_QUEUE_SIZE,
+    batch_size=AUDIT_BATCH_SIZE,
+    flush_interval=AUDIT_FLUSH_INTERVAL,
+    delay_warn=AUDIT_DELAY_WARN,
+)
+
+
+def get_audit_stats():
+    """操作日志异步写入的运行时统计：排队、已写入、丢弃、失败、延迟条数等。"""
+    return _AUDIT.stats()
@@ -0,0 +1,228 @@
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """在 checkout 超时时间内没有可用连接。"""
+
+
+class ConnectionClosed(Exception):
+    """连接代理已 close() 归还连接池，不能再使用。"""
+
+
+class _Entry:
+    """池中的一条底层连接及其创建时间。"""
+    __slots__ = ('raw', 'created_at')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+
+
+class PooledConnection:
+    """
+    连接池借出的连接代理：其余属性/方法透传给底层 pymysql 连接，
+    close() 不真正断开，而是回滚未提交事务后归还连接池。
+    每次借出都创建新的代理，归还后该代理永久失效（再次 close() 无效果，其它调用抛 ConnectionClosed），
+    持有旧代理的调用方碰不到已借给别人的连接。
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        entry = self.__dict__.get('_entry')
+        if entry is None:
+            raise ConnectionClosed(f"连接已归还连接池，不能再调用 {name}")
+        return getattr(entry.raw, name)
+
+    def close(self):
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool.release(entry)
+
+
+class ConnectionPool:
+    """
+    线程安全的连接池：
+    - min_size / max_size：常驻最少连接数与连接上限
+    - timeout：借连接的最长等待秒数，超时抛 PoolTimeout
+    - max_lifetime：连接最长存活秒数，超过后归还/借出时回收重建
+    - 借出前 ping 检活，归还时 rollback 清理未提交事务
+    """
+
+    def __init__(self, creator, min_size=2, max_size=20, timeout=10, max_lifetime=1800):
+        self._creator = creator
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._filled = False
+        self._closed = False
+
+        self._created = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _new_connection(self):
+        entry = _Entry(self._creator())
+        with self._cond:
+            self._created += 1
+        return entry
+
+    def _expired(self, entry):
+        return self.max_lifetime and time.monotonic() - entry.created_at >= self.max_lifetime
+
+    def _close_raw(self, entry):
+        try:
+            entry.raw.close()
+        except Exception:
+            pass
+
+    def _drop(self, entry):
+        """丢弃一条连接并释放其占用的名额。"""
+        self._close_raw(entry)
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _fill_min(self):
+        with self._cond:
+            if self._filled:
+                return
+            self._filled = True
+            need = max(0, self.min_size - self._size)
+            self._size += need
+        for _ in range(need):
+            try:
+                entry = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                continue
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def acquire(self):
+        if self._closed:
+            raise PoolTimeout("连接池已关闭")
+        self._fill_min()
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    entry = None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"等待数据库连接超时（{self.timeout}s），当前连接数 {self._size}")
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._total_wait += wait_time
+            self._max_wait = max(self._max_wait, wait_time)
+            self._in_use += 1
+
+        try:
+            entry = self._checkout(entry)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, entry)
+
+    def _checkout(self, entry):
+        """对借出的连接做过期回收与 ping 检活，不可用时就地重建。"""
+        if entry is not None and self._expired(entry):
+            self._close_raw(entry)
+            with self._cond:
+                self._recycled += 1
+            entry = None
+        if entry is not None:
+            try:
+                entry.raw.ping(reconnect=False)
+            except Exception:
+                self._close_raw(entry)
+                with self._cond:
+                    self._discarded += 1
+                entry = None
+        if entry is None:
+            entry = self._new_connection()
+        return entry
+
+    def release(self, entry):
+        """由 PooledConnection.close() 调用，每次借出只会归还一次。"""
+        with self._cond:
+            self._in_use -= 1
+        try:
+            entry.raw.rollback()
+        except Exception:
+            self._drop(entry)
+            return
+        if self._closed or self._expired(entry):
+            if not self._closed:
+                with self._cond:
+                    self._recycled += 1
+            self._close_raw(entry)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def close(self):
+        """关闭连接池：断开所有空闲连接，借出中的连接在归还时断开。"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_raw(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'created': self._created,
+                'recycled': self._recycled,
+                'discarded': self._discarded,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': round(self._total_wait / self._checkouts * 1000, 3) if self._checkouts else 0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
@@ -1,6 +1,21 @@
-from flask import Blueprint, render_template, redirect, url_for, session, request, flash
-from db import get_db_connection
+from flask import Blueprint, render_template, redirect, url_for, session, request, flash, jsonify, Response
+from db import (
+    get_audit_stats,
+    get_booking_gate_stats,
+    get_db_connection,
+    get_pool_stats,
+    get_reference_data,
+    invalidate_prescribing_frequency,
+    invalidate_reference_data,
+    publish_queue_change,
+    search_medicines,
+    save_consultation,
+    transaction,
+)
 from utils import require_admin
+from pagination import seek, page_links
+import queue_events
+import stats_rollup
 
 doctor_bp = Blueprint('doctor', __name__)
 
@@ -13,22 +28,11 @@ def dashboard():
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            sql = """
-                  SELECT r.reg_id, r.patient_id, p.name AS patient_name, p.gender, p.age,
-                         p.medical_record_no, p.allergy, p.past_illness,
-                         r.visit_status, r.queue_num, r.visit_date, r.shift, r.time_slot,
-                         r.called_time, r.call_times,
-                         CASE
-                             WHEN (r.visit_date = CURDATE() OR (r.visit_date IS NULL AND DATE(r.reg_time) = CURDATE()))
-                             THEN 1 ELSE 0
-                         END AS is_today
-                  FROM registration r
-                           JOIN patient p ON r.patient_id = p.patient_id
-                  WHERE r.doctor_id = %s
-                    AND r.visit_status IN ('未就诊', '就诊中')
-                  ORDER BY r.visit_date DESC, r.time_slot, r.queue_num ASC
-                  """
-            cursor.execute(sql, (session['user_id'],))
+            cursor.execute(queue_events.ROW_SELECT + """
+                WHERE r.doctor_id = %s
+                  AND r.visit_status IN ('未就诊', '就诊中')
+                ORDER BY r.visit_date DESC, r.time_slot, r.queue_num ASC
+            """, (session['user_id'],))
             patients = cursor.fetchall()
     finally:
         conn.close()
@@ -38,6 +42,20 @@ def dashboard():
                            patients=patients)
 
 
+@doctor_bp.route('/doctor_dashboard/stream')
+def dashboard_stream():
+    """
+    工作台候诊列表的实时推送（text/event-stream）：挂号、退号、叫号、接诊、完成问诊后推送变化的行。
+    """
+    if session.get('role') != 'doctor':
+        return jsonify(error='unauthorized'), 403
+
+    sub = queue_events.subscribe(session['user_id'])
+    return Response(queue_events.stream(sub),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @doctor_bp.route('/call_patient/<int:reg_id>')
 def call_patient(reg_id):
     """
@@ -72,6 +90,7 @@ def call_patient(reg_id):
                 WHERE reg_id = %s
             """, (reg_id,))
         conn.commit()
+        publish_queue_change(conn, reg_id, 'called')
         flash("已叫号", 'success')
     except Exception as e:
         conn.rollback()
@@ -93,6 +112,7 @@ def doctor_patient_detail(patient_id):
     patient = None
     regs = []
     med_records = []
+    reg_next = mr_next = None
     try:
         with conn.cursor() as cursor:
             cursor.execute("""
@@ -101,36 +121,35 @@ def doctor_patient_detail(patient_id):
             """, (patient_id,))
             patient = cursor.fetchone()
 
-            cursor.execute("""
-                SELECT r.reg_time, r.visit_date, r.shift, r.time_slot, r.visit_status, r.queue_num, r.reg_fee,
+            regs, reg_next = seek(cursor, """
+                SELECT r.reg_id, r.reg_time, r.visit_date, r.shift, r.time_slot, r.visit_status, r.queue_num, r.reg_fee,
                        d.name AS doctor_name, dept.dept_name
                 FROM registration r
                          JOIN doctor d ON r.doctor_id = d.doctor_id
                          JOIN department dept ON r.dept_id = dept.dept_id
                 WHERE r.patient_id=%s
-                ORDER BY r.reg_time DESC
-                LIMIT 50
-            """, (patient_id,))
-            regs = cursor.fetchall()
+            """, (patient_id,), keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                after=request.args.get('reg_after'))
 
-            cursor.execute("""
-                SELECT mr.main_complaint, mr.diagnosis, mr.create_time,
+            med_records, mr_next = seek(cursor, """
+                SELECT mr.record_id, mr.reg_id, mr.main_complaint, mr.diagnosis, mr.create_time,
                        d.name AS doctor_name
                 FROM medical_record mr
                          JOIN registration r ON mr.reg_id = r.reg_id
                          JOIN doctor d ON r.doctor_id = d.doctor_id
                 WHERE r.patient_id=%s
-                ORDER BY mr.create_time DESC
-                LIMIT 50
-            """, (patient_id,))
-            med_records = cursor.fetchall()
+            """, (patient_id,), keys=[('mr.create_time', 'create_time'), ('mr.reg_id', 'reg_id'),
+                                      ('mr.record_id', 'record_id')],
+                after=request.args.get('mr_after'))
     finally:
         conn.close()
 
     return render_template('doctor_patient_detail.html',
                            patient=patient,
                            regs=regs,
-                           med_records=med_records)
+                           med_records=med_records,
+                           reg_pages=page_links('reg_after', reg_next),
+                           mr_pages=page_links('mr_after', mr_next))
 
 
 @doctor_bp.route('/start_consult/<int:reg_id>')
@@ -140,7 +159,7 @@ def start_consult(reg_id):
 
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
+        with transaction(conn), conn.cursor() as cursor:
             cursor.execute("""
                 SELECT visit_status, called_time, doctor_id,
                        CASE
@@ -166,8 +185,9 @@ def start_consult(reg_id):
                 flash("请先叫号，再接诊", 'error')
                 return redirect(url_for('doctor.dashboard'))
 
-            cursor.execute("UPDATE registration SET visit_status = '就诊中' WHERE reg_id = %s", (reg_id,))
-            conn.commit()
+            with stats_rollup.track_registrations(conn, [reg_id]):
+                cursor.execute("UPDATE registration SET visit_status = '就诊中' WHERE reg_id = %s", (reg_id,))
+            publish_queue_change(conn, reg_id, 'consult_started')
     finally:
         conn.close()
     return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
@@ -207,18 +227,41 @@ def consultation_page(reg_id):
                 flash("非今日挂号不可问诊", 'error')
                 return redirect(url_for('doctor.dashboard'))
 
-            cursor.execute("SELECT * FROM medicine WHERE stock > 0")
-            medicines = cursor.fetchall()
-
     finally:
         conn.close()
 
     return render_template('consultation.html',
                            patient=patient,
-                           medicines=medicines,
                            doctor_name=session['user_name'])
 
 
+@doctor_bp.route('/consultation/medicines')
+def medicine_suggest():
+    """
+    处方药品输入联想：?q=药名/全拼/拼音首字母前缀，返回有库存的药品，本医生常用药优先。
+    """
+    if session.get('role') != 'doctor':
+        return jsonify(error='unauthorized'), 403
+
+    query = (request.args.get('q') or '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+    if not query:
+        return jsonify(items=[])
+
+    conn = get_db_connection()
+    try:
+        items = search_medicines(conn, query, doctor_id=session['user_id'], limit=limit)
+    finally:
+        conn.close()
+    return jsonify(items=[
+        {'med_id': m['med_id'], 'med_name': m['med_name'], 'price': float(m['price']), 'stock': m['stock']}
+        for m in items
+    ])
+
+
 @doctor_bp.route('/submit_consultation', methods=['POST'])
 def submit_consultation():
     if session.get('role') != 'doctor':
@@ -231,53 +274,32 @@ def submit_consultation():
     quantities = request.form.getlist('quantity[]')
     usages = request.form.getlist('usage[]')
 
+    items = []
+    for i in range(len(med_ids)):
+        if med_ids[i] and quantities[i]:
+            try:
+                med_id = int(med_ids[i])
+                qty_need = int(quantities[i])
+            except Exception:
+                flash("数量必须为数字", 'error')
+                return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
+            if qty_need <= 0:
+                flash("数量必须大于 0", 'error')
+                return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
+            items.append((med_id, qty_need, usages[i] if i < len(usages) else ''))
+
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            # 处方库存校验：如库存不足则整单回滚
-            for i in range(len(med_ids)):
-                if med_ids[i] and quantities[i]:
-                    cursor.execute("SELECT stock, med_name FROM medicine WHERE med_id=%s", (med_ids[i],))
-                    m = cursor.fetchone()
-                    if not m:
-                        flash("处方包含不存在的药品，已取消提交", 'error')
-                        conn.rollback()
-                        return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
-                    try:
-                        qty_need = int(quantities[i])
-                    except Exception:
-                        flash("数量必须为数字", 'error')
-                        conn.rollback()
-                        return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
-                    if int(m['stock']) < qty_need:
-                        flash(f"库存不足：{m['med_name']}（库存{m['stock']}），请调整数量", 'error')
-                        conn.rollback()
-                        return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
-
-            sql_record = """
-                         INSERT INTO medical_record (reg_id, doctor_id, main_complaint, diagnosis, create_time)
-                         VALUES (%s, %s, %s, %s, NOW())
-                         """
-            cursor.execute(sql_record, (reg_id, session['user_id'], main_complaint, diagnosis))
-
-            for i in range(len(med_ids)):
-                if med_ids[i] and quantities[i]:
-                    cursor.execute("SELECT price FROM medicine WHERE med_id=%s", (med_ids[i],))
-                    med_info = cursor.fetchone()
-                    total_amt = float(med_info['price']) * int(quantities[i])
-
-                    sql_presc = """
-                                INSERT INTO prescription (reg_id, med_id, dosage, med_usage, total_quantity, total_amount)
-                                VALUES (%s, %s, '标准剂量', %s, %s, %s)
-                                """
-                    cursor.execute(sql_presc, (reg_id, med_ids[i], usages[i], quantities[i], total_amt))
-
-            cursor.execute("UPDATE registration SET visit_status = '已就诊' WHERE reg_id = %s", (reg_id,))
-
-            conn.commit()
+        # 处方库存校验：如库存不足则整单回滚
+        save_consultation(conn, reg_id, session['user_id'], main_complaint, diagnosis, items)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('doctor.consultation_page', reg_id=reg_id))
     except Exception as e:
         print(f"保存失败: {e}")
-        conn.rollback()
+    else:
+        if items:
+            invalidate_prescribing_frequency(session['user_id'])
     finally:
         conn.close()
 
@@ -292,6 +314,30 @@ def admin_home():
     return render_template('admin_home.html')
 
 
+@doctor_bp.route('/admin/db_pool')
+def db_pool_stats():
+    """数据库连接池运行状态（JSON），便于高峰期观察连接占用与等待。"""
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+    return jsonify(get_pool_stats())
+
+
+@doctor_bp.route('/admin/booking_gate')
+def booking_gate_stats():
+    """预约准入运行状态（JSON）：各号源排队数、拒绝次数与排队等待耗时。"""
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+    return jsonify(get_booking_gate_stats())
+
+
+@doctor_bp.route('/admin/audit_log')
+def audit_log_stats():
+    """操作日志异步写入状态（JSON）：排队、已写入、丢弃、失败与延迟条数。"""
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+    return jsonify(get_audit_stats())
+
+
 @doctor_bp.route('/admin/doctors', methods=['GET', 'POST'])
 def doctor_manage():
     if not require_admin():
@@ -319,29 +365,19 @@ def doctor_manage():
                         VALUES (%s, %s, %s, %s, %s, %s, '正常')
                     """, (name, title, reg_fee, dept_id, phone, password))
                     conn.commit()
+                    invalidate_reference_data()
                     flash(f"医生 {name} 录入成功！", "success")
         except Exception as e:
             conn.rollback()
             flash(f"录入失败: {e}", "error")
 
     # 获取医生列表和科室列表用于展示和下拉选框
-    doctors = []
-    departments = []
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT d.*, dept.dept_name 
-                FROM doctor d 
-                JOIN department dept ON d.dept_id = dept.dept_id
-                ORDER BY dept.dept_name, d.name
-            """)
-            doctors = cursor.fetchall()
-            cursor.execute("SELECT * FROM department")
-            departments = cursor.fetchall()
+        ref = get_reference_data(conn)
     finally:
         conn.close()
 
-    return render_template('doctor_manage.html', doctors=doctors, departments=departments)
+    return render_template('doctor_manage.html', doctors=ref['all_doctors'], departments=ref['departments'])
 
 
 @doctor_bp.route('/admin/doctor/delete/<int:doctor_id>')
@@ -355,6 +391,7 @@ def delete_doctor(doctor_id):
             # 这里简单处理：改为停诊状态或直接删除（如果有外键约束建议改状态）
             cursor.execute("UPDATE doctor SET status='停诊' WHERE doctor_id=%s", (doctor_id,))
             conn.commit()
+            invalidate_reference_data()
             flash("该医生已设为停诊状态", "success")
     except Exception as e:
         flash(f"操作失败: {e}", "error")
@@ -0,0 +1,230 @@
+"""
+状态变更 POST 的幂等键：客户端在表单隐藏字段 idempotency_key（或请求头 Idempotency-Key）中带一个随机令牌，
+同一令牌的重复提交直接得到第一次的结果（提示信息 + 跳转地址），不再执行挂号/支付的读写。
+
+idempotency_key 表按 SHA-1(请求路径, 用户, 令牌) 存一行：
+    处理中  status=0，expires_at = 现在 + PENDING_SECONDS（处理中途崩溃时过期后可重新提交）
+    已完成  status=1，result 为 JSON，expires_at = 现在 + TTL_SECONDS
+视图里调用 discard() 表示本次结果是暂时性的（如“稍后重试”），不保存，令牌可再次使用。
+
+过期行由后台线程分批删除；也可手动执行：
+    python idempotency.py purge
+"""
+import hashlib
+import json
+import sys
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import g, redirect, request, session, flash
+
+from db import get_db_connection
+
+# 已完成结果的保留时间（秒）
+TTL_SECONDS = 24 * 3600
+# 处理中状态的有效期（秒）
+PENDING_SECONDS = 60
+# 后台清理的间隔（秒）与每批删除行数
+PURGE_INTERVAL = 600
+PURGE_BATCH = 1000
+# idempotency_key.result 列宽（字符）与保存时每条提示信息的最大长度
+RESULT_MAX_CHARS = 1000
+FLASH_MAX_CHARS = 200
+FORM_FIELD = 'idempotency_key'
+HEADER = 'Idempotency-Key'
+
+
+def new_token():
+    """模板中生成表单令牌：<input type="hidden" name="idempotency_key" value="{{ idempotency_token() }}">"""
+    return uuid.uuid4().hex
+
+
+def key_digest(path, role, user_id, token):
+    return hashlib.sha1(f"{path}\n{role}:{user_id}\n{token}".encode('utf-8')).digest()
+
+
+def claim(conn, digest):
+    """
+    占用幂等键并立即提交，返回 ('new', None) / ('done', result) / ('pending', None)。
+    已过期的键（含处理中途崩溃遗留的）视为新请求重新占用。
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT IGNORE INTO idempotency_key (key_hash, status, expires_at)
+                VALUES (%s, 0, NOW() + INTERVAL %s SECOND)
+            """, (digest, PENDING_SECONDS))
+            if cursor.rowcount == 1:
+                conn.commit()
+                return 'new', None
+            cursor.execute("""
+                UPDATE idempotency_key
+                SET status = 0, result = NULL, expires_at = NOW() + INTERVAL %s SECOND
+                WHERE key_hash = %s AND expires_at < NOW()
+            """, (PENDING_SECONDS, digest))
+            if cursor.rowcount == 1:
+                conn.commit()
+                return 'new', None
+            cursor.execute("SELECT status, result FROM idempotency_key WHERE key_hash = %s", (digest,))
+            row = cursor.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if row and row['status'] == 1:
+        return 'done', json.loads(row['result'])
+    return 'pending', None
+
+
+def complete(conn, digest, result):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE idempotency_key
+            SET status = 1, result = %s, expires_at = NOW() + INTERVAL %s SECOND
+            WHERE key_hash = %s
+        """, (json.dumps(result, ensure_ascii=False), TTL_SECONDS, digest))
+    conn.commit()
+
+
+def release(conn, digest):
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM idempotency_key WHERE key_hash = %s AND status = 0", (digest,))
+    conn.commit()
+
+
+def purge_expired(conn, batch=PURGE_BATCH):
+    """分批删除已过期的键（每批一个短事务），返回删除行数。"""
+    total = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM idempotency_key WHERE expires_at < NOW() LIMIT %s", (batch,))
+            deleted = cursor.rowcount
+        conn.commit()
+        total += deleted
+        if deleted < batch:
+            return total
+
+
+class Purger:
+    """后台守护线程：每 interval 秒清理一次过期键，首次处理幂等请求时启动。"""
+
+    def __init__(self, connect, interval=PURGE_INTERVAL):
+        self._connect = connect
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='idempotency-purge', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                conn = self._connect()
+                try:
+                    purge_expired(conn)
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f"[idempotency] 清理过期键失败: {e}")
+
+
+def stored_result(flashes, location):
+    """要保存的结果：提示信息截断到 FLASH_MAX_CHARS，整体超出列宽时从最早的提示开始丢弃。"""
+    result = {'flashes': [[category, message[:FLASH_MAX_CHARS]] for category, message in flashes],
+              'location': location}
+    while result['flashes'] and len(json.dumps(result, ensure_ascii=False)) > RESULT_MAX_CHARS:
+        result['flashes'].pop(0)
+    return result
+
+
+def discard():
+    """在视图中调用：本次结果不保存（暂时性失败），同一令牌可再次提交。"""
+    g.idempotency_discard = True
+
+
+def idempotent(view):
+    """
+    POST 视图装饰器：带令牌的请求先占用幂等键；重复提交直接重放第一次的提示信息与跳转，
+    处理中的重复提交提示稍候。只保存以跳转结束的结果。
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = (request.headers.get(HEADER) or request.form.get(FORM_FIELD) or '').strip()
+        if request.method != 'POST' or not token or not session.get('role'):
+            return view(*args, **kwargs)
+        _PURGER.ensure_started()
+
+        digest = key_digest(request.path, session.get('role'), session.get('user_id'), token[:128])
+        conn = get_db_connection()
+        try:
+            state, result = claim(conn, digest)
+        finally:
+            conn.close()
+        if state == 'done':
+            for category, message in result['flashes']:
+                flash(message, category)
+            return redirect(result['location'])
+        if state == 'pending':
+            flash("该请求正在处理中，请勿重复提交", 'info')
+            return redirect(request.referrer or '/')
+
+        flashed = len(session.get('_flashes', []))
+        keep_claim = False
+        try:
+            response = view(*args, **kwargs)
+            if getattr(response, 'status_code', None) in (301, 302, 303) and not g.get('idempotency_discard'):
+                # 视图已提交业务数据：保存结果失败时不释放令牌（处理中状态到期前重复提交仍被拦住），照常返回
+                keep_claim = True
+                try:
+                    conn = get_db_connection()
+                    try:
+                        complete(conn, digest, stored_result(session.get('_flashes', [])[flashed:],
+                                                             response.headers['Location']))
+                    finally:
+                        conn.close()
+                except Exception as e:
+                    print(f"[idempotency] 保存请求结果失败: {e}")
+            return response
+        finally:
+            if not keep_claim:
+                conn = get_db_connection()
+                try:
+                    release(conn, digest)
+                finally:
+                    conn.close()
+
+    return wrapper
+
+
+_PURGER = Purger(get_db_connection)
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv != ['purge']:
+        print("用法：python idempotency.py purge")
+        return 2
+
+    import pymysql
+    from db import DB_CONFIG
+
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        print(f"[idempotency] 已删除 {purge_expired(conn)} 个过期幂等键")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
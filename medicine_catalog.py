@@ -0,0 +1,166 @@
+import heapq
+import threading
+from array import array
+
+from medicine_search import PrefixIndex
+
+CATALOG_NAME = 'medicine'
+
+
+def mark_changed(conn, med_ids):
+    """
+    药品价格/库存变更后在同一事务内调用：目录版本号 +1，并把这些药品的 stock_version 记为新版本，
+    其它进程据此只增量刷新变化的行。须在锁定 medicine 行之后、写统计汇总之前调用。
+    """
+    med_ids = sorted({int(m) for m in med_ids})
+    if not med_ids:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE catalog_version SET version = LAST_INSERT_ID(version + 1) WHERE name=%s
+        """, (CATALOG_NAME,))
+        version = cursor.lastrowid
+        placeholders = ', '.join(['%s'] * len(med_ids))
+        cursor.execute(f"UPDATE medicine SET stock_version=%s WHERE med_id IN ({placeholders})",
+                       [version] + med_ids)
+    return version
+
+
+def mark_structure_changed(conn):
+    """
+    新增/删除药品后在同一事务内调用：目录版本与结构版本同时 +1，快照下次整体重新加载。
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE catalog_version
+            SET version = version + 1, structure_version = structure_version + 1
+            WHERE name=%s
+        """, (CATALOG_NAME,))
+
+
+class _Snapshot:
+    """按 med_id 升序排列的列式快照；创建后不再修改，刷新时复制出新快照。"""
+
+    __slots__ = ('version', 'structure_version', 'ids', 'names', 'prices', 'stocks', 'positions', 'index')
+
+    def __init__(self, version, structure_version, ids, names, prices, stocks, index=None):
+        self.version = version
+        self.structure_version = structure_version
+        self.ids = ids
+        self.names = names
+        self.prices = prices
+        self.stocks = stocks
+        self.positions = {med_id: i for i, med_id in enumerate(ids)}
+        # 联想检索用的前缀索引，首次检索时构建；只改价格/库存的增量刷新沿用同一索引
+        self.index = index
+
+    def search_index(self):
+        if self.index is None:
+            self.index = PrefixIndex(self.names)
+        return self.index
+
+    def row(self, i):
+        return {
+            'med_id': self.ids[i],
+            'med_name': self.names[i],
+            'price': self.prices[i],
+            'stock': self.stocks[i],
+        }
+
+
+class MedicineCatalog:
+    """
+    药品目录的进程内快照：med_id/库存存放在 array 中，药名、价格为并行列表。
+
+    每次读取先查一行 catalog_version：版本未变直接复用；只有库存/价格变化时按
+    stock_version > 快照版本 增量拉取变化的行；新增/删除药品（结构版本变化）才整表重载。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _read_version(self, cursor):
+        cursor.execute("SELECT version, structure_version FROM catalog_version WHERE name=%s", (CATALOG_NAME,))
+        row = cursor.fetchone()
+        if not row:
+            return 0, 0
+        return int(row['version']), int(row['structure_version'])
+
+    def _full_load(self, cursor, version, structure_version):
+        cursor.execute("SELECT med_id, med_name, price, stock FROM medicine ORDER BY med_id")
+        rows = cursor.fetchall()
+        return _Snapshot(
+            version, structure_version,
+            array('q', (row['med_id'] for row in rows)),
+            [row['med_name'] for row in rows],
+            [row['price'] for row in rows],
+            array('q', (int(row['stock'] or 0) for row in rows)),
+        )
+
+    def _refresh(self, cursor, snapshot, version):
+        cursor.execute("""
+            SELECT med_id, price, stock
+            FROM medicine
+            WHERE stock_version > %s
+        """, (snapshot.version,))
+        changed = cursor.fetchall()
+        prices = list(snapshot.prices)
+        stocks = array('q', snapshot.stocks)
+        for row in changed:
+            pos = snapshot.positions.get(row['med_id'])
+            if pos is None:
+                return None
+            prices[pos] = row['price']
+            stocks[pos] = int(row['stock'] or 0)
+        return _Snapshot(version, snapshot.structure_version, snapshot.ids, snapshot.names, prices, stocks,
+                         index=snapshot.index)
+
+    def _current(self, conn):
+        with conn.cursor() as cursor:
+            version, structure_version = self._read_version(cursor)
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version >= version:
+                return snapshot
+            fresh = None
+            if snapshot is not None and snapshot.structure_version == structure_version:
+                fresh = self._refresh(cursor, snapshot, version)
+            if fresh is None:
+                fresh = self._full_load(cursor, version, structure_version)
+        with self._lock:
+            current = self._snapshot
+            if current is None or current.version <= fresh.version:
+                self._snapshot = fresh
+        return fresh
+
+    def rows(self, conn, in_stock_only=False, descending=False):
+        """返回 [{med_id, med_name, price, stock}]，默认按 med_id 升序。"""
+        snapshot = self._current(conn)
+        order = range(len(snapshot.ids))
+        if descending:
+            order = reversed(order)
+        return [
+            snapshot.row(i)
+            for i in order
+            if not in_stock_only or snapshot.stocks[i] > 0
+        ]
+
+    def search(self, conn, query, frequency=None, limit=10, in_stock_only=True):
+        """
+        按药名/拼音前缀联想：先按 frequency（{med_id: 次数}）降序，
+        再药名以输入开头的优先、药名短的优先。
+        """
+        snapshot = self._current(conn)
+        query = (query or '').strip().lower()
+        matched = snapshot.search_index().lookup(query)
+        if in_stock_only:
+            matched = [i for i in matched if snapshot.stocks[i] > 0]
+        frequency = frequency or {}
+        names = snapshot.names
+        ids = snapshot.ids
+
+        def rank(i):
+            name = names[i]
+            return (-frequency.get(ids[i], 0), not name.lower().startswith(query), len(name), ids[i])
+
+        return [snapshot.row(i) for i in heapq.nsmallest(limit, matched, key=rank)]
@@ -0,0 +1,85 @@
+import threading
+import time
+from bisect import bisect_left
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:  # 未安装 pypinyin 时只按药名字符检索
+    lazy_pinyin = None
+
+
+def search_keys(name):
+    """
+    一个药名对应的检索键：药名及其各后缀（支持从中间开始输入），
+    安装了 pypinyin 时再加全拼与拼音首字母，均为小写、去空格。
+    """
+    name = (name or '').strip().lower()
+    if not name:
+        return set()
+    keys = {name[i:] for i in range(len(name))}
+    if lazy_pinyin is not None:
+        syllables = [s.lower() for s in lazy_pinyin(name) if s.strip()]
+        initials = [s.lower() for s in lazy_pinyin(name, style=Style.FIRST_LETTER) if s.strip()]
+        keys.add(''.join(syllables).replace(' ', ''))
+        keys.add(''.join(initials).replace(' ', ''))
+    return keys
+
+
+class PrefixIndex:
+    """
+    排序后的 (检索键, 位置) 并行数组，前缀查询用 bisect 定位区间。
+    位置指向药品快照中的下标，快照只改价格/库存时索引可以继续复用。
+    """
+
+    def __init__(self, names):
+        pairs = sorted((key, pos) for pos, name in enumerate(names) for key in search_keys(name))
+        self._keys = [key for key, _ in pairs]
+        self._positions = [pos for _, pos in pairs]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, prefix):
+        """返回以 prefix 开头的所有检索键对应的位置集合。"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return set()
+        start = bisect_left(self._keys, prefix)
+        # prefix 后接 U+10FFFF 是所有以 prefix 开头的键的上界
+        end = bisect_left(self._keys, prefix + '\U0010ffff', start)
+        return set(self._positions[start:end])
+
+
+class PrescribingFrequency:
+    """
+    每位医生历史开药频次 {med_id: 次数}，按医生缓存 ttl 秒，
+    输入联想时不必每次按键都统计处方表。
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def get(self, conn, doctor_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(doctor_id)
+        if cached and now - cached[0] < self.ttl:
+            return cached[1]
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT pr.med_id, COUNT(*) AS cnt
+                FROM prescription pr
+                         JOIN registration r ON pr.reg_id = r.reg_id
+                WHERE r.doctor_id = %s
+                GROUP BY pr.med_id
+            """, (doctor_id,))
+            counts = {row['med_id']: int(row['cnt']) for row in cursor.fetchall()}
+        with self._lock:
+            self._cache[doctor_id] = (now, counts)
+        return counts
+
+    def invalidate(self, doctor_id):
+        with self._lock:
+            self._cache.pop(doctor_id, None)
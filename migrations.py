@@ -0,0 +1,551 @@
+"""
+数据库版本迁移。
+
+每个迁移步骤带一个递增的版本号，执行成功后写入 schema_version 表；
+步骤本身保持幂等（先判断表/列是否存在），重复执行不会出错。
+
+用法：
+    python migrations.py            # 执行全部未应用的迁移
+    python migrations.py status     # 查看当前版本与待执行的迁移
+"""
+import sys
+
+import pymysql
+
+from db import (
+    DB_NAME,
+    DB_CONFIG,
+    DEFAULT_ADMIN_NAME,
+    DEFAULT_ADMIN_PHONE,
+    DEFAULT_ADMIN_PASSWORD,
+    table_exists,
+    column_exists,
+    invalidate_schema_catalog,
+)
+
+MIGRATIONS = []
+# 跨进程初始化使用的 MySQL 咨询锁名（GET_LOCK 作用于整个 MySQL 实例，按库名区分）
+MIGRATION_LOCK_NAME = f'{DB_NAME}.schema_migrate'
+
+
+def migration(version, description):
+    """注册一个迁移步骤，版本号必须严格递增。"""
+    def decorator(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"迁移版本号必须递增：{version}")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    """
+    读取数据库当前版本（一次查询）；schema_version 表不存在时视为 0。
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT IFNULL(MAX(version), 0) AS version FROM schema_version")
+            return int(cursor.fetchone()['version'])
+    except pymysql.err.ProgrammingError as e:
+        if e.args and e.args[0] == 1146:
+            return 0
+        raise
+
+
+def _ensure_version_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+    conn.commit()
+
+
+def _add_column(conn, cursor, table_name, column_name, ddl):
+    if not column_exists(conn, table_name, column_name):
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl};")
+        invalidate_schema_catalog()
+
+
+def _create_table(conn, cursor, table_name, ddl):
+    if not table_exists(conn, table_name):
+        cursor.execute(ddl)
+        invalidate_schema_catalog()
+
+
+def _has_index(cursor, table_name, index_name):
+    cursor.execute(f"SHOW INDEX FROM {table_name} WHERE Key_name=%s", (index_name,))
+    return cursor.fetchone() is not None
+
+
+def _has_index_on(cursor, table_name, column_name):
+    """表上是否已有以该列开头的索引。"""
+    cursor.execute(f"SHOW INDEX FROM {table_name} WHERE Column_name=%s AND Seq_in_index=1", (column_name,))
+    return cursor.fetchone() is not None
+
+
+def run_migrations(conn, target=None):
+    """
+    依次执行版本号大于当前版本的迁移，返回本次执行的 (version, description) 列表。
+    """
+    _ensure_version_table(conn)
+    current = current_version(conn)
+    applied = []
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+        if target is not None and version > target:
+            break
+        with conn.cursor() as cursor:
+            func(conn, cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+        conn.commit()
+        invalidate_schema_catalog()
+        applied.append((version, description))
+    return applied
+
+
+def migrate_with_lock(conn, wait_seconds=10):
+    """
+    多进程（如 gunicorn 多 worker）安全的自动迁移：
+    先用 GET_LOCK 抢占咨询锁，抢到后再读一次 schema_version（持久化的“已完成”标记），
+    仍落后才执行迁移；其它进程在锁上短暂等待，拿到锁时版本已是最新则直接跳过。
+    返回 'migrated' / 'skipped' / 'timeout'。
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, %s) AS got", (MIGRATION_LOCK_NAME, wait_seconds))
+        got = cursor.fetchone()['got']
+    if got != 1:
+        return 'timeout'
+    try:
+        if current_version(conn) >= latest_version():
+            return 'skipped'
+        run_migrations(conn)
+        return 'migrated'
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+
+
+# ==================== 迁移步骤 ==================== #
+
+
+@migration(1, '排班表 doctor_schedule 及按时间段的唯一索引')
+def _m001_doctor_schedule(conn, cursor):
+    if not table_exists(conn, 'doctor_schedule'):
+        _create_table(conn, cursor, 'doctor_schedule', """
+            CREATE TABLE doctor_schedule (
+                schedule_id INT AUTO_INCREMENT PRIMARY KEY,
+                doctor_id INT NOT NULL,
+                schedule_date DATE NOT NULL,
+                shift VARCHAR(10) NOT NULL,
+                time_slot VARCHAR(20) NOT NULL DEFAULT '09:00-10:00',
+                max_slots INT NOT NULL DEFAULT 20,
+                booked_slots INT NOT NULL DEFAULT 0,
+                status VARCHAR(10) NOT NULL DEFAULT '可用',
+                UNIQUE KEY uniq_doctor_date_slot (doctor_id, schedule_date, time_slot),
+                KEY idx_doctor_date_slot (doctor_id, schedule_date, time_slot)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+        return
+
+    # 针对已有表补全缺失列；避免在部分 MySQL 版本上使用函数作为默认值导致失败
+    _add_column(conn, cursor, 'doctor_schedule', 'schedule_date', "DATE NULL")
+    _add_column(conn, cursor, 'doctor_schedule', 'shift', "VARCHAR(10) NOT NULL DEFAULT '上午'")
+    _add_column(conn, cursor, 'doctor_schedule', 'time_slot', "VARCHAR(20) NOT NULL DEFAULT '09:00-10:00' AFTER shift")
+    _add_column(conn, cursor, 'doctor_schedule', 'max_slots', "INT NOT NULL DEFAULT 20")
+    _add_column(conn, cursor, 'doctor_schedule', 'booked_slots', "INT NOT NULL DEFAULT 0")
+    _add_column(conn, cursor, 'doctor_schedule', 'status', "VARCHAR(10) NOT NULL DEFAULT '可用'")
+
+    # 调整唯一索引，支持同一医生同一天多个时间段
+    if _has_index(cursor, 'doctor_schedule', 'uniq_doctor_date_shift'):
+        try:
+            cursor.execute("ALTER TABLE doctor_schedule DROP INDEX uniq_doctor_date_shift")
+        except Exception:
+            pass
+    if not _has_index(cursor, 'doctor_schedule', 'uniq_doctor_date_slot'):
+        try:
+            cursor.execute(
+                "ALTER TABLE doctor_schedule ADD UNIQUE KEY uniq_doctor_date_slot (doctor_id, schedule_date, time_slot)"
+            )
+        except Exception:
+            pass
+    if column_exists(conn, 'doctor_schedule', 'work_date'):
+        cursor.execute("""
+            UPDATE doctor_schedule
+            SET schedule_date = work_date
+            WHERE schedule_date IS NULL AND work_date IS NOT NULL
+        """)
+
+
+@migration(2, '处方表 prescription（药房发药/收费依赖）')
+def _m002_prescription(conn, cursor):
+    _create_table(conn, cursor, 'prescription', """
+        CREATE TABLE prescription (
+            presc_id INT AUTO_INCREMENT PRIMARY KEY,
+            reg_id INT NOT NULL,
+            med_id INT NOT NULL,
+            dosage VARCHAR(50) NULL,
+            med_usage VARCHAR(255) NULL,
+            total_quantity INT NOT NULL DEFAULT 0,
+            total_amount DECIMAL(10,2) NOT NULL DEFAULT 0,
+            dispense_status VARCHAR(20) NOT NULL DEFAULT '未发药',
+            dispense_time DATETIME NULL,
+            KEY idx_reg (reg_id),
+            KEY idx_med (med_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    _add_column(conn, cursor, 'prescription', 'dispense_status', "VARCHAR(20) NOT NULL DEFAULT '未发药'")
+    _add_column(conn, cursor, 'prescription', 'dispense_time', "DATETIME NULL")
+
+
+@migration(3, '挂号/患者表补充就诊日期、时间段、收费与叫号字段')
+def _m003_registration_patient_columns(conn, cursor):
+    _add_column(conn, cursor, 'registration', 'visit_date', "DATE NULL AFTER reg_time")
+    _add_column(conn, cursor, 'registration', 'shift', "VARCHAR(10) NOT NULL DEFAULT '全天' AFTER visit_date")
+    _add_column(conn, cursor, 'registration', 'time_slot', "VARCHAR(20) NOT NULL DEFAULT '09:00-10:00' AFTER shift")
+    _add_column(conn, cursor, 'registration', 'fee_status', "VARCHAR(20) NOT NULL DEFAULT '未支付' AFTER reg_fee")
+    _add_column(conn, cursor, 'registration', 'schedule_id', "INT NULL AFTER shift")
+    _add_column(conn, cursor, 'patient', 'medical_record_no', "VARCHAR(32) NULL AFTER age")
+    _add_column(conn, cursor, 'patient', 'past_illness', "VARCHAR(255) NULL AFTER allergy")
+    _add_column(conn, cursor, 'registration', 'check_fee', "DECIMAL(10,2) NOT NULL DEFAULT 0 AFTER reg_fee")
+    _add_column(conn, cursor, 'registration', 'paid_time', "DATETIME NULL AFTER fee_status")
+    # 医生叫号记录
+    _add_column(conn, cursor, 'registration', 'called_time', "DATETIME NULL")
+    _add_column(conn, cursor, 'registration', 'call_times', "INT NOT NULL DEFAULT 0")
+
+
+@migration(4, '历史数据回填：病历号、就诊日期、班次与时间段默认值')
+def _m004_backfill(conn, cursor):
+    # 病历号为空的患者：用 patient_id 生成稳定且唯一的病历号
+    cursor.execute("""
+        UPDATE patient
+        SET medical_record_no = CONCAT('MR', LPAD(patient_id, 8, '0'))
+        WHERE medical_record_no IS NULL OR medical_record_no = ''
+    """)
+    # 就诊日期为空的挂号：默认使用 reg_time 的日期
+    cursor.execute("""
+        UPDATE registration
+        SET visit_date = DATE(reg_time)
+        WHERE visit_date IS NULL AND reg_time IS NOT NULL
+    """)
+    cursor.execute("""
+        UPDATE registration
+        SET shift = '全天'
+        WHERE shift IS NULL OR shift = ''
+    """)
+    cursor.execute("""
+        UPDATE registration
+        SET time_slot = '09:00-10:00'
+        WHERE time_slot IS NULL OR time_slot = ''
+    """)
+    cursor.execute("""
+        UPDATE doctor_schedule
+        SET schedule_date = CURDATE()
+        WHERE schedule_date IS NULL
+    """)
+    cursor.execute("""
+        UPDATE doctor_schedule
+        SET time_slot = '09:00-10:00'
+        WHERE time_slot IS NULL OR time_slot = ''
+    """)
+
+
+@migration(5, '管理员账号表、操作日志表及默认管理员')
+def _m005_admin_and_log(conn, cursor):
+    # 管理员账号：单独表，避免依赖 doctor/department 结构
+    _create_table(conn, cursor, 'admin_user', """
+        CREATE TABLE admin_user (
+            admin_id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(50) NOT NULL,
+            phone VARCHAR(32) NOT NULL UNIQUE,
+            password VARCHAR(64) NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    _create_table(conn, cursor, 'operation_log', """
+        CREATE TABLE operation_log (
+            log_id INT AUTO_INCREMENT PRIMARY KEY,
+            operator_id INT NOT NULL,
+            operator_name VARCHAR(50) NULL,
+            operator_role VARCHAR(20) NULL,
+            operation_type VARCHAR(50) NOT NULL,
+            target_id INT NULL,
+            detail TEXT NULL,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    cursor.execute("SELECT 1 FROM admin_user WHERE phone=%s LIMIT 1", (DEFAULT_ADMIN_PHONE,))
+    if not cursor.fetchone():
+        cursor.execute(
+            "INSERT INTO admin_user (name, phone, password) VALUES (%s, %s, %s)",
+            (DEFAULT_ADMIN_NAME, DEFAULT_ADMIN_PHONE, DEFAULT_ADMIN_PASSWORD)
+        )
+
+
+@migration(6, '医生数据重置：初始化科室与演示医生（仅执行一次）')
+def _m006_reset_doctors(conn, cursor):
+    print("[migrate] 正在执行医生数据重置...")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+    cursor.execute("TRUNCATE TABLE registration;")
+    cursor.execute("TRUNCATE TABLE doctor_schedule;")
+    cursor.execute("TRUNCATE TABLE medical_record;")
+    cursor.execute("TRUNCATE TABLE prescription;")
+    cursor.execute("DELETE FROM doctor;")  # 清空所有医生
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
+
+    # 确保科室存在
+    for dname in ('内科', '外科', '儿科'):
+        cursor.execute("SELECT 1 FROM department WHERE dept_name=%s", (dname,))
+        if not cursor.fetchone():
+            cursor.execute("INSERT INTO department (dept_name) VALUES (%s)", (dname,))
+
+    cursor.execute("SELECT dept_id, dept_name FROM department")
+    dept_map = {row['dept_name']: row['dept_id'] for row in cursor.fetchall()}
+
+    # 重新生成的医生名单 (2-3名/科室)
+    regenerated_doctors = [
+        # 内科
+        ('张宏', '主任医师', 50.00, '内科', '13800000001', '123456'),
+        ('陈静', '副主任医师', 30.00, '内科', '13800000002', '123456'),
+        ('刘志强', '主治医师', 20.00, '内科', '13800000006', '123456'),
+        # 外科
+        ('李芳', '主任医师', 50.00, '外科', '13800000003', '123456'),
+        ('孙勇', '副主任医师', 30.00, '外科', '13800000004', '123456'),
+        ('赵铁柱', '主治医师', 25.00, '外科', '13800000007', '123456'),
+        # 儿科
+        ('王强', '主任医师', 50.00, '儿科', '13800000005', '123456'),
+        ('林妙妙', '副主任医师', 30.00, '儿科', '13800000008', '123456')
+    ]
+    for d_name, d_title, d_fee, d_dept_name, d_phone, d_pwd in regenerated_doctors:
+        target_dept_id = dept_map.get(d_dept_name)
+        if target_dept_id:
+            cursor.execute("""
+                INSERT INTO doctor (name, title, reg_fee, dept_id, phone, password, status)
+                VALUES (%s, %s, %s, %s, %s, %s, '正常')
+            """, (d_name, d_title, d_fee, target_dept_id, d_phone, d_pwd))
+    print(f"[migrate] 医生重置完成，共录入 {len(regenerated_doctors)} 名医生。")
+
+
+@migration(7, '排队号计数表 queue_sequence（按医生/日期/班次/时间段分配排队号）')
+def _m007_queue_sequence(conn, cursor):
+    _create_table(conn, cursor, 'queue_sequence', """
+        CREATE TABLE queue_sequence (
+            doctor_id INT NOT NULL,
+            visit_date DATE NOT NULL,
+            shift VARCHAR(10) NOT NULL,
+            time_slot VARCHAR(20) NOT NULL,
+            last_num INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (doctor_id, visit_date, shift, time_slot)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    # 已有挂号：计数从当前最大排队号继续，避免与历史号码重复
+    cursor.execute("""
+        INSERT INTO queue_sequence (doctor_id, visit_date, shift, time_slot, last_num)
+        SELECT doctor_id, visit_date, shift, time_slot, MAX(queue_num)
+        FROM registration
+        WHERE visit_date IS NOT NULL
+        GROUP BY doctor_id, visit_date, shift, time_slot
+        ON DUPLICATE KEY UPDATE last_num = GREATEST(last_num, VALUES(last_num))
+    """)
+
+
+@migration(8, '病历号按日计数表 medical_record_seq')
+def _m008_medical_record_seq(conn, cursor):
+    _create_table(conn, cursor, 'medical_record_seq', """
+        CREATE TABLE medical_record_seq (
+            seq_date DATE PRIMARY KEY,
+            last_no INT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    # 旧规则当日序号取 MAX(patient_id)+1，从其后继续编号，避免与今天已发出的病历号重复
+    cursor.execute("""
+        INSERT INTO medical_record_seq (seq_date, last_no)
+        SELECT CURDATE(), IFNULL(MAX(patient_id), 0) + 1 FROM patient
+        ON DUPLICATE KEY UPDATE last_no = GREATEST(last_no, VALUES(last_no))
+    """)
+
+
+@migration(9, '统计汇总表 daily_stats / daily_medicine_stats 及按日期查询的索引，并回填历史汇总')
+def _m009_daily_stats(conn, cursor):
+    import stats_rollup
+
+    _create_table(conn, cursor, 'daily_stats', """
+        CREATE TABLE daily_stats (
+            stat_date DATE NOT NULL,
+            dept_id INT NOT NULL,
+            doctor_id INT NOT NULL,
+            reg_total INT NOT NULL DEFAULT 0,
+            reg_cancelled INT NOT NULL DEFAULT 0,
+            reg_paid INT NOT NULL DEFAULT 0,
+            visiting INT NOT NULL DEFAULT 0,
+            visited INT NOT NULL DEFAULT 0,
+            mr_count INT NOT NULL DEFAULT 0,
+            paid_reg_fee DECIMAL(12,2) NOT NULL DEFAULT 0,
+            paid_check_fee DECIMAL(12,2) NOT NULL DEFAULT 0,
+            paid_med_fee DECIMAL(12,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (stat_date, dept_id, doctor_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    _create_table(conn, cursor, 'daily_medicine_stats', """
+        CREATE TABLE daily_medicine_stats (
+            stat_date DATE NOT NULL,
+            med_id INT NOT NULL,
+            qty_sum INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (stat_date, med_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    if not _has_index_on(cursor, 'registration', 'visit_date'):
+        cursor.execute("ALTER TABLE registration ADD KEY idx_visit_date (visit_date)")
+    cursor.execute("SHOW INDEX FROM registration WHERE Key_name='idx_doctor_visit_date'")
+    if not cursor.fetchone():
+        cursor.execute("ALTER TABLE registration ADD KEY idx_doctor_visit_date (doctor_id, visit_date)")
+    if not _has_index_on(cursor, 'medical_record', 'reg_id'):
+        cursor.execute("ALTER TABLE medical_record ADD KEY idx_reg (reg_id)")
+
+    cursor.execute("SELECT MIN(visit_date) AS date_from, MAX(visit_date) AS date_to FROM registration")
+    span = cursor.fetchone()
+    if span and span['date_from']:
+        stats_rollup.rebuild(conn, span['date_from'], span['date_to'])
+
+
+@migration(10, '药品目录版本表 catalog_version 与 medicine.stock_version（药品快照增量刷新）')
+def _m010_catalog_version(conn, cursor):
+    _create_table(conn, cursor, 'catalog_version', """
+        CREATE TABLE catalog_version (
+            name VARCHAR(32) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            structure_version BIGINT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    cursor.execute("""
+        INSERT IGNORE INTO catalog_version (name, version, structure_version) VALUES ('medicine', 1, 1)
+    """)
+    _add_column(conn, cursor, 'medicine', 'stock_version', "BIGINT NOT NULL DEFAULT 0")
+    if not _has_index(cursor, 'medicine', 'idx_stock_version'):
+        cursor.execute("ALTER TABLE medicine ADD KEY idx_stock_version (stock_version)")
+
+
+@migration(11, '患者检索索引表 patient_search_token（姓名子串/拼音/手机号后几位/病历号前缀），并回填')
+def _m011_patient_search_token(conn, cursor):
+    import patient_search
+
+    _create_table(conn, cursor, 'patient_search_token', """
+        CREATE TABLE patient_search_token (
+            token VARCHAR(64) NOT NULL,
+            patient_id INT NOT NULL,
+            PRIMARY KEY (token, patient_id),
+            KEY idx_patient (patient_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+    """)
+    if not _has_index(cursor, 'registration', 'idx_patient_doctor'):
+        cursor.execute("ALTER TABLE registration ADD KEY idx_patient_doctor (patient_id, doctor_id)")
+    patient_search.rebuild(conn)
+
+
+@migration(12, '键集分页用索引：registration(patient_id, reg_time)、registration(fee_status, reg_time)')
+def _m012_pagination_indexes(conn, cursor):
+    if not _has_index(cursor, 'registration', 'idx_patient_reg_time'):
+        cursor.execute("ALTER TABLE registration ADD KEY idx_patient_reg_time (patient_id, reg_time)")
+    if not _has_index(cursor, 'registration', 'idx_fee_status_reg_time'):
+        cursor.execute("ALTER TABLE registration ADD KEY idx_fee_status_reg_time (fee_status, reg_time)")
+
+
+@migration(13, '挂号账单台账 billing_ledger（挂号/检查/药费/合计与已付、已退金额），并按原始表回填')
+def _m013_billing_ledger(conn, cursor):
+    import billing
+
+    _create_table(conn, cursor, 'billing_ledger', """
+        CREATE TABLE billing_ledger (
+            reg_id INT PRIMARY KEY,
+            reg_fee DECIMAL(10,2) NOT NULL DEFAULT 0,
+            check_fee DECIMAL(10,2) NOT NULL DEFAULT 0,
+            med_fee DECIMAL(12,2) NOT NULL DEFAULT 0,
+            total_fee DECIMAL(12,2) NOT NULL DEFAULT 0,
+            paid_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+            refunded_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    billing.rebuild(conn)
+
+
+@migration(14, '号源余量查询用索引：doctor_schedule(schedule_date, doctor_id)')
+def _m014_schedule_date_index(conn, cursor):
+    if not _has_index_on(cursor, 'doctor_schedule', 'schedule_date'):
+        cursor.execute("ALTER TABLE doctor_schedule ADD KEY idx_schedule_date_doctor (schedule_date, doctor_id)")
+
+
+@migration(15, '医生周排班模板 schedule_template（周几 × 时间段 的号源与状态）')
+def _m015_schedule_template(conn, cursor):
+    _create_table(conn, cursor, 'schedule_template', """
+        CREATE TABLE schedule_template (
+            template_id INT AUTO_INCREMENT PRIMARY KEY,
+            doctor_id INT NOT NULL,
+            weekday TINYINT NOT NULL,
+            shift VARCHAR(10) NOT NULL,
+            time_slot VARCHAR(20) NOT NULL,
+            max_slots INT NOT NULL DEFAULT 20,
+            status VARCHAR(10) NOT NULL DEFAULT '可用',
+            UNIQUE KEY uniq_doctor_weekday_slot (doctor_id, weekday, time_slot)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+
+@migration(16, '幂等键表 idempotency_key（挂号/支付 POST 的重复提交直接返回首次结果）')
+def _m016_idempotency_key(conn, cursor):
+    _create_table(conn, cursor, 'idempotency_key', """
+        CREATE TABLE idempotency_key (
+            key_hash BINARY(20) PRIMARY KEY,
+            status TINYINT NOT NULL DEFAULT 0,
+            result VARCHAR(1000) NULL,
+            expires_at DATETIME NOT NULL,
+            KEY idx_expires_at (expires_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    command = argv[0] if argv else 'upgrade'
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        if command == 'status':
+            current = current_version(conn)
+            print(f"当前版本：{current}，最新版本：{latest_version()}")
+            for version, description, _ in MIGRATIONS:
+                if version > current:
+                    print(f"  待执行 {version:03d} {description}")
+        elif command == 'upgrade':
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 60) AS got", (MIGRATION_LOCK_NAME,))
+                if cursor.fetchone()['got'] != 1:
+                    print("[migrate] 其它进程正在执行迁移，请稍后重试")
+                    return 1
+            try:
+                applied = run_migrations(conn)
+            finally:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+            for version, description in applied:
+                print(f"[migrate] 已执行 {version:03d} {description}")
+            print(f"[migrate] 当前版本：{current_version(conn)}")
+        else:
+            print(__doc__)
+            return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
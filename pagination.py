@@ -0,0 +1,79 @@
+"""
+键集（seek）分页：按排序键记住上一页最后一行，下一页用 WHERE (k1, k2) < (v1, v2) 继续，
+不用 OFFSET，翻到多深每页的查询代价都一样。
+
+    rows, next_cursor = seek(cursor, sql, params,
+                             keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                             after=request.args.get('after'))
+
+sql 须以 WHERE 条件结尾（不含 ORDER BY / LIMIT），由 seek 追加翻页条件、倒序排序与 LIMIT；
+排序键的最后一列必须唯一（通常是主键），且都要出现在 SELECT 结果中。
+"""
+import base64
+import json
+
+from flask import request, url_for
+
+PAGE_SIZE = 20
+
+
+def encode_cursor(row, keys):
+    values = [None if row[field] is None else str(row[field]) for _, field in keys]
+    raw = json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, size):
+    """解析游标，格式不对时返回 None（按第一页处理）。"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size or any(v is None for v in values):
+        return None
+    return values
+
+
+def seek(cursor, sql, params, keys, after=None, size=PAGE_SIZE):
+    """
+    执行一页查询，返回 (rows, next_cursor)；没有下一页时 next_cursor 为 None。
+    keys: [(列表达式, 结果字段名)]，按先后顺序倒序排列。
+    """
+    params = list(params)
+    values = decode_cursor(after, len(keys))
+    if values:
+        ors = []
+        for i, (column, _) in enumerate(keys):
+            ands = [f"{keys[j][0]} = %s" for j in range(i)] + [f"{column} < %s"]
+            ors.append('(' + ' AND '.join(ands) + ')')
+            params.extend(values[:i + 1])
+        sql += " AND (" + ' OR '.join(ors) + ")"
+    sql += " ORDER BY " + ', '.join(f"{column} DESC" for column, _ in keys) + " LIMIT %s"
+    params.append(size + 1)
+
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(rows[-1], keys)
+    return rows, next_cursor
+
+
+def page_links(param, next_cursor):
+    """
+    当前页面的翻页链接：{'next': 下一页 URL 或 None, 'first': 回到第一页 URL 或 None}，
+    保留其它查询参数，只替换 param。
+    """
+    args = request.args.to_dict()
+    args.update(request.view_args or {})
+    links = {'next': None, 'first': None}
+    if next_cursor:
+        links['next'] = url_for(request.endpoint, **dict(args, **{param: next_cursor}))
+    if args.get(param):
+        args.pop(param)
+        links['first'] = url_for(request.endpoint, **args)
+    return links
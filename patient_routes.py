@@ -1,5 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from db import get_db_connection, generate_medical_record_no, table_exists
+import patient_search
+from pagination import seek, page_links
 from utils import require_admin
 
 patients_bp = Blueprint('patients', __name__)
@@ -12,30 +14,21 @@ def patient_manage():
         return redirect(url_for('auth.login'))
 
     keyword = request.args.get('q', '').strip()
+    doctor_id = session.get('user_id') if role == 'doctor' else None
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            if role == 'doctor':
-                like_kw = f"%{keyword}%"
-                cursor.execute("""
-                    SELECT DISTINCT p.patient_id, p.name, p.gender, p.age, p.phone, p.allergy, p.medical_record_no
-                    FROM patient p
-                             JOIN registration r ON r.patient_id = p.patient_id
-                    WHERE r.doctor_id = %s
-                      AND (%s = '' OR p.name LIKE %s OR p.medical_record_no LIKE %s)
-                    ORDER BY p.patient_id DESC
-                    LIMIT 200
-                """, (session.get('user_id'), keyword, like_kw, like_kw))
-            else:
-                if keyword:
-                    like_kw = f"%{keyword}%"
+        if keyword:
+            patients = patient_search.search_patients(conn, keyword, doctor_id=doctor_id)
+        else:
+            with conn.cursor() as cursor:
+                if role == 'doctor':
                     cursor.execute("""
-                        SELECT patient_id, name, gender, age, phone, allergy, medical_record_no
-                        FROM patient
-                        WHERE name LIKE %s OR medical_record_no LIKE %s
-                        ORDER BY patient_id DESC
+                        SELECT p.patient_id, p.name, p.gender, p.age, p.phone, p.allergy, p.medical_record_no
+                        FROM patient p
+                        WHERE EXISTS (SELECT 1 FROM registration r WHERE r.patient_id = p.patient_id AND r.doctor_id = %s)
+                        ORDER BY p.patient_id DESC
                         LIMIT 200
-                    """, (like_kw, like_kw))
+                    """, (doctor_id,))
                 else:
                     cursor.execute("""
                         SELECT patient_id, name, gender, age, phone, allergy, medical_record_no
@@ -43,7 +36,7 @@ def patient_manage():
                         ORDER BY patient_id DESC
                         LIMIT 200
                     """)
-            patients = cursor.fetchall()
+                patients = cursor.fetchall()
     finally:
         conn.close()
 
@@ -71,12 +64,13 @@ def patient_create():
                     flash("病历号已存在，请更换或留空自动生成。", 'error')
                     return redirect(url_for('patients.patient_manage'))
             else:
-                med_no = generate_medical_record_no(conn)
+                med_no = generate_medical_record_no()
 
             cursor.execute("""
                 INSERT INTO patient (name, gender, age, phone, allergy, medical_record_no, password)
                 VALUES (%s, %s, %s, %s, %s, %s, %s)
             """, (name, gender, age, phone, allergy, med_no, '123456'))
+            patient_search.index_patient(conn, cursor.lastrowid, name, phone, med_no)
         conn.commit()
         flash(f"已创建患者，病历号：{med_no}", 'success')
     except Exception as e:
@@ -118,6 +112,7 @@ def patient_update():
                 SET name=%s, gender=%s, age=%s, phone=%s, allergy=%s, medical_record_no=%s
                 WHERE patient_id=%s
             """, (name, gender, age, phone, allergy, med_no, patient_id))
+            patient_search.index_patient(conn, patient_id, name, phone, med_no)
         conn.commit()
         flash("信息已更新", 'success')
     except Exception as e:
@@ -138,6 +133,7 @@ def patient_detail(patient_id):
     patient = None
     regs = []
     med_records = []
+    reg_next = mr_next = None
     try:
         with conn.cursor() as cursor:
             if role == 'doctor':
@@ -157,35 +153,36 @@ def patient_detail(patient_id):
             """, (patient_id,))
             patient = cursor.fetchone()
 
-            cursor.execute("""
-                SELECT r.reg_time, r.visit_date, r.shift, r.visit_status, r.queue_num, r.reg_fee,
+            regs, reg_next = seek(cursor, """
+                SELECT r.reg_id, r.reg_time, r.visit_date, r.shift, r.visit_status, r.queue_num, r.reg_fee,
                        d.name AS doctor_name, dept.dept_name
                 FROM registration r
                          JOIN doctor d ON r.doctor_id = d.doctor_id
                          JOIN department dept ON r.dept_id = dept.dept_id
                 WHERE r.patient_id=%s
-                ORDER BY r.reg_time DESC
-            """, (patient_id,))
-            regs = cursor.fetchall()
+            """, (patient_id,), keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                after=request.args.get('reg_after'))
 
             if table_exists(conn, 'medical_record'):
-                cursor.execute("""
-                    SELECT mr.main_complaint, mr.diagnosis, mr.create_time,
+                med_records, mr_next = seek(cursor, """
+                    SELECT mr.record_id, mr.reg_id, mr.main_complaint, mr.diagnosis, mr.create_time,
                            d.name AS doctor_name
                     FROM medical_record mr
                              JOIN registration r ON mr.reg_id = r.reg_id
                              JOIN doctor d ON r.doctor_id = d.doctor_id
                     WHERE r.patient_id=%s
-                    ORDER BY mr.create_time DESC
-                """, (patient_id,))
-                med_records = cursor.fetchall()
+                """, (patient_id,), keys=[('mr.create_time', 'create_time'), ('mr.reg_id', 'reg_id'),
+                                          ('mr.record_id', 'record_id')],
+                    after=request.args.get('mr_after'))
     finally:
         conn.close()
 
     return render_template('patient_detail.html',
                            patient=patient,
                            regs=regs,
-                           med_records=med_records)
+                           med_records=med_records,
+                           reg_pages=page_links('reg_after', reg_next),
+                           mr_pages=page_links('mr_after', mr_next))
 
 
 @patients_bp.route('/patient/profile', methods=['GET', 'POST'])
@@ -234,7 +231,7 @@ def patient_records():
     rows = []
     try:
         with conn.cursor() as cursor:
-            cursor.execute("""
+            rows, next_cursor = seek(cursor, """
                 SELECT r.reg_id, r.reg_time, r.visit_date, r.time_slot, r.shift,
                        r.visit_status, r.fee_status,
                        d.name AS doctor_name, dept.dept_name,
@@ -244,10 +241,9 @@ def patient_records():
                          JOIN department dept ON d.dept_id = dept.dept_id
                          LEFT JOIN medical_record mr ON mr.reg_id = r.reg_id
                 WHERE r.patient_id = %s
-                ORDER BY r.reg_time DESC
-            """, (patient_id,))
-            rows = cursor.fetchall()
+            """, (patient_id,), keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                after=request.args.get('after'))
     finally:
         conn.close()
 
-    return render_template('patient_visits.html', rows=rows)
+    return render_template('patient_visits.html', rows=rows, pages=page_links('after', next_cursor))
@@ -0,0 +1,182 @@
+"""
+患者检索索引：patient_search_token(token, patient_id)，替代 name/medical_record_no 的 LIKE '%kw%' 全表扫描。
+
+token 带类型前缀，统一小写：
+    n:<姓名子串>        姓名中长度不超过 NAME_GRAM 的所有连续子串
+    p:<全拼> / p:<首字母>  姓名拼音（需安装 pypinyin），按前缀匹配
+    s:<手机号后 k 位>     k = 4..手机号长度，精确匹配
+    m:<病历号>           按前缀匹配
+
+患者新建/修改时在同一事务内调用 index_patient()；全量重建：
+    python patient_search.py rebuild
+"""
+import re
+import sys
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:  # 未安装 pypinyin 时不建拼音 token
+    lazy_pinyin = None
+
+# 姓名子串 token 的最大长度；更长的关键字先用前 NAME_GRAM 个字符取候选，再按原文过滤
+NAME_GRAM = 4
+PHONE_SUFFIX_MIN = 4
+PREFIX_MIN = 4
+TOKEN_MAX_LEN = 64
+SEARCH_LIMIT = 200
+REBUILD_BATCH = 1000
+
+
+def _norm(text):
+    return re.sub(r'\s+', '', str(text or '')).lower()
+
+
+def _like_prefix(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def patient_tokens(name, phone, medical_record_no):
+    tokens = set()
+    name = _norm(name)
+    for i in range(len(name)):
+        for j in range(i + 1, min(len(name), i + NAME_GRAM) + 1):
+            tokens.add('n:' + name[i:j])
+    if name and lazy_pinyin is not None:
+        tokens.add('p:' + ''.join(lazy_pinyin(name)).lower())
+        tokens.add('p:' + ''.join(lazy_pinyin(name, style=Style.FIRST_LETTER)).lower())
+    phone = _norm(phone)
+    for k in range(PHONE_SUFFIX_MIN, len(phone) + 1):
+        tokens.add('s:' + phone[-k:])
+    mr_no = _norm(medical_record_no)
+    if mr_no:
+        tokens.add('m:' + mr_no)
+    return {t[:TOKEN_MAX_LEN] for t in tokens}
+
+
+def index_patient(conn, patient_id, name, phone, medical_record_no):
+    """重建单个患者的检索 token（先删后插），须与患者的 INSERT/UPDATE 处于同一事务。"""
+    tokens = sorted(patient_tokens(name, phone, medical_record_no))
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM patient_search_token WHERE patient_id=%s", (patient_id,))
+        if tokens:
+            cursor.executemany(
+                "INSERT IGNORE INTO patient_search_token (token, patient_id) VALUES (%s, %s)",
+                [(token, patient_id) for token in tokens]
+            )
+
+
+def _query_terms(keyword):
+    """关键字 -> [(条件 SQL, 参数)]，每个条件单独走 token 索引，结果取并集。"""
+    kw = _norm(keyword)
+    if len(kw) <= NAME_GRAM:
+        terms = [("t.token = %s", ['n:' + kw])]
+    else:
+        # 超过 NAME_GRAM 的关键字先按前缀子串取候选，再按原文过滤
+        terms = [("t.token = %s AND EXISTS (SELECT 1 FROM patient p2 WHERE p2.patient_id = t.patient_id "
+                  "AND p2.name LIKE %s)", ['n:' + kw[:NAME_GRAM], '%' + _like_prefix(keyword.strip())])]
+    # 前缀条件要求至少 2 个字母 / PREFIX_MIN 位，避免过短的前缀扫描大段索引
+    if re.fullmatch(r'[a-z]{2,}', kw) and lazy_pinyin is not None:
+        terms.append(("t.token LIKE %s", [_like_prefix('p:' + kw)]))
+    if kw.isdigit() and len(kw) >= PHONE_SUFFIX_MIN:
+        terms.append(("t.token = %s", ['s:' + kw]))
+        terms.append(("t.token LIKE %s", [_like_prefix('m:mr' + kw)]))
+    elif kw.startswith('mr') and len(kw) >= PREFIX_MIN:
+        terms.append(("t.token LIKE %s", [_like_prefix('m:' + kw)]))
+    return kw, terms
+
+
+def search_patients(conn, keyword, doctor_id=None, limit=SEARCH_LIMIT):
+    """
+    按关键字检索患者（姓名子串、拼音前缀、手机号后几位、病历号前缀），按 patient_id 倒序返回最多 limit 条。
+    指定 doctor_id 时只返回在该医生处挂过号的患者。
+    """
+    kw, terms = _query_terms(keyword)
+    if not kw:
+        return []
+    doctor_sql = ""
+    if doctor_id is not None:
+        doctor_sql = " AND EXISTS (SELECT 1 FROM registration r WHERE r.patient_id = t.patient_id AND r.doctor_id = %s)"
+    parts = []
+    args = []
+    for condition, values in terms:
+        parts.append(f"""
+            (SELECT t.patient_id FROM patient_search_token t
+             WHERE {condition}{doctor_sql}
+             ORDER BY t.patient_id DESC
+             LIMIT %s)""")
+        args.extend(values)
+        if doctor_id is not None:
+            args.append(doctor_id)
+        args.append(limit)
+    args.append(limit)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT p.patient_id, p.name, p.gender, p.age, p.phone, p.allergy, p.medical_record_no
+            FROM patient p
+                     JOIN ({' UNION '.join(parts)}) hit ON hit.patient_id = p.patient_id
+            ORDER BY p.patient_id DESC
+            LIMIT %s
+        """, args)
+        return cursor.fetchall()
+
+
+def rebuild(conn):
+    """按 patient_id 分批全量重建检索 token，每批一个事务，返回处理的患者数。"""
+    last_id = 0
+    total = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT patient_id, name, phone, medical_record_no
+                FROM patient
+                WHERE patient_id > %s
+                ORDER BY patient_id
+                LIMIT %s
+            """, (last_id, REBUILD_BATCH))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            ids = [row['patient_id'] for row in rows]
+            cursor.execute(f"""
+                DELETE FROM patient_search_token WHERE patient_id IN ({', '.join(['%s'] * len(ids))})
+            """, ids)
+            cursor.executemany(
+                "INSERT IGNORE INTO patient_search_token (token, patient_id) VALUES (%s, %s)",
+                [(token, row['patient_id'])
+                 for row in rows
+                 for token in sorted(patient_tokens(row['name'], row['phone'], row['medical_record_no']))]
+            )
+        conn.commit()
+        last_id = ids[-1]
+        total += len(rows)
+    # 已删除患者遗留的 token
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            DELETE t FROM patient_search_token t
+                LEFT JOIN patient p ON p.patient_id = t.patient_id
+            WHERE p.patient_id IS NULL
+        """)
+    conn.commit()
+    return total
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv != ['rebuild']:
+        print("用法：python patient_search.py rebuild")
+        return 2
+
+    import pymysql
+    from db import DB_CONFIG
+
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        total = rebuild(conn)
+        print(f"[patient_search] 已重建 {total} 位患者的检索索引")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
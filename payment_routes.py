@@ -1,7 +1,9 @@
 from datetime import date
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from db import get_db_connection, column_exists, log_operation
+from db import get_db_connection, column_exists, log_operation, settle_registrations, transaction
 from utils import require_admin
+from pagination import seek, page_links
+from idempotency import idempotent, discard
 
 payment_bp = Blueprint('cashier', __name__)
 
@@ -19,37 +21,35 @@ def cashier_page():
     conn = get_db_connection()
     rows = []
     totals = {'count': 0, 'amount': 0}
+    next_cursor = None
     try:
         with conn.cursor() as cursor:
-            sql = """
-                SELECT r.reg_id, r.reg_fee, IFNULL(r.check_fee, 0) AS check_fee,
+            where = " WHERE r.visit_date = %s"
+            params = [selected_date]
+            if status_filter == 'unpaid':
+                where += " AND r.fee_status = '未支付'"
+            elif status_filter == 'paid':
+                where += " AND r.fee_status = '已支付'"
+
+            rows, next_cursor = seek(cursor, """
+                SELECT r.reg_id, b.reg_fee, b.check_fee, b.med_fee, b.total_fee,
                        r.fee_status, r.visit_status, r.visit_date, r.shift, r.paid_time,
                        p.name AS patient_name, p.medical_record_no,
-                       d.name AS doctor_name,
-                       IFNULL((
-                            SELECT SUM(pr.total_amount) FROM prescription pr WHERE pr.reg_id = r.reg_id
-                       ), 0) AS med_fee
+                       d.name AS doctor_name
                 FROM registration r
+                    JOIN billing_ledger b ON b.reg_id = r.reg_id
                     JOIN patient p ON r.patient_id = p.patient_id
                     JOIN doctor d ON r.doctor_id = d.doctor_id
-                WHERE r.visit_date = %s
-            """
-            params = [selected_date]
-            if status_filter == 'unpaid':
-                sql += " AND r.fee_status = '未支付'"
-            elif status_filter == 'paid':
-                sql += " AND r.fee_status = '已支付'"
-            sql += " ORDER BY r.visit_date DESC, r.reg_id DESC"
-
-            cursor.execute(sql, params)
-            rows = cursor.fetchall()
-
-        # 计算合计
-        for r in rows:
-            total_fee = float(r['reg_fee']) + float(r['check_fee']) + float(r['med_fee'])
-            r['total_fee'] = total_fee
-            totals['count'] += 1
-            totals['amount'] += total_fee
+            """ + where, params, keys=[('r.reg_id', 'reg_id')], after=request.args.get('after'))
+
+            # 合计按当天全部记录计算，不受分页影响
+            cursor.execute("""
+                SELECT COUNT(*) AS cnt, IFNULL(SUM(b.total_fee), 0) AS amount
+                FROM registration r
+                    JOIN billing_ledger b ON b.reg_id = r.reg_id
+            """ + where, params)
+            agg = cursor.fetchone()
+            totals = {'count': agg['cnt'], 'amount': agg['amount']}
     finally:
         conn.close()
 
@@ -57,7 +57,8 @@ def cashier_page():
                            rows=rows,
                            selected_date=selected_date,
                            status_filter=status_filter,
-                           totals=totals)
+                           totals=totals,
+                           pages=page_links('after', next_cursor))
 
 
 @payment_bp.route('/cashier/pay/<int:reg_id>', methods=['POST'])
@@ -67,17 +68,16 @@ def cashier_pay(reg_id):
 
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
+        with transaction(conn), conn.cursor() as cursor:
             cursor.execute("SELECT visit_status FROM registration WHERE reg_id=%s", (reg_id,))
             reg = cursor.fetchone()
             if not reg or reg['visit_status'] == '已取消':
                 flash("已取消挂号不可支付", 'error')
                 return redirect(url_for('cashier.cashier_page'))
-            cursor.execute("""
-                UPDATE registration
-                SET fee_status='已支付', paid_time=NOW()
-                WHERE reg_id=%s
-            """, (reg_id,))
+            # 与批量收款同一条件更新：已支付的订单不会重复盖章 paid_time、重复计入统计
+            if not settle_registrations(conn, reg_ids=[reg_id])['reg_ids']:
+                flash("该订单已支付，无需重复操作", 'info')
+                return redirect(url_for('cashier.cashier_page'))
 
             # 记录日志
             log_operation(
@@ -89,16 +89,56 @@ def cashier_pay(reg_id):
                 target_id=reg_id,
                 detail=f"管理员确认支付：挂号ID {reg_id}"
             )
-        conn.commit()
         flash("支付状态已更新为已支付", 'success')
     except Exception as e:
-        conn.rollback()
         flash(f"支付更新失败：{e}", 'error')
     finally:
         conn.close()
     return redirect(url_for('cashier.cashier_page'))
 
 
+@payment_bp.route('/cashier/pay_batch', methods=['POST'])
+def cashier_pay_batch():
+    """
+    批量收款：结算勾选的挂号；scope=date 时结算所选日期全部未支付订单。一次事务、一条操作日志。
+    """
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+
+    selected_date = request.form.get('date') or date.today().isoformat()
+    status_filter = request.form.get('status', 'all')
+    reg_ids = request.form.getlist('reg_ids')
+    scope = request.form.get('scope')
+
+    conn = get_db_connection()
+    try:
+        with transaction(conn):
+            if scope == 'date':
+                result = settle_registrations(conn, visit_date=selected_date)
+            else:
+                result = settle_registrations(conn, reg_ids=reg_ids)
+            if result['reg_ids']:
+                log_operation(
+                    conn,
+                    operator_id=session.get('user_id'),
+                    operator_name=session.get('user_name'),
+                    operator_role=session.get('role'),
+                    op_type='批量支付',
+                    detail=f"管理员批量确认支付 {len(result['reg_ids'])} 笔，合计 ￥{result['amount']:.2f}，"
+                           f"挂号ID {','.join(str(r) for r in result['reg_ids'])}",
+                    # 批量结算的汇总记录与结算同事务落库
+                    durable=True,
+                )
+        if result['reg_ids']:
+            flash(f"已结算 {len(result['reg_ids'])} 笔，合计 ￥{result['amount']:.2f}", 'success')
+        else:
+            flash("没有需要结算的未支付订单", 'info')
+    except Exception as e:
+        flash(f"批量支付失败：{e}", 'error')
+    finally:
+        conn.close()
+    return redirect(url_for('cashier.cashier_page', date=selected_date, status=status_filter))
+
 # ============ 患者自助支付 ============ #
 
 
@@ -110,29 +150,38 @@ def patient_payments():
     patient_id = session.get('user_id')
     conn = get_db_connection()
     rows = []
+    next_cursor = None
+    outstanding = {'count': 0, 'amount': 0}
     try:
         with conn.cursor() as cursor:
             cursor.execute("""
+                SELECT COUNT(*) AS cnt, IFNULL(SUM(b.total_fee), 0) AS amount
+                FROM registration r
+                         JOIN billing_ledger b ON b.reg_id = r.reg_id
+                WHERE r.patient_id = %s AND r.fee_status = '未支付' AND r.visit_status != '已取消'
+            """, (patient_id,))
+            agg = cursor.fetchone()
+            outstanding = {'count': agg['cnt'], 'amount': agg['amount']}
+
+            rows, next_cursor = seek(cursor, """
                 SELECT r.reg_id, r.reg_time, r.visit_date, r.shift, r.fee_status, r.visit_status,
-                       r.reg_fee, IFNULL(r.check_fee, 0) AS check_fee,
-                       d.name AS doctor_name,
-                       IFNULL((SELECT SUM(pr.total_amount) FROM prescription pr WHERE pr.reg_id = r.reg_id), 0) AS med_fee
+                       b.reg_fee, b.check_fee, b.med_fee, b.total_fee,
+                       d.name AS doctor_name
                 FROM registration r
+                         JOIN billing_ledger b ON b.reg_id = r.reg_id
                          JOIN doctor d ON r.doctor_id = d.doctor_id
                 WHERE r.patient_id = %s
-                ORDER BY r.reg_time DESC
-            """, (patient_id,))
-            rows = cursor.fetchall()
-
-        for r in rows:
-            r['total_fee'] = float(r['reg_fee']) + float(r['check_fee']) + float(r['med_fee'])
+            """, (patient_id,), keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                after=request.args.get('after'))
     finally:
         conn.close()
 
-    return render_template('patient_payments.html', rows=rows)
+    return render_template('patient_payments.html', rows=rows, outstanding=outstanding,
+                           pages=page_links('after', next_cursor))
 
 
 @payment_bp.route('/patient/pay/<int:reg_id>', methods=['POST'])
+@idempotent
 def patient_pay(reg_id):
     if session.get('role') != 'patient':
         return redirect(url_for('auth.login'))
@@ -140,7 +189,7 @@ def patient_pay(reg_id):
     patient_id = session.get('user_id')
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
+        with transaction(conn), conn.cursor() as cursor:
             # 确认该挂号属于当前患者
             cursor.execute("SELECT patient_id, visit_status FROM registration WHERE reg_id=%s", (reg_id,))
             reg = cursor.fetchone()
@@ -151,15 +200,56 @@ def patient_pay(reg_id):
                 flash("已取消挂号不可支付", 'error')
                 return redirect(url_for('cashier.patient_payments'))
 
-            cursor.execute("""
-                UPDATE registration
-                SET fee_status='已支付', paid_time=NOW()
-                WHERE reg_id=%s
-            """, (reg_id,))
-        conn.commit()
+            if not settle_registrations(conn, reg_ids=[reg_id], patient_id=patient_id)['reg_ids']:
+                flash("该订单已支付，无需重复支付", 'info')
+                return redirect(url_for('cashier.patient_payments'))
         flash("支付成功", 'success')
+    except ValueError as e:
+        flash(f"支付失败：{e}", 'error')
+    except Exception as e:
+        # 暂时性错误不保存为幂等结果，同一令牌重试时重新执行
+        discard()
+        flash(f"支付失败：{e}", 'error')
+    finally:
+        conn.close()
+    return redirect(url_for('cashier.patient_payments'))
+
+
+@payment_bp.route('/patient/pay_all', methods=['POST'])
+@idempotent
+def patient_pay_all():
+    """
+    患者一键支付：结算本人勾选的订单，未勾选时结算本人全部未支付订单。
+    """
+    if session.get('role') != 'patient':
+        return redirect(url_for('auth.login'))
+
+    patient_id = session.get('user_id')
+    reg_ids = request.form.getlist('reg_ids') or None
+    conn = get_db_connection()
+    try:
+        with transaction(conn):
+            result = settle_registrations(conn, reg_ids=reg_ids, patient_id=patient_id)
+            if result['reg_ids']:
+                log_operation(
+                    conn,
+                    operator_id=patient_id,
+                    operator_name=session.get('user_name'),
+                    operator_role=session.get('role'),
+                    op_type='批量支付',
+                    detail=f"患者自助支付 {len(result['reg_ids'])} 笔，合计 ￥{result['amount']:.2f}，"
+                           f"挂号ID {','.join(str(r) for r in result['reg_ids'])}",
+                    durable=True,
+                )
+        if result['reg_ids']:
+            flash(f"支付成功，共 {len(result['reg_ids'])} 笔，合计 ￥{result['amount']:.2f}", 'success')
+        else:
+            flash("没有待支付的订单", 'info')
+    except ValueError as e:
+        flash(f"支付失败：{e}", 'error')
     except Exception as e:
-        conn.rollback()
+        # 暂时性错误不保存为幂等结果，同一令牌重试时重新执行
+        discard()
         flash(f"支付失败：{e}", 'error')
     finally:
         conn.close()
@@ -1,9 +1,15 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from db import get_db_connection
+from db import get_db_connection, get_medicines, dispense_registrations
+import medicine_catalog
+import stats_rollup
 from utils import require_admin
+from pagination import seek, page_links
 
 pharmacy_bp = Blueprint('pharmacy', __name__)
 
+# 批量发药时跳过的处方行最多列出几项
+SKIPPED_SHOWN = 5
+
 
 @pharmacy_bp.route('/pharmacy')
 def pharmacy_manage():
@@ -13,35 +19,43 @@ def pharmacy_manage():
     conn = get_db_connection()
     medicines = []
     pending_items = []
+    next_cursor = None
     try:
+        medicines = get_medicines(conn, descending=True)
         with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT med_id, med_name, price, stock
-                FROM medicine
-                ORDER BY med_id DESC
-            """)
-            medicines = cursor.fetchall()
-
-            # 待发药清单：已支付的处方，且未发药
-            cursor.execute("""
-                SELECT r.reg_id, p.name AS patient_name, p.medical_record_no,
-                       d.name AS doctor_name, r.visit_date, r.shift,
-                       pr.med_id, m.med_name, pr.total_quantity, pr.total_amount,
-                       pr.dispense_status
-                FROM prescription pr
-                         JOIN registration r ON pr.reg_id = r.reg_id
-                         JOIN patient p ON r.patient_id = p.patient_id
-                         JOIN doctor d ON r.doctor_id = d.doctor_id
-                         JOIN medicine m ON pr.med_id = m.med_id
+            # 待发药清单：已支付且有未发药处方的挂号，按挂号分页，每页再取这些挂号的处方明细
+            pending_regs, next_cursor = seek(cursor, """
+                SELECT r.reg_id, r.reg_time
+                FROM registration r
                 WHERE r.fee_status = '已支付'
-                  AND IFNULL(pr.dispense_status, '未发药') != '已发药'
-                ORDER BY r.reg_time DESC
-            """)
-            pending_items = cursor.fetchall()
+                  AND EXISTS (
+                      SELECT 1 FROM prescription pr
+                      WHERE pr.reg_id = r.reg_id AND IFNULL(pr.dispense_status, '未发药') != '已发药'
+                  )
+            """, (), keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')], after=request.args.get('after'))
+
+            if pending_regs:
+                reg_ids = [row['reg_id'] for row in pending_regs]
+                cursor.execute(f"""
+                    SELECT r.reg_id, p.name AS patient_name, p.medical_record_no,
+                           d.name AS doctor_name, r.visit_date, r.shift,
+                           pr.med_id, m.med_name, pr.total_quantity, pr.total_amount,
+                           pr.dispense_status
+                    FROM prescription pr
+                             JOIN registration r ON pr.reg_id = r.reg_id
+                             JOIN patient p ON r.patient_id = p.patient_id
+                             JOIN doctor d ON r.doctor_id = d.doctor_id
+                             JOIN medicine m ON pr.med_id = m.med_id
+                    WHERE r.reg_id IN ({', '.join(['%s'] * len(reg_ids))})
+                      AND IFNULL(pr.dispense_status, '未发药') != '已发药'
+                    ORDER BY r.reg_time DESC, r.reg_id DESC
+                """, reg_ids)
+                pending_items = cursor.fetchall()
     finally:
         conn.close()
 
-    return render_template('pharmacy_manage.html', medicines=medicines, pending_items=pending_items)
+    return render_template('pharmacy_manage.html', medicines=medicines, pending_items=pending_items,
+                           pages=page_links('after', next_cursor))
 
 
 @pharmacy_bp.route('/pharmacy/add', methods=['POST'])
@@ -60,6 +74,7 @@ def pharmacy_add():
                 INSERT INTO medicine (med_name, price, stock)
                 VALUES (%s, %s, %s)
             """, (med_name, price, stock))
+        medicine_catalog.mark_structure_changed(conn)
         conn.commit()
         flash("已添加新药品", 'success')
     except Exception as e:
@@ -85,6 +100,7 @@ def pharmacy_update():
             cursor.execute("""
                 UPDATE medicine SET price=%s, stock=%s WHERE med_id=%s
             """, (price, stock, med_id))
+        medicine_catalog.mark_changed(conn, [med_id])
         conn.commit()
         flash("药品信息已更新", 'success')
     except Exception as e:
@@ -104,6 +120,7 @@ def pharmacy_delete(med_id):
     try:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM medicine WHERE med_id=%s", (med_id,))
+        medicine_catalog.mark_structure_changed(conn)
         conn.commit()
         flash("药品已下架", 'success')
     except Exception as e:
@@ -129,7 +146,7 @@ def pharmacy_dispense():
     try:
         with conn.cursor() as cursor:
             # 校验是否已支付
-            cursor.execute("SELECT fee_status FROM registration WHERE reg_id=%s", (reg_id,))
+            cursor.execute("SELECT fee_status, visit_date FROM registration WHERE reg_id=%s", (reg_id,))
             reg = cursor.fetchone()
             if not reg or reg['fee_status'] != '已支付':
                 flash("未支付订单不可发药", 'error')
@@ -185,6 +202,8 @@ def pharmacy_dispense():
                 flash("处方状态已变化，已取消本次发药", 'error')
                 conn.rollback()
                 return redirect(url_for('pharmacy.pharmacy_manage'))
+            medicine_catalog.mark_changed(conn, [med_id])
+            stats_rollup.add_dispensed(conn, [(reg['visit_date'], int(med_id), qty)])
 
         conn.commit()
         flash("发药成功，库存已扣减", 'success')
@@ -195,3 +214,37 @@ def pharmacy_dispense():
         conn.close()
 
     return redirect(url_for('pharmacy.pharmacy_manage'))
+
+
+@pharmacy_bp.route('/pharmacy/dispense_batch', methods=['POST'])
+def pharmacy_dispense_batch():
+    """
+    整单/批量发药：对选中挂号的全部未发药处方一次性发药，反馈成功数与跳过的处方行（汇总为一条提示）。
+    """
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+
+    reg_ids = request.form.getlist('reg_ids')
+    if not reg_ids:
+        flash("请先选择要发药的挂号", 'error')
+        return redirect(url_for('pharmacy.pharmacy_manage'))
+
+    conn = get_db_connection()
+    try:
+        results = dispense_registrations(conn, reg_ids)
+        done = [r for r in results if r['ok']]
+        if done:
+            flash(f"发药成功 {len(done)} 项，库存已扣减", 'success')
+        skipped = [f"挂号 {r['reg_id']} · {r['med_name'] or r['med_id']}：{r['message']}"
+                   for r in results if not r['ok']]
+        if skipped:
+            more = f" 等（另有 {len(skipped) - SKIPPED_SHOWN} 项）" if len(skipped) > SKIPPED_SHOWN else ''
+            flash(f"跳过 {len(skipped)} 项：{'；'.join(skipped[:SKIPPED_SHOWN])}{more}", 'info')
+        if not results:
+            flash("未找到对应处方", 'error')
+    except Exception as e:
+        flash(f"发药失败：{e}", 'error')
+    finally:
+        conn.close()
+
+    return redirect(url_for('pharmacy.pharmacy_manage'))
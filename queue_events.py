@@ -0,0 +1,201 @@
+"""
+候诊队列变化推送：进程内一个发布者，按医生扇出给所有打开的工作台、按科室扇出给候诊区叫号屏
+（Server-Sent Events）。
+
+挂号/退号/恢复/叫号/接诊/完成问诊在事务提交后调用 db.publish_queue_change()，
+最终由 notify() 查一次变化的那一行、渲染一次表格行 HTML，再放进每个订阅者的队列；
+N 个打开的工作台共用这一份变化，不再各自轮询整张候诊列表。
+同一行同时更新 call_board 中的科室队列，再把科室的叫号屏数据推送给该科室的所有屏幕。
+
+订阅者队列有上限：消费跟不上（连接卡住）时不阻塞发布方，只标记溢出，
+该订阅者下一次读取得到 resync 事件，由页面整体刷新一次。
+
+注意：订阅关系保存在进程内存中，只有同一进程内的写操作会被推送；
+多进程/多机部署时各进程只能看到自己处理的请求。长连接会占用一个工作线程，
+需使用多线程（app.run(threaded=True)）或协程（gevent 等）服务器。
+"""
+import json
+import queue
+import threading
+
+from flask import get_template_attribute, has_request_context
+
+from call_board import CallBoard
+
+# 每个订阅者最多积压的事件数，超过后改发 resync
+MAX_PENDING = 100
+# 无事件时的心跳间隔（秒），防止代理/浏览器把空闲连接断开
+HEARTBEAT_SECONDS = 15
+# 浏览器断线后的重连间隔（毫秒）
+RETRY_MS = 3000
+
+# 与工作台候诊列表相同的列，notify() 取单行时复用
+ROW_SELECT = """
+    SELECT r.reg_id, r.doctor_id, r.dept_id, d.name AS doctor_name,
+           r.patient_id, p.name AS patient_name, p.gender, p.age,
+           p.medical_record_no, p.allergy, p.past_illness,
+           r.visit_status, r.queue_num, r.visit_date, r.shift, r.time_slot,
+           r.called_time, r.call_times
+    FROM registration r
+             JOIN patient p ON r.patient_id = p.patient_id
+             JOIN doctor d ON r.doctor_id = d.doctor_id
+"""
+ACTIVE_STATUSES = ('未就诊', '就诊中')
+
+
+class Subscription:
+    def __init__(self, channel, max_pending):
+        self.channel = channel
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=max_pending)
+
+    def offer(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """取下一条事件；超时返回 None，积压溢出后返回 resync。"""
+        if self.overflowed:
+            return {'type': 'resync'}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class QueueEventHub:
+    """按频道（如医生 ID）登记订阅者；publish 只做内存入队，不阻塞写请求。"""
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._published = 0
+        self._overflowed = 0
+
+    def subscribe(self, channel):
+        sub = Subscription(channel, self.max_pending)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._channels.get(sub.channel)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._channels[sub.channel]
+
+    def has_subscribers(self, channel=None):
+        with self._lock:
+            if channel is None:
+                return bool(self._channels)
+            return channel in self._channels
+
+    def publish(self, channel, event):
+        with self._lock:
+            subs = list(self._channels.get(channel, ()))
+            self._published += 1
+        for sub in subs:
+            was_overflowed = sub.overflowed
+            sub.offer(event)
+            if sub.overflowed and not was_overflowed:
+                with self._lock:
+                    self._overflowed += 1
+        return len(subs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'subscribers': sum(len(subs) for subs in self._channels.values()),
+                'published': self._published,
+                'overflowed': self._overflowed,
+            }
+
+
+_HUB = QueueEventHub()
+_BOARD = CallBoard()
+
+
+def subscribe(doctor_id):
+    return _HUB.subscribe(('doctor', doctor_id))
+
+
+def subscribe_board(dept_id):
+    return _HUB.subscribe(('dept', dept_id))
+
+
+def unsubscribe(sub):
+    _HUB.unsubscribe(sub)
+
+
+def board_view(conn, dept_id):
+    """科室叫号屏数据：[{doctor_id, doctor_name, current, next, waiting}]，见 call_board。"""
+    return _BOARD.view(conn, dept_id)
+
+
+def cached_board_view(dept_id):
+    return _BOARD.cached_view(dept_id)
+
+
+def _sort_key(row):
+    visit_date = row['visit_date']
+    return [visit_date.isoformat() if visit_date else '', row['time_slot'] or '', row['queue_num'] or 0]
+
+
+def notify(conn, reg_id, kind):
+    """
+    挂号 reg_id 的候诊状态变化（kind：booked/cancelled/restored/called/consult_started/consult_finished），
+    须在事务提交后调用。没有订阅者且没有已装载的叫号屏科室时直接返回，不查库。
+    工作台：仍在候诊中的行推送渲染好的 <tr>，已完成/已取消的推送删除；
+    叫号屏：更新科室队列后推送整个科室的叫号屏数据。
+    """
+    if not _HUB.has_subscribers() and not _BOARD.has_departments():
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(ROW_SELECT + " WHERE r.reg_id = %s", (reg_id,))
+        row = cursor.fetchone()
+    if not row:
+        return
+
+    doctors = _BOARD.apply(row)
+    if doctors is not None:
+        _HUB.publish(('dept', row['dept_id']), {'type': 'board', 'kind': kind, 'doctors': doctors})
+
+    channel = ('doctor', row['doctor_id'])
+    if not _HUB.has_subscribers(channel) or not has_request_context():
+        return
+    event = {'type': kind, 'reg_id': reg_id, 'html': None}
+    if row['visit_status'] in ACTIVE_STATUSES:
+        event['html'] = get_template_attribute('_queue_row.html', 'queue_row')(row)
+        event['sort'] = _sort_key(row)
+    _HUB.publish(channel, event)
+
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def stream(sub, initial=None, heartbeat=HEARTBEAT_SECONDS):
+    """
+    SSE 响应体生成器：先输出 initial（如有），再逐条输出事件，空闲时输出心跳注释；
+    连接断开或 resync 后注销订阅。
+    """
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        if initial is not None:
+            yield format_event(initial)
+        while True:
+            event = sub.get(heartbeat)
+            if event is None:
+                yield ": ping\n\n"
+                continue
+            yield format_event(event)
+            if event['type'] == 'resync':
+                return
+    finally:
+        _HUB.unsubscribe(sub)
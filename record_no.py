@@ -0,0 +1,73 @@
+import threading
+from datetime import datetime
+
+
+class MedicalRecordNoGenerator:
+    """
+    病历号生成器：MR + yyyyMMdd + 当日序号。
+
+    序号来自 medical_record_seq 表的按日计数行，不读取 patient 表。
+    每次向数据库申请 block_size 个连续序号并缓存在进程内，用完或跨天再申请；
+    申请使用生成器自己的一条数据库连接（connect() 创建，断开后重建），不占用连接池，
+    在其上立即提交，计数行锁只持有一条语句的时间。
+    号段内取号只持有进程内锁；申请新号段时另用 _reserve_lock 串行，不阻塞仍有余号的取号。
+    同一进程内序号严格递增，不同进程各自持有互不重叠的号段。
+    """
+
+    def __init__(self, connect, block_size=10):
+        self._connect = connect
+        self.block_size = max(1, int(block_size))
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._conn = None
+        self._day = None
+        self._next = 0
+        self._end = -1
+
+    def _reserve_block(self, day):
+        """在 _reserve_lock 内调用。"""
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            self._conn.ping(reconnect=True)
+            with self._conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO medical_record_seq (seq_date, last_no)
+                    VALUES (%s, LAST_INSERT_ID(%s))
+                    ON DUPLICATE KEY UPDATE last_no = LAST_INSERT_ID(last_no + %s)
+                """, (day, self.block_size, self.block_size))
+                end = cursor.lastrowid
+            self._conn.commit()
+        except Exception:
+            conn, self._conn = self._conn, None
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        return end - self.block_size + 1, end
+
+    def _take(self, day):
+        """在 _lock 内调用：当日号段有余号时取一个，否则返回 None。"""
+        if self._day != day or self._next > self._end:
+            return None
+        seq = self._next
+        self._next += 1
+        return seq
+
+    def next_no(self):
+        while True:
+            now = datetime.now()
+            day = now.strftime('%Y-%m-%d')
+            with self._lock:
+                seq = self._take(day)
+            if seq is not None:
+                return f"MR{now.strftime('%Y%m%d')}{str(seq).zfill(4)}"
+            with self._reserve_lock:
+                # 等待期间其它线程可能已申请到新号段
+                with self._lock:
+                    refilled = self._day == day and self._next <= self._end
+                if not refilled:
+                    start, end = self._reserve_block(day)
+                    with self._lock:
+                        self._day, self._next, self._end = day, start, end
@@ -0,0 +1,75 @@
+import threading
+import time
+
+
+class ReferenceDataCache:
+    """
+    科室/医生参考数据的进程内缓存。
+
+    首次使用或超过 ttl 秒后整体重新加载一次，并预先构建常用视图
+    （在岗医生列表、按科室分组、各科室医生数）；本进程内修改 doctor/department
+    后调用 invalidate() 立即失效，其他进程最迟在 ttl 后刷新。
+    返回的快照在多个请求间共享，调用方只读不改。
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._generation += 1
+
+    def get(self, conn):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return snapshot
+        with self._lock:
+            generation = self._generation
+        snapshot = self._load(conn)
+        with self._lock:
+            # 加载期间若已被失效，本次结果只给当前调用方用，不写回缓存
+            if generation == self._generation:
+                self._snapshot = snapshot
+                self._loaded_at = time.monotonic()
+        return snapshot
+
+    def _load(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT dept_id, dept_name FROM department ORDER BY dept_name")
+            departments = cursor.fetchall()
+            cursor.execute("""
+                SELECT d.doctor_id, d.name, d.title, d.reg_fee, d.phone, d.status, d.dept_id, dept.dept_name
+                FROM doctor d
+                         JOIN department dept ON d.dept_id = dept.dept_id
+                ORDER BY dept.dept_name, d.name
+            """)
+            all_doctors = cursor.fetchall()
+
+        doctors = [doc for doc in all_doctors if doc['status'] == '正常']
+        grouped = {}
+        for doc in doctors:
+            grouped.setdefault(doc['dept_id'], []).append(doc)
+        doctors_by_dept = [
+            {'dept_id': dept['dept_id'], 'dept_name': dept['dept_name'], 'doctors': grouped[dept['dept_id']]}
+            for dept in departments if dept['dept_id'] in grouped
+        ]
+        counts = {}
+        for doc in all_doctors:
+            counts[doc['dept_id']] = counts.get(doc['dept_id'], 0) + 1
+        dept_doctor_counts = [
+            {'dept_name': dept['dept_name'], 'doctor_count': counts.get(dept['dept_id'], 0)}
+            for dept in departments
+        ]
+        return {
+            'departments': departments,
+            'all_doctors': all_doctors,
+            'doctors': doctors,
+            'doctors_by_dept': doctors_by_dept,
+            'dept_doctor_counts': dept_doctor_counts,
+            'doctor_by_id': {doc['doctor_id']: doc for doc in all_doctors},
+        }
@@ -1,15 +1,30 @@
-from datetime import date
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from datetime import date, datetime, timedelta
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
 from db import (
+    admit_booking,
     get_db_connection,
-    fetch_departments_and_doctors,
+    get_availability,
+    get_schedule_date_column,
+    get_reference_data,
     create_registration_record,
     generate_medical_record_no,
     update_schedule_booked,
-    column_exists,
+    get_table_columns,
+    invalidate_availability,
     log_operation,
+    publish_queue_change,
+    reopen_booking,
+    transaction,
 )
 from utils import require_admin
+from pagination import seek, page_links
+from availability import MAX_DAYS
+from booking_gate import RetryLater
+from idempotency import idempotent, discard
+import schedule_templates
+import billing
+import patient_search
+import stats_rollup
 
 reg_bp = Blueprint('registration', __name__)
 
@@ -30,27 +45,24 @@ def _guess_shift(time_slot: str) -> str:
         return '全天'
 
 
+def _parse_date(value, default):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return default
+
+
 @reg_bp.route('/patient_home')
 def patient_home():
     if session.get('role') != 'patient':
         return redirect(url_for('auth.login'))
 
     conn = get_db_connection()
-    doctors = []
-    departments = []
-    doctors_by_dept = []
     my_regs = []
+    next_cursor = None
     try:
+        ref = get_reference_data(conn)
         with conn.cursor() as cursor:
-            cursor.execute("""
-                  SELECT d.doctor_id, d.name, d.title, d.reg_fee, dept.dept_name, d.status
-                  FROM doctor d
-                           JOIN department dept ON d.dept_id = dept.dept_id
-                  WHERE d.status = '正常'
-                  ORDER BY dept.dept_name, d.name
-                  """)
-            doctors = cursor.fetchall()
-
             my_sql = """
                      SELECT r.reg_id, r.queue_num, r.visit_status, r.reg_time,
                             r.visit_date, r.shift, r.time_slot, r.fee_status,
@@ -58,39 +70,28 @@ def patient_home():
                      FROM registration r
                               JOIN doctor d ON r.doctor_id = d.doctor_id
                      WHERE r.patient_id = %s
-                     ORDER BY r.reg_time DESC
                      """
-            cursor.execute(my_sql, (session['user_id'],))
-            my_regs = cursor.fetchall()
-            cursor.execute("SELECT dept_name FROM department ORDER BY dept_name")
-            departments = cursor.fetchall()
+            my_regs, next_cursor = seek(cursor, my_sql, (session['user_id'],),
+                                        keys=[('r.reg_time', 'reg_time'), ('r.reg_id', 'reg_id')],
+                                        after=request.args.get('after'))
     finally:
         conn.close()
 
-    dept_map = {}
-    for doc in doctors:
-        dept_map.setdefault(doc['dept_name'], []).append(doc)
-    for dept in departments:
-        name = dept['dept_name']
-        if name in dept_map:
-            doctors_by_dept.append({'dept_name': name, 'doctors': dept_map[name]})
-    for name, dept_docs in dept_map.items():
-        if not any(d['dept_name'] == name for d in departments):
-            doctors_by_dept.append({'dept_name': name, 'doctors': dept_docs})
-
     return render_template(
         'patient_home.html',
         patient_name=session['user_name'],
-        doctors=doctors,
-        departments=departments,
-        doctors_by_dept=doctors_by_dept,
+        doctors=ref['doctors'],
+        departments=ref['departments'],
+        doctors_by_dept=ref['doctors_by_dept'],
         my_regs=my_regs,
+        my_regs_pages=page_links('after', next_cursor),
         time_slots=TIME_SLOTS,
         today=date.today().isoformat()
     )
 
 
 @reg_bp.route('/book_appointment/<int:doctor_id>', methods=['POST', 'GET'])
+@idempotent
 def book_appointment(doctor_id):
     if session.get('role') != 'patient':
         return redirect(url_for('auth.login'))
@@ -100,33 +101,85 @@ def book_appointment(doctor_id):
     time_slot = request.form.get('time_slot') or TIME_SLOTS[0]
     shift = request.form.get('shift') or _guess_shift(time_slot)
 
-    conn = get_db_connection()
+    # 放号高峰时同一号源的预约先在进程内排队，轮到后才借连接；号源已满/排队过长时直接返回
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT dept_id, reg_fee FROM doctor WHERE doctor_id=%s", (doctor_id,))
-            doc_info = cursor.fetchone()
-            if not doc_info:
-                flash("医生不存在", 'error')
-                return redirect(url_for('registration.patient_home'))
-
-        create_registration_record(
-            conn,
-            patient_id=patient_id,
-            doctor_id=doctor_id,
-            dept_id=doc_info['dept_id'],
-            visit_date=visit_date,
-            shift=shift,
-            time_slot=time_slot,
-            fee_status='未支付'
-        )
+        with admit_booking(doctor_id, visit_date, time_slot):
+            conn = get_db_connection()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT dept_id, reg_fee FROM doctor WHERE doctor_id=%s", (doctor_id,))
+                    doc_info = cursor.fetchone()
+                    if not doc_info:
+                        flash("医生不存在", 'error')
+                        return redirect(url_for('registration.patient_home'))
+
+                create_registration_record(
+                    conn,
+                    patient_id=patient_id,
+                    doctor_id=doctor_id,
+                    dept_id=doc_info['dept_id'],
+                    visit_date=visit_date,
+                    shift=shift,
+                    time_slot=time_slot,
+                    fee_status='未支付'
+                )
+            finally:
+                conn.close()
         flash("挂号成功，请按时就诊", 'success')
+    except RetryLater as e:
+        # 暂时性拒绝不保存为幂等结果，同一次提交稍后可以重试
+        discard()
+        flash(str(e), 'info')
+    except ValueError as e:
+        # 业务拒绝（号源已满、停诊等）结果确定，保存后重复提交直接重放
+        flash(f"挂号失败：{e}", 'error')
     except Exception as e:
-        conn.rollback()
+        # 连接池超时、锁等待/死锁等暂时性错误不保存，同一令牌重试时重新执行
+        discard()
         flash(f"挂号失败：{e}", 'error')
+
+    return redirect(url_for('registration.patient_home'))
+
+
+@reg_bp.route('/registration/availability')
+def slot_availability():
+    """
+    号源余量（JSON）：?start=YYYY-MM-DD&end=YYYY-MM-DD（默认今天，最多 MAX_DAYS 天），
+    可选 dept_id / doctor_id 过滤，返回在岗医生每天每个时间段的剩余号数。
+    """
+    if not session.get('role'):
+        return jsonify(error='unauthorized'), 403
+
+    start = _parse_date(request.args.get('start'), date.today())
+    end = _parse_date(request.args.get('end'), start)
+    if end < start:
+        return jsonify(error='结束日期不能早于开始日期'), 400
+    if (end - start).days >= MAX_DAYS:
+        return jsonify(error=f'查询区间不能超过 {MAX_DAYS} 天'), 400
+    dept_id = request.args.get('dept_id', type=int)
+    doctor_id = request.args.get('doctor_id', type=int)
+
+    conn = get_db_connection()
+    try:
+        doctors = [
+            doc for doc in get_reference_data(conn)['doctors']
+            if (dept_id is None or doc['dept_id'] == dept_id)
+            and (doctor_id is None or doc['doctor_id'] == doctor_id)
+        ]
+        slots = get_availability(conn, [doc['doctor_id'] for doc in doctors], start, end, TIME_SLOTS, _guess_shift)
     finally:
         conn.close()
 
-    return redirect(url_for('registration.patient_home'))
+    return jsonify(
+        start=start.isoformat(),
+        end=end.isoformat(),
+        time_slots=TIME_SLOTS,
+        doctors=[
+            {'doctor_id': doc['doctor_id'], 'name': doc['name'], 'dept_id': doc['dept_id'],
+             'days': slots[doc['doctor_id']]}
+            for doc in doctors
+        ],
+    )
 
 
 @reg_bp.route('/registration/manage')
@@ -145,7 +198,9 @@ def registration_manage():
     schedules = []
     dept_doctors = []
     try:
-        departments, doctors = fetch_departments_and_doctors(conn)
+        ref = get_reference_data(conn)
+        departments, doctors = ref['departments'], ref['doctors']
+        dept_doctors = ref['dept_doctor_counts']
         with conn.cursor() as cursor:
             cursor.execute("""
                 SELECT r.reg_id, r.queue_num, r.visit_status, r.visit_date, r.shift, r.time_slot, r.fee_status,
@@ -177,13 +232,14 @@ def registration_manage():
             """, (selected_date,))
             totals = cursor.fetchone()
 
-            has_date = column_exists(conn, 'doctor_schedule', 'schedule_date')
-            has_work_date = column_exists(conn, 'doctor_schedule', 'work_date')
-            has_shift = column_exists(conn, 'doctor_schedule', 'shift')
-            has_time_slot = column_exists(conn, 'doctor_schedule', 'time_slot')
-            has_max = column_exists(conn, 'doctor_schedule', 'max_slots')
-            has_booked = column_exists(conn, 'doctor_schedule', 'booked_slots')
-            has_status = column_exists(conn, 'doctor_schedule', 'status')
+            schedule_cols = get_table_columns(conn, 'doctor_schedule')
+            has_date = 'schedule_date' in schedule_cols
+            has_work_date = 'work_date' in schedule_cols
+            has_shift = 'shift' in schedule_cols
+            has_time_slot = 'time_slot' in schedule_cols
+            has_max = 'max_slots' in schedule_cols
+            has_booked = 'booked_slots' in schedule_cols
+            has_status = 'status' in schedule_cols
 
             if has_date:
                 col_date = "s.schedule_date"
@@ -215,15 +271,6 @@ def registration_manage():
 
             cursor.execute(schedule_sql)
             schedules = cursor.fetchall()
-
-            cursor.execute("""
-                SELECT dept.dept_name, COUNT(d.doctor_id) AS doctor_count
-                FROM department dept
-                         LEFT JOIN doctor d ON d.dept_id = dept.dept_id
-                GROUP BY dept.dept_name
-                ORDER BY dept.dept_name
-            """)
-            dept_doctors = cursor.fetchall()
     finally:
         conn.close()
 
@@ -259,18 +306,20 @@ def registration_new_patient():
 
     conn = get_db_connection()
     try:
-        mr_no = generate_medical_record_no(conn)
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO patient (name, gender, age, phone, allergy, medical_record_no, password)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (name, gender, age, phone, allergy, mr_no, '123456'))
-            patient_id = cursor.lastrowid
+        mr_no = generate_medical_record_no()
+        # 建档与挂号在同一事务内：任一步失败都不会留下半条数据
+        with transaction(conn):
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO patient (name, gender, age, phone, allergy, medical_record_no, password)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """, (name, gender, age, phone, allergy, mr_no, '123456'))
+                patient_id = cursor.lastrowid
+            patient_search.index_patient(conn, patient_id, name, phone, mr_no)
 
-        create_registration_record(conn, patient_id, doctor_id, dept_id, visit_date, shift, time_slot, fee_status='未支付')
+            create_registration_record(conn, patient_id, doctor_id, dept_id, visit_date, shift, time_slot, fee_status='未支付')
         flash(f"新患者挂号成功，病历号：{mr_no}", 'success')
     except Exception as e:
-        conn.rollback()
         flash(f"挂号失败：{e}", 'error')
     finally:
         conn.close()
@@ -322,9 +371,9 @@ def registration_cancel(reg_id):
     visit_date = None
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
+        with transaction(conn), conn.cursor() as cursor:
             cursor.execute("""
-                SELECT r.visit_status, r.schedule_id, r.visit_date, p.name as patient_name
+                SELECT r.visit_status, r.schedule_id, r.doctor_id, r.visit_date, r.time_slot, p.name as patient_name
                 FROM registration r
                 JOIN patient p ON r.patient_id = p.patient_id
                 WHERE r.reg_id=%s
@@ -351,19 +400,23 @@ def registration_cancel(reg_id):
                 return redirect(url_for('registration.registration_manage', date=visit_date))
 
             # 1. 更新订单状态
-            if reg['visit_status'] == '未就诊':
-                # 如果已支付，则标记为已退款（或由财务流程处理，这里演示标记为已退款）
-                cursor.execute("""
-                    UPDATE registration 
-                    SET visit_status='已取消', 
-                        fee_status = CASE WHEN fee_status='已支付' THEN '已退款' ELSE fee_status END
-                    WHERE reg_id=%s
-                """, (reg_id,))
-            else:
-                cursor.execute("UPDATE registration SET visit_status='已取消' WHERE reg_id=%s", (reg_id,))
+            with stats_rollup.track_registrations(conn, [reg_id]):
+                if reg['visit_status'] == '未就诊':
+                    # 如果已支付，则标记为已退款（或由财务流程处理，这里演示标记为已退款）
+                    cursor.execute("""
+                        UPDATE registration
+                        SET visit_status='已取消',
+                            fee_status = CASE WHEN fee_status='已支付' THEN '已退款' ELSE fee_status END
+                        WHERE reg_id=%s
+                    """, (reg_id,))
+                    billing.record_refund(conn, [reg_id])
+                else:
+                    cursor.execute("UPDATE registration SET visit_status='已取消' WHERE reg_id=%s", (reg_id,))
             
             # 2. 释放号源
-            update_schedule_booked(conn, reg['schedule_id'], -1)
+            update_schedule_booked(conn, reg['schedule_id'], -1, reg['visit_date'])
+            reopen_booking(conn, reg['doctor_id'], reg['visit_date'], reg['time_slot'])
+            publish_queue_change(conn, reg_id, 'cancelled')
             
             # 3. 记录操作日志
             log_operation(
@@ -375,11 +428,8 @@ def registration_cancel(reg_id):
                 target_id=reg_id,
                 detail=f"管理员退号：患者 {reg['patient_name']}，挂号ID {reg_id}。原状态：{reg['visit_status']}"
             )
-            
-        conn.commit()
         flash("已成功退号，号源已释放", 'success')
     except Exception as e:
-        conn.rollback()
         flash(f"操作失败：{e}", 'error')
     finally:
         conn.close()
@@ -394,7 +444,7 @@ def registration_restore(reg_id):
     visit_date = None
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
+        with transaction(conn), conn.cursor() as cursor:
             cursor.execute("""
                 SELECT r.visit_status, r.schedule_id, r.visit_date, p.name as patient_name
                 FROM registration r
@@ -410,7 +460,8 @@ def registration_restore(reg_id):
                 flash("当前状态不可恢复", 'info')
                 return redirect(url_for('registration.registration_manage', date=visit_date))
 
-            cursor.execute("UPDATE registration SET visit_status='未就诊' WHERE reg_id=%s", (reg_id,))
+            with stats_rollup.track_registrations(conn, [reg_id]):
+                cursor.execute("UPDATE registration SET visit_status='未就诊' WHERE reg_id=%s", (reg_id,))
             
             # 记录日志
             log_operation(
@@ -422,11 +473,11 @@ def registration_restore(reg_id):
                 target_id=reg_id,
                 detail=f"管理员恢复挂号：患者 {reg['patient_name']}，挂号ID {reg_id}"
             )
-            
-        update_schedule_booked(conn, reg['schedule_id'], 1)
+
+            update_schedule_booked(conn, reg['schedule_id'], 1, reg['visit_date'])
+            publish_queue_change(conn, reg_id, 'restored')
         flash("已恢复挂号", 'success')
     except Exception as e:
-        conn.rollback()
         flash(f"操作失败：{e}", 'error')
     finally:
         conn.close()
@@ -448,10 +499,11 @@ def schedule_save():
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
+            schedule_cols = get_table_columns(conn, 'doctor_schedule')
             date_cols = []
-            if column_exists(conn, 'doctor_schedule', 'schedule_date'):
+            if 'schedule_date' in schedule_cols:
                 date_cols.append('schedule_date')
-            if column_exists(conn, 'doctor_schedule', 'work_date'):
+            if 'work_date' in schedule_cols:
                 date_cols.append('work_date')
             if not date_cols:
                 date_cols.append('schedule_date')
@@ -468,6 +520,8 @@ def schedule_save():
                 [doctor_id] + [schedule_date] * len(date_cols) + [shift, time_slot, max_slots, 0, status]
             )
         conn.commit()
+        invalidate_availability(conn, schedule_date)
+        reopen_booking(conn, doctor_id, schedule_date, time_slot)
         flash("排班已保存", 'success')
     except Exception as e:
         conn.rollback()
@@ -477,6 +531,114 @@ def schedule_save():
     return redirect(url_for('registration.registration_manage', date=schedule_date))
 
 
+@reg_bp.route('/schedule/template', methods=['GET', 'POST'])
+def schedule_template():
+    """
+    医生周排班模板：周几 × 时间段 的号源数（留空表示不排班），可将某天整天设为停诊。
+    """
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+
+    doctor_id = request.values.get('doctor_id', type=int)
+    conn = get_db_connection()
+    try:
+        doctors = get_reference_data(conn)['doctors']
+        if doctor_id is None and doctors:
+            doctor_id = doctors[0]['doctor_id']
+
+        if request.method == 'POST':
+            if doctor_id not in {doc['doctor_id'] for doc in doctors}:
+                flash("请选择在岗医生", 'error')
+                return redirect(url_for('registration.schedule_template'))
+            entries = []
+            for weekday in range(len(schedule_templates.WEEKDAYS)):
+                if request.form.get(f'stop_{weekday}'):
+                    entries.extend((weekday, '全天', slot, 0, '停诊') for slot in TIME_SLOTS)
+                    continue
+                for i, slot in enumerate(TIME_SLOTS):
+                    value = (request.form.get(f'cap_{weekday}_{i}') or '').strip()
+                    if not value:
+                        continue
+                    try:
+                        max_slots = int(value)
+                    except ValueError:
+                        max_slots = 0
+                    if max_slots <= 0:
+                        flash(f"{schedule_templates.WEEKDAYS[weekday]} {slot} 的号源数必须为正整数", 'error')
+                        return redirect(url_for('registration.schedule_template', doctor_id=doctor_id))
+                    entries.append((weekday, _guess_shift(slot), slot, max_slots, '可用'))
+            with transaction(conn):
+                schedule_templates.save_template(conn, doctor_id, entries)
+            flash("排班模板已保存", 'success')
+            return redirect(url_for('registration.schedule_template', doctor_id=doctor_id))
+
+        template = schedule_templates.load_template(conn, doctor_id) if doctor_id else {}
+    finally:
+        conn.close()
+
+    stop_days = {weekday for (weekday, _), row in template.items() if row['status'] == '停诊'}
+    return render_template(
+        'schedule_template.html',
+        doctors=doctors,
+        doctor_id=doctor_id,
+        template=template,
+        stop_days=stop_days,
+        weekdays=schedule_templates.WEEKDAYS,
+        time_slots=TIME_SLOTS,
+        today=date.today(),
+        default_end=date.today() + timedelta(days=30),
+        max_apply_days=schedule_templates.MAX_APPLY_DAYS,
+    )
+
+
+@reg_bp.route('/schedule/apply', methods=['POST'])
+def schedule_apply():
+    """
+    按周模板批量生成排班：所选医生（留空为全部在岗医生）× 日期区间，一个事务内分批写入。
+    """
+    if not require_admin():
+        return redirect(url_for('auth.login'))
+
+    start = _parse_date(request.form.get('start'), None)
+    end = _parse_date(request.form.get('end'), None)
+    overwrite = bool(request.form.get('overwrite'))
+    selected = {int(d) for d in request.form.getlist('doctor_ids') if d.isdigit()}
+    if not start or not end or end < start:
+        flash("请填写正确的起止日期", 'error')
+        return redirect(url_for('registration.schedule_template'))
+    if (end - start).days >= schedule_templates.MAX_APPLY_DAYS:
+        flash(f"单次最多生成 {schedule_templates.MAX_APPLY_DAYS} 天的排班", 'error')
+        return redirect(url_for('registration.schedule_template'))
+
+    conn = get_db_connection()
+    try:
+        doctor_ids = [doc['doctor_id'] for doc in get_reference_data(conn)['doctors']
+                      if not selected or doc['doctor_id'] in selected]
+        with transaction(conn):
+            counts = schedule_templates.apply_templates(
+                conn, get_schedule_date_column(conn), get_table_columns(conn, 'doctor_schedule'),
+                doctor_ids, start, end, overwrite=overwrite,
+            )
+            invalidate_availability(conn)
+            reopen_booking(conn)
+            log_operation(
+                conn,
+                operator_id=session.get('user_id'),
+                operator_name=session.get('user_name'),
+                operator_role=session.get('role'),
+                op_type='批量排班',
+                detail=f"{start} 至 {end}，医生 {len(doctor_ids)} 位：新增 {counts['inserted']}，"
+                       f"更新 {counts['updated']}，跳过 {counts['skipped']}",
+            )
+        flash(f"排班已生成：新增 {counts['inserted']} 条，更新 {counts['updated']} 条，跳过 {counts['skipped']} 条",
+              'success')
+    except Exception as e:
+        flash(f"批量排班失败：{e}", 'error')
+    finally:
+        conn.close()
+    return redirect(url_for('registration.registration_manage', date=start.isoformat(), _anchor='sec-schedule'))
+
+
 @reg_bp.route('/schedule/status/<int:schedule_id>/<string:new_status>')
 def schedule_status(schedule_id, new_status):
     if not require_admin():
@@ -484,9 +646,19 @@ def schedule_status(schedule_id, new_status):
 
     conn = get_db_connection()
     try:
+        date_col = get_schedule_date_column(conn) or 'schedule_date'
         with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT doctor_id, {date_col} AS schedule_date, time_slot
+                FROM doctor_schedule
+                WHERE schedule_id=%s
+            """, (schedule_id,))
+            schedule = cursor.fetchone()
             cursor.execute("UPDATE doctor_schedule SET status=%s WHERE schedule_id=%s", (new_status, schedule_id))
         conn.commit()
+        if schedule:
+            invalidate_availability(conn, schedule['schedule_date'])
+            reopen_booking(conn, schedule['doctor_id'], schedule['schedule_date'], schedule['time_slot'])
         flash("排班状态已更新", 'success')
     except Exception as e:
         conn.rollback()
@@ -0,0 +1,113 @@
+"""
+按周排班模板：schedule_template 为每位医生保存 周几 × 时间段 的号源数与状态，
+apply_templates() 把模板批量展开到一段日期的 doctor_schedule。
+
+展开时先一次读出区间内已有的排班行（FOR UPDATE），逐行比较后分为
+新增 / 更新 / 跳过（内容相同，或 overwrite=False 时已存在），
+再用多行 INSERT ... ON DUPLICATE KEY UPDATE 分批写入，整个过程一个事务。
+"""
+from datetime import timedelta
+
+WEEKDAYS = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+# 单次展开最多覆盖的天数
+MAX_APPLY_DAYS = 92
+# 每条多行 INSERT 的行数
+UPSERT_BATCH = 500
+
+
+def load_template(conn, doctor_id):
+    """返回 {(weekday, time_slot): row}。"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT weekday, shift, time_slot, max_slots, status
+            FROM schedule_template
+            WHERE doctor_id=%s
+        """, (doctor_id,))
+        return {(row['weekday'], row['time_slot']): row for row in cursor.fetchall()}
+
+
+def save_template(conn, doctor_id, entries):
+    """
+    整体替换医生的周模板。entries 为 [(weekday, shift, time_slot, max_slots, status)]；
+    停诊日按 shift='全天'、status='停诊' 写入该日每个时间段。须在调用方事务内执行。
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM schedule_template WHERE doctor_id=%s", (doctor_id,))
+        if entries:
+            cursor.executemany("""
+                INSERT INTO schedule_template (doctor_id, weekday, shift, time_slot, max_slots, status)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, [(doctor_id,) + tuple(entry) for entry in entries])
+
+
+def _date_cols(columns):
+    """排班表的日期列：新旧库可能同时有 schedule_date 与 work_date，两列都写。"""
+    cols = [c for c in ('schedule_date', 'work_date') if c in columns]
+    return cols or ['schedule_date']
+
+
+def apply_templates(conn, date_col, table_columns, doctor_ids, start, end, overwrite=True):
+    """
+    把 doctor_ids 的周模板展开到 [start, end]，返回 {'inserted', 'updated', 'skipped'}。
+    date_col 为查询用的排班日期列，table_columns 为 doctor_schedule 的列集合。
+    已有排班的 booked_slots 保持不变。须在调用方事务内执行。
+    """
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    doctor_ids = sorted({int(d) for d in doctor_ids})
+    if not doctor_ids or end < start:
+        return counts
+    placeholders = ', '.join(['%s'] * len(doctor_ids))
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT doctor_id, weekday, shift, time_slot, max_slots, status
+            FROM schedule_template
+            WHERE doctor_id IN ({placeholders})
+        """, doctor_ids)
+        templates = {}
+        for row in cursor.fetchall():
+            templates.setdefault((row['doctor_id'], row['weekday']), []).append(row)
+        if not templates:
+            return counts
+
+        cursor.execute(f"""
+            SELECT doctor_id, {date_col} AS schedule_date, shift, time_slot, max_slots, status
+            FROM doctor_schedule
+            WHERE {date_col} BETWEEN %s AND %s
+              AND doctor_id IN ({placeholders})
+            FOR UPDATE
+        """, [start, end] + doctor_ids)
+        existing = {(row['doctor_id'], row['schedule_date'], row['time_slot']): row for row in cursor.fetchall()}
+
+        rows = []
+        day = start
+        while day <= end:
+            for doctor_id in doctor_ids:
+                for tpl in templates.get((doctor_id, day.weekday()), ()):
+                    old = existing.get((doctor_id, day, tpl['time_slot']))
+                    if old is not None:
+                        same = (old['shift'], int(old['max_slots']), old['status']) == \
+                               (tpl['shift'], int(tpl['max_slots']), tpl['status'])
+                        if same or not overwrite:
+                            counts['skipped'] += 1
+                            continue
+                        counts['updated'] += 1
+                    else:
+                        counts['inserted'] += 1
+                    rows.append((doctor_id, day, tpl['shift'], tpl['time_slot'], tpl['max_slots'], tpl['status']))
+            day += timedelta(days=1)
+
+        date_cols = _date_cols(table_columns)
+        columns = ['doctor_id'] + date_cols + ['shift', 'time_slot', 'max_slots', 'booked_slots', 'status']
+        row_sql = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        for i in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[i:i + UPSERT_BATCH]
+            params = []
+            for doctor_id, day, shift, time_slot, max_slots, status in batch:
+                params.extend([doctor_id] + [day] * len(date_cols) + [shift, time_slot, max_slots, 0, status])
+            cursor.execute(f"""
+                INSERT INTO doctor_schedule ({', '.join(columns)})
+                VALUES {', '.join([row_sql] * len(batch))}
+                ON DUPLICATE KEY UPDATE shift=VALUES(shift), max_slots=VALUES(max_slots), status=VALUES(status)
+            """, params)
+    return counts
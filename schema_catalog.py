@@ -0,0 +1,66 @@
+import threading
+
+
+class SchemaCatalog:
+    """
+    进程内表结构目录：首次使用时一次性读取 information_schema，
+    之后的表/列存在性判断直接查内存；执行 DDL 后调用 invalidate() 重新加载。
+    """
+
+    def __init__(self, schema_name):
+        self.schema_name = schema_name
+        self._lock = threading.Lock()
+        self._tables = None
+        self._schedule_date_column = None
+
+    def _ensure_loaded(self, conn):
+        tables = self._tables
+        if tables is not None:
+            return tables
+        with self._lock:
+            if self._tables is None:
+                self._tables = self._load(conn)
+                self._schedule_date_column = None
+            return self._tables
+
+    def _load(self, conn):
+        tables = {}
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT table_name AS table_name, column_name AS column_name
+                FROM information_schema.columns
+                WHERE table_schema=%s
+            """, (self.schema_name,))
+            for row in cursor.fetchall():
+                tables.setdefault(row['table_name'], set()).add(row['column_name'])
+        return {name: frozenset(cols) for name, cols in tables.items()}
+
+    def invalidate(self):
+        with self._lock:
+            self._tables = None
+            self._schedule_date_column = None
+
+    def table_exists(self, conn, table_name):
+        return table_name in self._ensure_loaded(conn)
+
+    def column_exists(self, conn, table_name, column_name):
+        return column_name in self._ensure_loaded(conn).get(table_name, ())
+
+    def columns(self, conn, table_name):
+        """返回表的列名集合（frozenset），表不存在时为空集合。"""
+        return self._ensure_loaded(conn).get(table_name, frozenset())
+
+    def schedule_date_column(self, conn):
+        """排班表的日期列：优先 schedule_date，兼容旧库的 work_date。"""
+        resolved = self._schedule_date_column
+        if resolved is not None:
+            return resolved
+        cols = self.columns(conn, 'doctor_schedule')
+        if 'schedule_date' in cols:
+            resolved = 'schedule_date'
+        elif 'work_date' in cols:
+            resolved = 'work_date'
+        else:
+            resolved = 'schedule_date'
+        self._schedule_date_column = resolved
+        return resolved
@@ -0,0 +1,410 @@
+"""
+统计汇总表（daily_stats / daily_medicine_stats）的增量维护与重建。
+
+daily_stats 按 (日期, 科室, 医生) 保存挂号量、取消、支付、接诊与已支付收入；
+各写路径在自己的事务内用 track_registrations() 包住对挂号的修改，
+根据修改前后的差值累加到汇总行，/stats 只读这张小表。
+
+重建/校验（从原始表重新计算指定日期范围）：
+    python stats_rollup.py rebuild --from 2025-01-01 --to 2025-01-31
+    python stats_rollup.py check --from 2025-01-01 --to 2025-01-31
+"""
+import argparse
+import sys
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+COUNTER_FIELDS = ('reg_total', 'reg_cancelled', 'reg_paid', 'visiting', 'visited', 'mr_count')
+AMOUNT_FIELDS = ('paid_reg_fee', 'paid_check_fee', 'paid_med_fee')
+FIELDS = COUNTER_FIELDS + AMOUNT_FIELDS
+
+_LOAD_SQL = """
+    SELECT r.reg_id, r.visit_date, r.dept_id, r.doctor_id, r.visit_status, r.fee_status,
+           r.reg_fee, IFNULL(r.check_fee, 0) AS check_fee,
+           IFNULL(b.med_fee, 0) AS med_fee,
+           (SELECT COUNT(*) FROM medical_record mr WHERE mr.reg_id = r.reg_id) AS mr_count
+    FROM registration r
+             LEFT JOIN billing_ledger b ON b.reg_id = r.reg_id
+    WHERE r.reg_id IN ({placeholders})
+    FOR UPDATE
+"""
+
+# 从原始表按 (日期, 科室, 医生) 汇总，供重建与漂移校验共用
+_AGGREGATE_SQL = """
+    SELECT r.visit_date AS stat_date, r.dept_id, r.doctor_id,
+           COUNT(*) AS reg_total,
+           SUM(r.visit_status = '已取消') AS reg_cancelled,
+           SUM(r.fee_status = '已支付') AS reg_paid,
+           SUM(r.visit_status = '就诊中') AS visiting,
+           SUM(r.visit_status = '已就诊') AS visited,
+           SUM(IFNULL(mr.cnt, 0)) AS mr_count,
+           SUM(CASE WHEN r.fee_status = '已支付' AND r.visit_status != '已取消'
+                    THEN r.reg_fee ELSE 0 END) AS paid_reg_fee,
+           SUM(CASE WHEN r.fee_status = '已支付' AND r.visit_status != '已取消'
+                    THEN IFNULL(r.check_fee, 0) ELSE 0 END) AS paid_check_fee,
+           SUM(CASE WHEN r.fee_status = '已支付' AND r.visit_status != '已取消'
+                    THEN IFNULL(pf.med_fee, 0) ELSE 0 END) AS paid_med_fee
+    FROM registration r
+             LEFT JOIN (
+                 SELECT pr.reg_id, SUM(pr.total_amount) AS med_fee
+                 FROM prescription pr
+                          JOIN registration r2 ON pr.reg_id = r2.reg_id
+                 WHERE r2.visit_date BETWEEN %s AND %s
+                 GROUP BY pr.reg_id
+             ) pf ON pf.reg_id = r.reg_id
+             LEFT JOIN (
+                 SELECT m.reg_id, COUNT(*) AS cnt
+                 FROM medical_record m
+                          JOIN registration r3 ON m.reg_id = r3.reg_id
+                 WHERE r3.visit_date BETWEEN %s AND %s
+                 GROUP BY m.reg_id
+             ) mr ON mr.reg_id = r.reg_id
+    WHERE r.visit_date BETWEEN %s AND %s
+    GROUP BY r.visit_date, r.dept_id, r.doctor_id
+"""
+
+_MEDICINE_AGGREGATE_SQL = """
+    SELECT r.visit_date AS stat_date, pr.med_id, SUM(pr.total_quantity) AS qty_sum
+    FROM prescription pr
+             JOIN registration r ON pr.reg_id = r.reg_id
+    WHERE r.visit_date BETWEEN %s AND %s AND pr.dispense_status = '已发药'
+    GROUP BY r.visit_date, pr.med_id
+"""
+
+
+def _amount(value):
+    return Decimal(str(value or 0))
+
+
+def _contribution(row):
+    """单条挂号对汇总行各字段的贡献值。"""
+    paid = row['fee_status'] == '已支付'
+    cancelled = row['visit_status'] == '已取消'
+    counted = paid and not cancelled
+    return {
+        'reg_total': 1,
+        'reg_cancelled': 1 if cancelled else 0,
+        'reg_paid': 1 if paid else 0,
+        'visiting': 1 if row['visit_status'] == '就诊中' else 0,
+        'visited': 1 if row['visit_status'] == '已就诊' else 0,
+        'mr_count': int(row['mr_count'] or 0),
+        'paid_reg_fee': _amount(row['reg_fee']) if counted else Decimal(0),
+        'paid_check_fee': _amount(row['check_fee']) if counted else Decimal(0),
+        'paid_med_fee': _amount(row['med_fee']) if counted else Decimal(0),
+    }
+
+
+def _key(row):
+    return row['visit_date'], row['dept_id'], row['doctor_id']
+
+
+def _load(conn, reg_ids):
+    reg_ids = sorted({int(r) for r in reg_ids if r})
+    if not reg_ids:
+        return {}
+    with conn.cursor() as cursor:
+        cursor.execute(_LOAD_SQL.format(placeholders=', '.join(['%s'] * len(reg_ids))), reg_ids)
+        return {row['reg_id']: row for row in cursor.fetchall()}
+
+
+def _apply(conn, before, after):
+    deltas = {}
+    for reg_id in set(before) | set(after):
+        for row, sign in ((before.get(reg_id), -1), (after.get(reg_id), 1)):
+            if row is None or row['visit_date'] is None:
+                continue
+            acc = deltas.setdefault(_key(row), dict.fromkeys(FIELDS, 0))
+            for field, value in _contribution(row).items():
+                acc[field] += sign * value
+    rows = [
+        (key, acc) for key, acc in sorted(deltas.items(), key=lambda kv: tuple(str(k) for k in kv[0]))
+        if any(acc[f] for f in FIELDS)
+    ]
+    if not rows:
+        return
+    columns = ('stat_date', 'dept_id', 'doctor_id') + FIELDS
+    placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    updates = ', '.join(f"{f} = {f} + VALUES({f})" for f in FIELDS)
+    args = [v for key, acc in rows for v in key + tuple(acc[f] for f in FIELDS)]
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO daily_stats ({', '.join(columns)})
+            VALUES {', '.join([placeholders] * len(rows))}
+            ON DUPLICATE KEY UPDATE {updates}
+        """, args)
+
+
+@contextmanager
+def track_registrations(conn, reg_ids):
+    """
+    在调用方事务内包住对挂号的修改：进入时锁定并读取挂号当前状态，
+    退出时再读一次，把前后差值累加到 daily_stats。
+
+        with transaction(conn), track_registrations(conn, [reg_id]):
+            cursor.execute("UPDATE registration SET ... WHERE reg_id=%s", (reg_id,))
+    """
+    before = _load(conn, reg_ids)
+    yield
+    _apply(conn, before, _load(conn, reg_ids))
+
+
+def add_registrations(conn, reg_ids):
+    """新建挂号后调用，把新挂号计入汇总。"""
+    _apply(conn, {}, _load(conn, reg_ids))
+
+
+def add_dispensed(conn, items):
+    """
+    发药后调用：items 为 [(visit_date, med_id, quantity), ...]，累加到当日药品发药量。
+    """
+    totals = {}
+    for visit_date, med_id, quantity in items:
+        if visit_date is None:
+            continue
+        totals[(visit_date, med_id)] = totals.get((visit_date, med_id), 0) + int(quantity)
+    if not totals:
+        return
+    keys = sorted(totals, key=lambda k: (str(k[0]), k[1]))
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO daily_medicine_stats (stat_date, med_id, qty_sum)
+            VALUES {', '.join(['(%s, %s, %s)'] * len(keys))}
+            ON DUPLICATE KEY UPDATE qty_sum = qty_sum + VALUES(qty_sum)
+        """, [v for k in keys for v in (k[0], k[1], totals[k])])
+
+
+def read_day(conn, stat_date):
+    """
+    读取某日汇总：返回 (summary, dept_rows, doctor_rows, medicine_rows)，字段与原报表一致。
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT IFNULL(SUM(reg_total), 0) AS reg_total,
+                   IFNULL(SUM(reg_cancelled), 0) AS reg_cancelled,
+                   IFNULL(SUM(reg_paid), 0) AS reg_paid,
+                   IFNULL(SUM(reg_total - reg_paid), 0) AS reg_unpaid,
+                   IFNULL(SUM(visiting), 0) AS visiting,
+                   IFNULL(SUM(visited), 0) AS visited,
+                   IFNULL(SUM(mr_count), 0) AS mr_count,
+                   IFNULL(SUM(paid_reg_fee), 0) AS paid_reg_fee_sum,
+                   IFNULL(SUM(paid_check_fee), 0) AS paid_check_fee_sum,
+                   IFNULL(SUM(paid_med_fee), 0) AS paid_med_fee_sum,
+                   IFNULL(SUM(paid_reg_fee + paid_check_fee + paid_med_fee), 0) AS paid_total_fee_sum
+            FROM daily_stats
+            WHERE stat_date = %s
+        """, (stat_date,))
+        summary = cursor.fetchone() or {}
+
+        cursor.execute("""
+            SELECT dept.dept_name, SUM(s.reg_total - s.reg_cancelled) AS cnt
+            FROM daily_stats s
+                     JOIN department dept ON s.dept_id = dept.dept_id
+            WHERE s.stat_date = %s
+            GROUP BY dept.dept_name
+            HAVING cnt > 0
+            ORDER BY cnt DESC
+        """, (stat_date,))
+        dept_rows = cursor.fetchall() or []
+
+        cursor.execute("""
+            SELECT d.name AS doctor_name,
+                   SUM(s.reg_total - s.reg_cancelled) AS reg_cnt,
+                   SUM(s.visited) AS done_cnt
+            FROM daily_stats s
+                     JOIN doctor d ON s.doctor_id = d.doctor_id
+            WHERE s.stat_date = %s
+            GROUP BY d.name
+            HAVING reg_cnt > 0
+            ORDER BY reg_cnt DESC
+        """, (stat_date,))
+        doctor_rows = cursor.fetchall() or []
+
+        cursor.execute("""
+            SELECT m.med_name, SUM(s.qty_sum) AS qty_sum
+            FROM daily_medicine_stats s
+                     JOIN medicine m ON s.med_id = m.med_id
+            WHERE s.stat_date = %s AND s.qty_sum > 0
+            GROUP BY m.med_name
+            ORDER BY qty_sum DESC
+            LIMIT 10
+        """, (stat_date,))
+        medicine_rows = cursor.fetchall() or []
+    return summary, dept_rows, doctor_rows, medicine_rows
+
+
+# 时间粒度 -> 汇总表上的分组表达式（周以周一为起点，月以 1 日为起点）
+_PERIOD_SQL = {
+    'day': "s.stat_date",
+    'week': "DATE_SUB(s.stat_date, INTERVAL WEEKDAY(s.stat_date) DAY)",
+    'month': "DATE_FORMAT(s.stat_date, '%%Y-%%m-01')",
+}
+
+
+def period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def read_range(conn, date_from, date_to, granularity='day'):
+    """
+    区间趋势：按日/周/月汇总挂号量、取消量、已支付收入（挂号/检查/药费），
+    以及科室、医生的挂号量时间序列（不含取消）。全部来自 daily_stats，
+    查询量只与区间内的汇总行数有关，与原始挂号量无关。
+    返回 {'periods': [...], 'totals': [...], 'departments': [...], 'doctors': [...]}，
+    departments / doctors 的每项带 series（与 periods 对齐的数量列表）。
+    """
+    period_sql = _PERIOD_SQL[granularity]
+    periods = []
+    day = date_from
+    while day <= date_to:
+        key = period_start(day, granularity).isoformat()
+        if not periods or periods[-1] != key:
+            periods.append(key)
+        day += timedelta(days=1)
+    index = {key: i for i, key in enumerate(periods)}
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT {period_sql} AS period,
+                   SUM(s.reg_total) AS reg_total,
+                   SUM(s.reg_cancelled) AS reg_cancelled,
+                   SUM(s.paid_reg_fee) AS paid_reg_fee,
+                   SUM(s.paid_check_fee) AS paid_check_fee,
+                   SUM(s.paid_med_fee) AS paid_med_fee
+            FROM daily_stats s
+            WHERE s.stat_date BETWEEN %s AND %s
+            GROUP BY period
+        """, (date_from, date_to))
+        totals = [
+            {'period': key, 'reg_total': 0, 'reg_cancelled': 0,
+             'paid_reg_fee': Decimal(0), 'paid_check_fee': Decimal(0), 'paid_med_fee': Decimal(0),
+             'paid_total_fee': Decimal(0)}
+            for key in periods
+        ]
+        for row in cursor.fetchall():
+            item = totals[index[str(row['period'])[:10]]]
+            item['reg_total'] = int(row['reg_total'] or 0)
+            item['reg_cancelled'] = int(row['reg_cancelled'] or 0)
+            for field in AMOUNT_FIELDS:
+                item[field] = _amount(row[field])
+            item['paid_total_fee'] = item['paid_reg_fee'] + item['paid_check_fee'] + item['paid_med_fee']
+
+        cursor.execute(f"""
+            SELECT {period_sql} AS period, dept.dept_id, dept.dept_name,
+                   SUM(s.reg_total - s.reg_cancelled) AS cnt
+            FROM daily_stats s
+                     JOIN department dept ON s.dept_id = dept.dept_id
+            WHERE s.stat_date BETWEEN %s AND %s
+            GROUP BY period, dept.dept_id, dept.dept_name
+        """, (date_from, date_to))
+        departments = _series(cursor.fetchall(), 'dept_id', 'dept_name', index, len(periods))
+
+        cursor.execute(f"""
+            SELECT {period_sql} AS period, d.doctor_id, d.name AS doctor_name,
+                   SUM(s.reg_total - s.reg_cancelled) AS cnt
+            FROM daily_stats s
+                     JOIN doctor d ON s.doctor_id = d.doctor_id
+            WHERE s.stat_date BETWEEN %s AND %s
+            GROUP BY period, d.doctor_id, d.name
+        """, (date_from, date_to))
+        doctors = _series(cursor.fetchall(), 'doctor_id', 'doctor_name', index, len(periods))
+
+    return {'periods': periods, 'totals': totals, 'departments': departments, 'doctors': doctors}
+
+
+def _series(rows, id_field, name_field, index, length):
+    by_id = {}
+    for row in rows:
+        item = by_id.setdefault(row[id_field], {
+            id_field: row[id_field], name_field: row[name_field], 'series': [0] * length, 'total': 0,
+        })
+        cnt = int(row['cnt'] or 0)
+        item['series'][index[str(row['period'])[:10]]] = cnt
+        item['total'] += cnt
+    return sorted(by_id.values(), key=lambda item: -item['total'])
+
+
+def rebuild(conn, date_from, date_to):
+    """从原始表重新计算 [date_from, date_to] 内的汇总行（先删后插，单事务）。"""
+    range_args = (date_from, date_to) * 3
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM daily_stats WHERE stat_date BETWEEN %s AND %s", (date_from, date_to))
+            cursor.execute(f"""
+                INSERT INTO daily_stats (stat_date, dept_id, doctor_id, {', '.join(FIELDS)})
+                SELECT stat_date, dept_id, doctor_id, {', '.join(FIELDS)}
+                FROM ({_AGGREGATE_SQL}) agg
+            """, range_args)
+            cursor.execute("DELETE FROM daily_medicine_stats WHERE stat_date BETWEEN %s AND %s",
+                           (date_from, date_to))
+            cursor.execute(f"""
+                INSERT INTO daily_medicine_stats (stat_date, med_id, qty_sum)
+                {_MEDICINE_AGGREGATE_SQL}
+            """, (date_from, date_to))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def check(conn, date_from, date_to):
+    """
+    漂移校验：对比汇总表与原始表重新计算的结果，返回不一致的 (key, field, rollup, actual) 列表。
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(_AGGREGATE_SQL, (date_from, date_to) * 3)
+        actual = {_stat_key(row): row for row in cursor.fetchall()}
+        cursor.execute(f"""
+            SELECT stat_date, dept_id, doctor_id, {', '.join(FIELDS)}
+            FROM daily_stats
+            WHERE stat_date BETWEEN %s AND %s
+        """, (date_from, date_to))
+        rollup = {_stat_key(row): row for row in cursor.fetchall()}
+
+    diffs = []
+    empty = dict.fromkeys(FIELDS, 0)
+    for key in sorted(set(actual) | set(rollup), key=lambda k: tuple(str(x) for x in k)):
+        a = actual.get(key, empty)
+        r = rollup.get(key, empty)
+        for field in FIELDS:
+            if _amount(a[field]) != _amount(r[field]):
+                diffs.append((key, field, r[field], a[field]))
+    return diffs
+
+
+def _stat_key(row):
+    return str(row['stat_date']), row['dept_id'], row['doctor_id']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='统计汇总表重建 / 漂移校验')
+    parser.add_argument('command', choices=['rebuild', 'check'])
+    parser.add_argument('--from', dest='date_from', required=True)
+    parser.add_argument('--to', dest='date_to', required=True)
+    args = parser.parse_args(argv)
+
+    import pymysql
+    from db import DB_CONFIG
+
+    conn = pymysql.connect(**DB_CONFIG)
+    try:
+        if args.command == 'rebuild':
+            rebuild(conn, args.date_from, args.date_to)
+            print(f"[stats] 已重建 {args.date_from} ~ {args.date_to} 的汇总数据")
+        else:
+            diffs = check(conn, args.date_from, args.date_to)
+            for key, field, rollup_value, actual_value in diffs:
+                print(f"  {key} {field}: 汇总表={rollup_value} 实际={actual_value}")
+            print(f"[stats] 共发现 {len(diffs)} 处不一致")
+            return 1 if diffs else 0
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())